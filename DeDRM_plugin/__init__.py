@@ -333,8 +333,14 @@ class DeDRM(FileTypePlugin):
                 # This is an Adobe PassHash / B&N encrypted eBook
                 print("{0} v{1}: “{2}” is a secure PassHash-protected (B&N) ePub".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook)))
 
+                keyhints = prefs.DeDRM_KeyHints()
+                hintid = None
+                book_resource = ineptepub.adeptGetResourceID(inf.name)
+                if book_resource is not None:
+                    hintid = "bandn:" + book_resource.lower()
+
                 # Attempt to decrypt epub with each encryption key (generated or provided).
-                for keyname, userkey in dedrmprefs['bandnkeys'].items():
+                for keyname, userkey in keyhints.sortkeys(hintid, dedrmprefs['bandnkeys'].items()):
                     print("{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
                     of = self.temporary_file(".epub")
 
@@ -350,6 +356,7 @@ class DeDRM(FileTypePlugin):
 
                     if  result == 0:
                         # Decryption was successful.
+                        keyhints.remember(hintid, keyname)
                         # Return the modified PersistentTemporary file to calibre.
                         return self.postProcessEPUB(of.name)
 
@@ -457,10 +464,12 @@ class DeDRM(FileTypePlugin):
                                 print("{0} v{1}: Saving a new default key".format(PLUGIN_NAME, PLUGIN_VERSION))
                                 try:
                                     if userkey in defaultkeys_ade:
-                                        dedrmprefs.addnamedvaluetoprefs('bandnkeys','ade_passhash_'+str(int(time.time())),keyvalue)
+                                        added, newname = dedrmprefs.addnamedvaluetoprefs('bandnkeys','ade_passhash_'+str(int(time.time())),keyvalue)
                                     else:
-                                        dedrmprefs.addnamedvaluetoprefs('bandnkeys','nook_key_'+str(int(time.time())),keyvalue)
+                                        added, newname = dedrmprefs.addnamedvaluetoprefs('bandnkeys','nook_key_'+str(int(time.time())),keyvalue)
                                     dedrmprefs.writeprefs()
+                                    if added:
+                                        keyhints.remember(hintid, newname)
                                     print("{0} v{1}: Saved a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
                                 except:
                                     print("{0} v{1}: Exception saving a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
@@ -494,6 +503,17 @@ class DeDRM(FileTypePlugin):
                 else: 
                     print("{0} v{1}: {2} is a secure Adobe Adept ePub for UUID {3}".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook), book_uuid))
 
+                # Books licensed to the same Adobe account share a user UUID, so
+                # that is the best hint. Fall back to the resource ID otherwise.
+                keyhints = prefs.DeDRM_KeyHints()
+                hintid = None
+                if book_uuid is not None:
+                    hintid = "adept:" + book_uuid.lower()
+                else:
+                    book_resource = ineptepub.adeptGetResourceID(inf.name)
+                    if book_resource is not None:
+                        hintid = "adept:" + book_resource.lower()
+
 
                 if book_uuid is not None: 
                     # Check if we have a key with that UUID in its name: 
@@ -510,6 +530,7 @@ class DeDRM(FileTypePlugin):
                             of.close()
                             if result == 0:
                                 print("{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
+                                keyhints.remember(hintid, keyname)
                                 return self.postProcessEPUB(of.name)
                         except ineptepub.ADEPTNewVersionError:
                             print("{0} v{1}: Book uses unsupported (too new) Adobe DRM.".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
@@ -521,7 +542,7 @@ class DeDRM(FileTypePlugin):
 
 
                 # Attempt to decrypt epub with each encryption key (generated or provided).
-                for keyname, userkeyhex in dedrmprefs['adeptkeys'].items():
+                for keyname, userkeyhex in keyhints.sortkeys(hintid, dedrmprefs['adeptkeys'].items()):
                     
                     print("{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
                     of = self.temporary_file(".epub")
@@ -547,6 +568,7 @@ class DeDRM(FileTypePlugin):
                         # Decryption was successful.
                         # Return the modified PersistentTemporary file to calibre.
                         print("{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
+                        keyhints.remember(hintid, keyname)
                         return self.postProcessEPUB(of.name)
 
                     print("{0} v{1}: Failed to decrypt with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
@@ -583,7 +605,7 @@ class DeDRM(FileTypePlugin):
 
                 # Check for DeACSM keys:
                 try: 
-                    from config import checkForDeACSMkeys
+                    from utilities import checkForDeACSMkeys
 
                     newkey, newname = checkForDeACSMkeys()
 
@@ -617,8 +639,10 @@ class DeDRM(FileTypePlugin):
                                 # Store the new successful key in the defaults
                                 print("{0} v{1}: Saving a new default key".format(PLUGIN_NAME, PLUGIN_VERSION))
                                 try:
-                                    dedrmprefs.addnamedvaluetoprefs('adeptkeys', newnames[i], codecs.encode(userkey, 'hex').decode('ascii'))
+                                    added, newname = dedrmprefs.addnamedvaluetoprefs('adeptkeys', newnames[i], codecs.encode(userkey, 'hex').decode('ascii'))
                                     dedrmprefs.writeprefs()
+                                    if added:
+                                        keyhints.remember(hintid, newname)
                                     print("{0} v{1}: Saved a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
                                 except:
                                     print("{0} v{1}: Exception when saving a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
@@ -657,7 +681,11 @@ class DeDRM(FileTypePlugin):
         except:
             pass
 
+        keyhints = prefs.DeDRM_KeyHints()
+        hintid = None
+
         if book_uuid is not None: 
+            hintid = "adept:" + book_uuid.lower()
             print("{0} v{1}: {2} is a PDF ebook (EBX) for UUID {3}".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook), book_uuid))
             # Check if we have a key for that UUID
             for keyname, userkeyhex in dedrmprefs['adeptkeys'].items():
@@ -674,6 +702,7 @@ class DeDRM(FileTypePlugin):
                     of.close()
                     if result == 0:
                         print("{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
+                        keyhints.remember(hintid, keyname)
                         return of.name
                        
                 except ineptpdf.ADEPTNewVersionError:
@@ -687,7 +716,7 @@ class DeDRM(FileTypePlugin):
         # If we end up here, we didn't find a key with a matching UUID, so lets just try all of them.
 
         # Attempt to decrypt PDF with each encryption key (generated or provided).        
-        for keyname, userkeyhex in dedrmprefs['adeptkeys'].items():
+        for keyname, userkeyhex in keyhints.sortkeys(hintid, dedrmprefs['adeptkeys'].items()):
             userkey = codecs.decode(userkeyhex,'hex')
             print("{0} v{1}: Trying encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
             of = self.temporary_file(".pdf")
@@ -709,6 +738,7 @@ class DeDRM(FileTypePlugin):
                 # Decryption was successful.
                 # Return the modified PersistentTemporary file to calibre.
                 print("{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
+                keyhints.remember(hintid, keyname)
                 return of.name
 
             print("{0} v{1}: Failed to decrypt with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
@@ -745,7 +775,7 @@ class DeDRM(FileTypePlugin):
 
         # Check for DeACSM keys:
         try: 
-            from config import checkForDeACSMkeys
+            from utilities import checkForDeACSMkeys
 
             newkey, newname = checkForDeACSMkeys()
 
@@ -778,8 +808,10 @@ class DeDRM(FileTypePlugin):
                         # Store the new successful key in the defaults
                         print("{0} v{1}: Saving a new default key".format(PLUGIN_NAME, PLUGIN_VERSION))
                         try:
-                            dedrmprefs.addnamedvaluetoprefs('adeptkeys', newnames[i], codecs.encode(userkey,'hex').decode('ascii'))
+                            added, newname = dedrmprefs.addnamedvaluetoprefs('adeptkeys', newnames[i], codecs.encode(userkey,'hex').decode('ascii'))
                             dedrmprefs.writeprefs()
+                            if added:
+                                keyhints.remember(hintid, newname)
                             print("{0} v{1}: Saved a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
                         except:
                             print("{0} v{1}: Exception when saving a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
@@ -918,7 +950,8 @@ class DeDRM(FileTypePlugin):
 
         dedrmprefs = prefs.DeDRM_Prefs()
         pids = dedrmprefs['pids']
-        serials = dedrmprefs['serials']
+        # a copy, so the android serials don't end up in the saved serials
+        serials = list(dedrmprefs['serials'])
         for android_serials_list in dedrmprefs['androidkeys'].values():
             #print android_serials_list
             serials.extend(android_serials_list)
@@ -926,8 +959,11 @@ class DeDRM(FileTypePlugin):
         androidFiles = []
         kindleDatabases = list(dedrmprefs['kindlekeys'].items())
 
+        keyhints = prefs.DeDRM_KeyHints()
+
         try:
-            book = k4mobidedrm.GetDecryptedBook(path_to_ebook,kindleDatabases,androidFiles,serials,pids,self.starttime)
+            book = k4mobidedrm.GetDecryptedBook(path_to_ebook,kindleDatabases,androidFiles,serials,pids,self.starttime,keyhints,
+                                                dedrmprefs['topaz_page_workers'])
         except Exception as e:
             decoded = False
             # perhaps we need to get a new default Kindle for Mac/PC key
@@ -964,7 +1000,8 @@ class DeDRM(FileTypePlugin):
             if len(newkeys) > 0:
                 print("{0} v{1}: Found {2} new {3}".format(PLUGIN_NAME, PLUGIN_VERSION, len(newkeys), "key" if len(newkeys)==1 else "keys"))
                 try:
-                    book = k4mobidedrm.GetDecryptedBook(path_to_ebook,newkeys.items(),[],[],[],self.starttime)
+                    book = k4mobidedrm.GetDecryptedBook(path_to_ebook,newkeys.items(),[],[],[],self.starttime,
+                                                        topazworkers=dedrmprefs['topaz_page_workers'])
                     decoded = True
                     # store the new successful keys in the defaults
                     print("{0} v{1}: Saving {2} new {3}".format(PLUGIN_NAME, PLUGIN_VERSION, len(newkeys), "key" if len(newkeys)==1 else "keys"))
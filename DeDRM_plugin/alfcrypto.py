@@ -12,7 +12,10 @@ import sys
 import hmac
 from struct import pack
 import hashlib
-from . import aescbc
+try:
+    from . import aescbc
+except ImportError:
+    import aescbc
 
 class Pukall_Cipher(object):
     def __init__(self):
@@ -62,6 +65,9 @@ class Pukall_Cipher(object):
                 
         return bytes(dst)
 
+# (m * m * 0x0F902007) & 0xFFFFFFFF for every plaintext byte m
+_topaz_feedback = [(m * m * 0x0F902007) & 0xFFFFFFFF for m in range(256)]
+
 class Topaz_Cipher(object):
     def __init__(self):
         self._ctx = None
@@ -74,22 +80,28 @@ class Topaz_Cipher(object):
             ctx2 = ctx1
             ctx1 = ((((ctx1 >>2) * (ctx1 >>7))&0xFFFFFFFF) ^ (keyByte * keyByte * 0x0F902007)& 0xFFFFFFFF )
         self._ctx = [ctx1, ctx2]
-        return [ctx1,ctx2]
+        return self._ctx
 
+    # The context is updated in place, so a record may be decrypted in
+    # several pieces by passing the same context for each one.
     def decrypt(self, data,  ctx=None):
         if ctx == None:
             ctx = self._ctx
         ctx1 = ctx[0]
         ctx2 = ctx[1]
-        plainText = ""
         if isinstance(data, str):
             data = data.encode('latin-1')
+        feedback = _topaz_feedback
+        plainText = bytearray()
+        append = plainText.append
         for dataByte in data:
-            m = (dataByte ^ ((ctx1 >> 3) &0xFF) ^ ((ctx2<<3) & 0xFF)) &0xFF
+            m = (dataByte ^ (ctx1 >> 3) ^ (ctx2 << 3)) & 0xFF
             ctx2 = ctx1
-            ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) &0xFFFFFFFF) ^((m * m * 0x0F902007) &0xFFFFFFFF)
-            plainText += chr(m)
-        return plainText
+            ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) & 0xFFFFFFFF) ^ feedback[m]
+            append(m)
+        ctx[0] = ctx1
+        ctx[1] = ctx2
+        return bytes(plainText)
 
 class AES_CBC(object):
     def __init__(self):
@@ -29,46 +29,14 @@ from calibre.constants import iswindows, isosx
 
 from __init__ import PLUGIN_NAME, PLUGIN_VERSION
 from __version import RESOURCE_NAME as help_file_name
-from .utilities import uStrCmp
+try:
+    from .utilities import uStrCmp, checkForDeACSMkeys
+except ImportError:
+    from utilities import uStrCmp, checkForDeACSMkeys
 
 import prefs
 import androidkindlekey
 
-def checkForDeACSMkeys(): 
-        try: 
-            from calibre_plugins.deacsm.libadobeAccount import exportAccountEncryptionKeyDER, getAccountUUID
-        except: 
-            # Looks like DeACSM is not installed. 
-            return None, None
-
-        try:
-            from calibre.ptempfile import TemporaryFile
-       
-
-            acc_uuid = getAccountUUID()
-            if acc_uuid is None: 
-                return None, None
-
-            name = "DeACSM_uuid_" + getAccountUUID()
-
-            # Unfortunately, the DeACSM plugin only has code to export to a file, not to return raw key bytes.
-            # Make a temporary file, have the plugin write to that, then read (& delete) that file.
-
-            with TemporaryFile(suffix='.der') as tmp_key_file:
-                export_result = exportAccountEncryptionKeyDER(tmp_key_file)
-
-                if (export_result is False): 
-                    return None, None
-
-                # Read key file
-                with open(tmp_key_file,'rb') as keyfile:
-                    new_key_value = keyfile.read()
-
-            return new_key_value, name
-        except: 
-            traceback.print_exc()
-            return None, None
-
 
 class ConfigWidget(QWidget):
     def __init__(self, plugin_path, alfdir):
@@ -237,6 +205,11 @@ class ConfigWidget(QWidget):
         open_url(QUrl(url))
 
     def save_settings(self):
+        # write all the settings to the file at once
+        with self.dedrmprefs:
+            self._save_settings()
+
+    def _save_settings(self):
         self.dedrmprefs.set('bandnkeys', self.tempdedrmprefs['bandnkeys'])
         self.dedrmprefs.set('adeptkeys', self.tempdedrmprefs['adeptkeys'])
         self.dedrmprefs.set('ereaderkeys', self.tempdedrmprefs['ereaderkeys'])
@@ -8,12 +8,17 @@
 
 #@@CALIBRE_COMPAT_CODE@@
 
-from .utilities import SafeUnbuffered
+try:
+    from .utilities import SafeUnbuffered
+except ImportError:
+    from utilities import SafeUnbuffered
 
 import sys
 import csv
 import os
 import getopt
+import io
+import itertools
 from struct import pack, unpack
 
 class TpzDRMError(Exception):
@@ -111,23 +116,27 @@ def convert(i):
 
 # the complete string table used to store all book text content
 # as well as the xml tokens and values that make sense out of it
+# every string is escaped once when the table is read and the table itself
+# is a tuple, so one Dictionary can be shared by every page of a book and
+# pickled cheaply for page worker processes
 
 class Dictionary(object):
-    def __init__(self, dictFile):
+    def __init__(self, dictFile, data=None):
         self.filename = dictFile
-        self.size = 0
-        self.fo = open(dictFile,'rb')
-        self.stable = []
-        self.size = readEncodedNumber(self.fo)
-        for i in range(self.size):
-            self.stable.append(self.escapestr(readString(self.fo)))
+        if data is None:
+            with open(dictFile,'rb') as f:
+                data = f.read()
+        fo = io.BytesIO(data)
+        size = readEncodedNumber(fo) or 0
+        self.stable = tuple(self.escapestr(readString(fo) or b'') for i in range(size))
+        self.size = len(self.stable)
         self.pos = 0
 
     def escapestr(self, str):
-        str = str.replace('&','&amp;')
-        str = str.replace('<','&lt;')
-        str = str.replace('>','&gt;')
-        str = str.replace('=','&#61;')
+        str = str.replace(b'&',b'&amp;')
+        str = str.replace(b'<',b'&lt;')
+        str = str.replace(b'>',b'&gt;')
+        str = str.replace(b'=',b'&#61;')
         return str
 
     def lookup(self,val):
@@ -155,14 +164,22 @@ class Dictionary(object):
 # and information used to inject the xml snippets into page*.dat files
 
 class PageParser(object):
-    def __init__(self, filename, dict, debug, flat_xml):
-        self.fo = open(filename,'rb')
+    def __init__(self, filename, dict, debug, flat_xml, data=None):
+        # data, when given, is the record itself and filename only names it
+        if data is None:
+            with open(filename,'rb') as fo:
+                data = fo.read()
+        # the whole record is decoded in memory with an integer cursor
+        self.data = data
+        self.pos = 0
         self.id = os.path.basename(filename).replace('.dat','')
         self.dict = dict
         self.debug = debug
         self.first_unknown = True
         self.flat_xml = flat_xml
         self.tagpath = []
+        # for each depth, the tag path starting at every level: [full path, ..., last token]
+        self.tagpaths = [[]]
         self.doc = []
         self.snippetList = []
 
@@ -407,17 +424,15 @@ class PageParser(object):
     # full tag path record keeping routines
     def tag_push(self, token):
         self.tagpath.append(token)
+        self.tagpaths.append([path + b'.' + token for path in self.tagpaths[-1]] + [token])
     def tag_pop(self):
         if len(self.tagpath) > 0 :
             self.tagpath.pop()
+            self.tagpaths.pop()
     def tagpath_len(self):
         return len(self.tagpath)
     def get_tagpath(self, i):
-        cnt = len(self.tagpath)
-        if i < cnt : result = self.tagpath[i]
-        for j in range(i+1, cnt) :
-            result += b'.' + self.tagpath[j]
-        return result
+        return self.tagpaths[-1][i]
 
 
     # list of absolute command byte values values that indicate
@@ -427,21 +442,81 @@ class PageParser(object):
 
     # peek at and return 1 byte that is ahead by i bytes
     def peek(self, aheadi):
-        c = self.fo.read(aheadi)
-        if (len(c) == 0):
+        size = len(self.data)
+        if self.pos >= size:
             return None
-        self.fo.seek(-aheadi,1)
-        c = c[-1:]
-        return ord(c)
+        return self.data[min(self.pos + aheadi, size) - 1]
+
+
+    # get a 7 bit encoded number at the cursor, as readEncodedNumber does from a file
+    def readNumber(self):
+        data = self.data
+        size = len(data)
+        pos = self.pos
+        if pos >= size:
+            return None
+        c = data[pos]
+        pos += 1
+        flag = False
+        if c == 0xFF:
+            flag = True
+            if pos >= size:
+                self.pos = pos
+                return None
+            c = data[pos]
+            pos += 1
+        if c >= 0x80:
+            datax = c & 0x7F
+            while c >= 0x80:
+                if pos >= size:
+                    self.pos = pos
+                    return None
+                c = data[pos]
+                pos += 1
+                datax = (datax << 7) + (c & 0x7F)
+            c = datax
+        self.pos = pos
+        if flag:
+            return -c
+        return c
+
+    # get cnt 7 bit encoded numbers, decoding positive values inline
+    def readNumbers(self, cnt):
+        data = self.data
+        size = len(data)
+        pos = self.pos
+        result = []
+        append = result.append
+        try:
+            for i in range(cnt):
+                c = data[pos]
+                pos += 1
+                if c >= 0x80:
+                    if c == 0xFF:
+                        self.pos = pos - 1
+                        c = self.readNumber()
+                        pos = self.pos
+                    else:
+                        datax = c & 0x7F
+                        while c >= 0x80:
+                            c = data[pos]
+                            pos += 1
+                            datax = (datax << 7) + (c & 0x7F)
+                        c = datax
+                append(c)
+        except IndexError:
+            # ran off the end of the record, as readNumber would
+            append(None)
+            pos = size
+        self.pos = pos
+        return result
 
 
     # get the next value from the file being processed
     def getNext(self):
-        nbyte = self.peek(1);
-        if (nbyte == None):
+        if self.pos >= len(self.data):
             return None
-        val = readEncodedNumber(self.fo)
-        return val
+        return self.readNumber()
 
 
     # format an arg by argtype
@@ -466,9 +541,7 @@ class PageParser(object):
         self.tag_push(token)
 
         if self.debug : print('Processing: ', self.get_tagpath(0))
-        cnt = self.tagpath_len()
-        for j in range(cnt):
-            tkn = self.get_tagpath(j)
+        for tkn in self.tagpaths[-1]:
             if tkn in self.token_tags :
                 num_args = self.token_tags[tkn][0]
                 argtype = self.token_tags[tkn][1]
@@ -485,15 +558,15 @@ class PageParser(object):
             if (splcase == 1):
                 # this type of tag uses of escape marker 0x74 indicate subtag count
                 if self.peek(1) == 0x74:
-                    skip = readEncodedNumber(self.fo)
+                    skip = self.readNumber()
                     subtags = 1
                     num_args = 0
 
             if (subtags == 1):
-                ntags = readEncodedNumber(self.fo)
+                ntags = self.readNumber()
                 if self.debug : print('subtags: ', token , ' has ' , str(ntags))
                 for j in range(ntags):
-                    val = readEncodedNumber(self.fo)
+                    val = self.readNumber()
                     subtagres.append(self.procToken(self.dict.lookup(val)))
 
             # arguments can be scalars or vectors of text or numbers
@@ -502,12 +575,12 @@ class PageParser(object):
                 firstarg = self.peek(1)
                 if (firstarg in self.cmd_list) and (argtype != 'scalar_number') and (argtype != 'scalar_text'):
                     # single argument is a variable length vector of data
-                    arg = readEncodedNumber(self.fo)
+                    arg = self.readNumber()
                     argres = self.decodeCMD(arg,argtype)
                 else :
                     # num_arg scalar arguments
                     for i in range(num_args):
-                        argres.append(self.formatArg(readEncodedNumber(self.fo), argtype))
+                        argres.append(self.formatArg(self.readNumber(), argtype))
 
             # build the return tag
             result = []
@@ -535,7 +608,7 @@ class PageParser(object):
     # it is NEVER used to format arguments.
     # builds the snippetList
     def doLoop72(self, argtype):
-        cnt = readEncodedNumber(self.fo)
+        cnt = self.readNumber()
         if self.debug :
             result = 'Set of '+ str(cnt) + ' xml snippets. The overall structure \n'
             result += 'of the document is indicated by snippet number sets at the\n'
@@ -545,7 +618,7 @@ class PageParser(object):
             if self.debug: print('Snippet:',str(i))
             snippet = []
             snippet.append(i)
-            val = readEncodedNumber(self.fo)
+            val = self.readNumber()
             snippet.append(self.procToken(self.dict.lookup(val)))
             self.snippetList.append(snippet)
         return
@@ -557,14 +630,18 @@ class PageParser(object):
         result = []
         adj = 0
         if mode & 1:
-            adj = readEncodedNumber(self.fo)
+            adj = self.readNumber()
         mode = mode >> 1
-        x = []
-        for i in range(cnt):
-            x.append(readEncodedNumber(self.fo) - adj)
+        x = self.readNumbers(cnt)
+        if adj:
+            x = [val - adj for val in x]
         for i in range(mode):
-            for j in range(1, cnt):
-                x[j] = x[j] + x[j - 1]
+            x = list(itertools.accumulate(x))
+        if (argtype == 'text') or (argtype == 'scalar_text') :
+            lookup = self.dict.lookup
+            return [lookup(val) for val in x]
+        if argtype in ('raw', 'number', 'scalar_number', 'snippets') :
+            return x
         for i in range(cnt):
             result.append(self.formatArg(x[i],argtype))
         return result
@@ -581,8 +658,8 @@ class PageParser(object):
         if (cmd == 0x76):
 
             # loop with cnt, and mode to control loop styles
-            cnt = readEncodedNumber(self.fo)
-            mode = readEncodedNumber(self.fo)
+            cnt = self.readNumber()
+            mode = self.readNumber()
 
             if self.debug : print('Loop for', cnt, 'with  mode', mode,  ':  ')
             return self.doLoop76Mode(argtype, cnt, mode)
@@ -687,14 +764,10 @@ class PageParser(object):
         rlst = []
         rlst.append(name)
         if (len(argList) > 0):
-            alst = []
-            for j in argList:
-                if (argtype == 'text') or (argtype == 'scalar_text') :
-                     alst.append(j + b'|')
-                else :
-                    alst.append(str(j).encode('utf-8') + b'|')
-            argres = b"".join(alst)
-            argres = argres[0:-1]
+            if (argtype == 'text') or (argtype == 'scalar_text') :
+                argres = b"|".join(argList)
+            else :
+                argres = b"|".join([b'%d' % j for j in argList])
             if argtype == b'snippets' :
                 rlst.append(b'.snippets=' + argres)
             else :
@@ -732,21 +805,22 @@ class PageParser(object):
     def process(self):
 
         # peek at the first bytes to see what type of file it is
-        magic = self.fo.read(9)
+        magic = self.data[0:9]
+        self.pos = 9
         if (magic[0:1] == b'p') and (magic[2:9] == b'marker_'):
             first_token = b'info'
         elif (magic[0:1] == b'p') and (magic[2:9] == b'__PAGE_'):
-            skip = self.fo.read(2)
+            self.pos += 2
             first_token = b'info'
         elif (magic[0:1] == b'p') and (magic[2:8] == b'_PAGE_'):
             first_token = b'info'
         elif (magic[0:1] == b'g') and (magic[2:9] == b'__GLYPH'):
-            skip = self.fo.read(3)
+            self.pos += 3
             first_token = b'info'
         else :
             # other0.dat file
             first_token = None
-            self.fo.seek(-9,1)
+            self.pos = 0
 
 
         # main loop to read and build the document tree
@@ -774,7 +848,7 @@ class PageParser(object):
                     print("Main Loop:  Unknown value: %x" % v)
                 if (v == 0):
                     if (self.peek(1) == 0x5f):
-                        skip = self.fo.read(1)
+                        self.pos += 1
                         first_token = b'info'
 
         # now do snippet injection
@@ -793,17 +867,17 @@ class PageParser(object):
         return xmlpage
 
 
-def fromData(dict, fname):
+def fromData(dict, fname, data=None):
     flat_xml = True
     debug = True
-    pp = PageParser(fname, dict, debug, flat_xml)
+    pp = PageParser(fname, dict, debug, flat_xml, data)
     xmlpage = pp.process()
     return xmlpage
 
-def getXML(dict, fname):
+def getXML(dict, fname, data=None):
     flat_xml = False
     debug = True
-    pp = PageParser(fname, dict, debug, flat_xml)
+    pp = PageParser(fname, dict, debug, flat_xml, data)
     xmlpage = pp.process()
     return xmlpage
 
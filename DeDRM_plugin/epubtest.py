@@ -55,12 +55,18 @@ import sys, struct, os, traceback
 import zlib
 import zipfile
 import xml.etree.ElementTree as etree
-from .argv_utils import unicode_argv
+try:
+    from .argv_utils import unicode_argv
+except ImportError:
+    from argv_utils import unicode_argv
 
 NSMAP = {'adept': 'http://ns.adobe.com/adept',
          'enc': 'http://www.w3.org/2001/04/xmlenc#'}
 
-from .utilities import SafeUnbuffered
+try:
+    from .utilities import SafeUnbuffered
+except ImportError:
+    from utilities import SafeUnbuffered
 
 
 _FILENAME_LEN_OFFSET = 26
@@ -66,11 +66,12 @@
 #  1.00 - Added Python 3 compatibility for calibre 5.0
 #  1.01 - Bugfixes for standalone version.
 #  1.02 - Remove OpenSSL support; only use PyCryptodome
+#  1.03 - Stream decrypted pages straight into the PMLZ, read sections through mmap
 
-__version__='1.02'
+__version__='1.03'
 
 import sys, re
-import struct, binascii, getopt, zlib, os, os.path, urllib, tempfile, traceback, hashlib
+import struct, binascii, getopt, zlib, os, os.path, urllib, traceback, hashlib, mmap, zipfile
 
 try:
     from Cryptodome.Cipher import DES
@@ -79,8 +80,12 @@ except ImportError:
 
 #@@CALIBRE_COMPAT_CODE@@
 
-from .utilities import SafeUnbuffered
-from .argv_utils import unicode_argv
+try:
+    from .utilities import SafeUnbuffered
+    from .argv_utils import unicode_argv
+except ImportError:
+    from utilities import SafeUnbuffered
+    from argv_utils import unicode_argv
 
 iswindows = sys.platform.startswith('win')
 isosx = sys.platform.startswith('darwin')
@@ -96,20 +101,29 @@ class Sectionizer(object):
     bkType = "Book"
 
     def __init__(self, filename, ident):
-        self.contents = open(filename, 'rb').read()
-        self.header = self.contents[0:72]
-        self.num_sections, = struct.unpack('>H', self.contents[76:78])
-        # Dictionary or normal content (TODO: Not hard-coded)
-        if self.header[0x3C:0x3C+8] != ident:
-            if self.header[0x3C:0x3C+8] == b"PDctPPrs":
-                self.bkType = "Dict"
-            else:
-                raise ValueError('Invalid file format')
-        self.sections = []
-        for i in range(self.num_sections):
-            offset, a1,a2,a3,a4 = struct.unpack('>LBBBB', self.contents[78+i*8:78+i*8+8])
-            flags, val = a1, a2<<16|a3<<8|a4
-            self.sections.append( (offset, flags, val) )
+        self.fo = open(filename, 'rb')
+        try:
+            try:
+                # sections are sliced out of the mapped file as they are needed
+                self.contents = mmap.mmap(self.fo.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                self.contents = self.fo.read()
+            self.header = self.contents[0:72]
+            self.num_sections, = struct.unpack('>H', self.contents[76:78])
+            # Dictionary or normal content (TODO: Not hard-coded)
+            if self.header[0x3C:0x3C+8] != ident:
+                if self.header[0x3C:0x3C+8] == b"PDctPPrs":
+                    self.bkType = "Dict"
+                else:
+                    raise ValueError('Invalid file format')
+            self.sections = []
+            for i in range(self.num_sections):
+                offset, a1,a2,a3,a4 = struct.unpack('>LBBBB', self.contents[78+i*8:78+i*8+8])
+                flags, val = a1, a2<<16|a3<<8|a4
+                self.sections.append( (offset, flags, val) )
+        except:
+            self.close()
+            raise
     def loadSection(self, section):
         if section + 1 == self.num_sections:
             end_off = len(self.contents)
@@ -117,6 +131,10 @@ class Sectionizer(object):
             end_off = self.sections[section + 1][0]
         off = self.sections[section][0]
         return self.contents[off:end_off]
+    def close(self):
+        if isinstance(getattr(self, 'contents', None), mmap.mmap):
+            self.contents.close()
+        self.fo.close()
 
 # cleanup unicode filenames
 # borrowed from calibre from calibre/src/calibre/__init__.py
@@ -147,17 +165,8 @@ def fixKey(key):
     return bytes(bytearray([fixByte(a) for a in key]))
 
 def deXOR(text, sp, table):
-    r=b''
-    j = sp
-    for i in range(len(text)):
-        if sys.version_info[0] == 2:
-            r += chr(ord(table[j]) ^ ord(text[i]))
-        else: 
-            r += bytes(bytearray([table[j] ^ text[i]]))
-        j = j + 1
-        if j == len(table):
-            j = 0
-    return r
+    tlen = len(table)
+    return bytes(table[(sp + i) % tlen] ^ c for i, c in enumerate(text))
 
 class EreaderProcessor(object):
     def __init__(self, sect, user_key):
@@ -309,16 +318,16 @@ class EreaderProcessor(object):
     #         bkinfo += '\n'
     #     return bkinfo
 
-    def getText(self):
+    # yields the pml of the book a page at a time
+    def getTextPages(self):
         des = DES.new(fixKey(self.content_key), DES.MODE_ECB)
-        r = b''
         for i in range(self.num_text_pages):
             logging.debug('get page %d', i)
-            r += zlib.decompress(des.decrypt(self.section_reader(1 + i)))
+            yield zlib.decompress(des.decrypt(self.section_reader(1 + i)))
 
         # now handle footnotes pages
         if self.num_footnote_pages > 0:
-            r += '\n'
+            yield b'\n'
             # the record 0 of the footnote section must pass through the Xor Table to make it useful
             sect = self.section_reader(self.first_footnote_page)
             fnote_ids = deXOR(sect, 0, self.xortable)
@@ -326,12 +335,11 @@ class EreaderProcessor(object):
             des = DES.new(fixKey(self.content_key), DES.MODE_ECB)
             for i in range(1,self.num_footnote_pages):
                 logging.debug('get footnotepage %d', i)
-                id_len = ord(fnote_ids[2])
+                id_len = fnote_ids[2]
                 id = fnote_ids[3:3+id_len]
-                fmarker = '<footnote id="%s">\n' % id
-                fmarker += zlib.decompress(des.decrypt(self.section_reader(self.first_footnote_page + i)))
-                fmarker += '\n</footnote>\n'
-                r += fmarker
+                yield b'<footnote id="%s">\n' % id
+                yield zlib.decompress(des.decrypt(self.section_reader(self.first_footnote_page + i)))
+                yield b'\n</footnote>\n'
                 fnote_ids = fnote_ids[id_len+4:]
 
         # TODO: Handle dictionary index (?) pages - which are also marked as
@@ -342,83 +350,86 @@ class EreaderProcessor(object):
 
         # now handle sidebar pages
         if self.num_sidebar_pages > 0:
-            r += '\n'
+            yield b'\n'
             # the record 0 of the sidebar section must pass through the Xor Table to make it useful
             sect = self.section_reader(self.first_sidebar_page)
             sbar_ids = deXOR(sect, 0, self.xortable)
             # the remaining records of the sidebar sections need to be decoded with the content_key and zlib inflated
             des = DES.new(fixKey(self.content_key), DES.MODE_ECB)
             for i in range(1,self.num_sidebar_pages):
-                id_len = ord(sbar_ids[2])
+                id_len = sbar_ids[2]
                 id = sbar_ids[3:3+id_len]
-                smarker = '<sidebar id="%s">\n' % id
-                smarker += zlib.decompress(des.decrypt(self.section_reader(self.first_sidebar_page + i)))
-                smarker += '\n</sidebar>\n'
-                r += smarker
+                yield b'<sidebar id="%s">\n' % id
+                yield zlib.decompress(des.decrypt(self.section_reader(self.first_sidebar_page + i)))
+                yield b'\n</sidebar>\n'
                 sbar_ids = sbar_ids[id_len+4:]
 
-        return r
+    def getText(self):
+        return b''.join(self.getTextPages())
+
+_highChars = re.compile(b'[\x80-\xff]')
 
 def cleanPML(pml):
     # Convert special characters to proper PML code.  High ASCII start at (\x80, \a128) and go up to (\xff, \a255)
-    pml2 = pml
-    for k in range(128,256):
-        pml2 = pml2.replace(bytes([k]), b'\\a%03d' % k)
-    return pml2
+    return _highChars.sub(lambda m: b'\\a%03d' % m.group()[0], pml)
 
 def decryptBook(infile, outpath, make_pmlz, user_key):
     bookname = os.path.splitext(os.path.basename(infile))[0]
+    pmlfilename = bookname + ".pml"
     if make_pmlz:
-        # outpath is actually pmlz name
+        # outpath is actually pmlz name, everything is written straight into it
         pmlzname = outpath
-        outdir = tempfile.mkdtemp()
-        imagedirpath = os.path.join(outdir,"images")
+        outdir = None
+        imagedirname = "images"
     else:
         pmlzname = None
         outdir = outpath
-        imagedirpath = os.path.join(outdir,bookname + "_img")
+        imagedirname = bookname + "_img"
 
+    sect = None
+    myZipFile = None
     try:
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
         print("Decoding File")
-        sect  =Sectionizer(infile, b'PNRdPPrs')
+        sect = Sectionizer(infile, b'PNRdPPrs')
         er = EreaderProcessor(sect, user_key)
 
+        if pmlzname is not None:
+            print("Creating PMLZ file {0}".format(os.path.basename(pmlzname)))
+            myZipFile = zipfile.ZipFile(pmlzname,'w',zipfile.ZIP_STORED, False)
+        elif not os.path.exists(outdir):
+            os.makedirs(outdir)
+
         if er.getNumImages() > 0:
             print("Extracting images")
-            if not os.path.exists(imagedirpath):
-                os.makedirs(imagedirpath)
-            for i in range(er.getNumImages()):
+            if myZipFile is None:
+                imagedirpath = os.path.join(outdir, imagedirname)
+                if not os.path.exists(imagedirpath):
+                    os.makedirs(imagedirpath)
+            # last to first, skipping names already written, so that of two
+            # images with the same name the last one is kept, like in a folder
+            written = set()
+            for i in reversed(range(er.getNumImages())):
                 name, contents = er.getImage(i)
-                open(os.path.join(imagedirpath, name), 'wb').write(contents)
+                if name in written:
+                    continue
+                written.add(name)
+                if myZipFile is not None:
+                    myZipFile.writestr(imagedirname + "/" + name, contents)
+                else:
+                    open(os.path.join(imagedirpath, name), 'wb').write(contents)
 
         print("Extracting pml")
-        pml_string = er.getText()
-        pmlfilename = bookname + ".pml"
-        open(os.path.join(outdir, pmlfilename),'wb').write(cleanPML(pml_string))
-        if pmlzname is not None:
-            import zipfile
-            import shutil
-            print("Creating PMLZ file {0}".format(os.path.basename(pmlzname)))
-            myZipFile = zipfile.ZipFile(pmlzname,'w',zipfile.ZIP_STORED, False)
-            list = os.listdir(outdir)
-            for filename in list:
-                localname = filename
-                filePath = os.path.join(outdir,filename)
-                if os.path.isfile(filePath):
-                    myZipFile.write(filePath, localname)
-                elif os.path.isdir(filePath):
-                    imageList = os.listdir(filePath)
-                    localimgdir = os.path.basename(filePath)
-                    for image in imageList:
-                        localname = os.path.join(localimgdir,image)
-                        imagePath = os.path.join(filePath,image)
-                        if os.path.isfile(imagePath):
-                            myZipFile.write(imagePath, localname)
+        if myZipFile is not None:
+            pmlfile = myZipFile.open(pmlfilename, 'w')
+        else:
+            pmlfile = open(os.path.join(outdir, pmlfilename), 'wb')
+        with pmlfile:
+            for page in er.getTextPages():
+                pmlfile.write(cleanPML(page))
+
+        if myZipFile is not None:
             myZipFile.close()
-            # remove temporary directory
-            shutil.rmtree(outdir, True)
+            myZipFile = None
             print("Output is {0}".format(pmlzname))
         else:
             print("Output is in {0}".format(outdir))
@@ -427,6 +438,15 @@ def decryptBook(infile, outpath, make_pmlz, user_key):
         print("Error: {0}".format(e))
         traceback.print_exc()
         return 1
+    finally:
+        if myZipFile is not None:
+            # the pmlz wasn't finished, don't leave a half written one behind
+            try:
+                myZipFile.close()
+            finally:
+                os.remove(pmlzname)
+        if sect is not None:
+            sect.close()
     return 0
 
 
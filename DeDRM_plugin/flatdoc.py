@@ -0,0 +1,81 @@
+#! /usr/bin/python
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+# For use with Topaz Scripts Version 2.6
+
+import bisect
+
+
+# The flattened xml made by convert2xml has one "tag.path=value" per line.
+# It is split into names and values once, and lookups by tag path go through
+# an index of the lines whose name ends with that path, built the first time
+# the path is asked for, so searching a range is a bisect rather than a scan
+# that splits every line again.
+
+class FlatDoc(object):
+    def __init__(self, flatxml):
+        self.names = []
+        self.values = []
+        for item in flatxml.split(b'\n'):
+            (name, sep, value) = item.partition(b'=')
+            self.names.append(name)
+            self.values.append(value)
+        self.size = len(self.names)
+        self.suffixes = {}
+        self.firstnames = None
+        self.taken = None
+
+    # return the sorted line numbers of every tag whose path ends with tagpath
+    def positions(self, tagpath):
+        if (isinstance(tagpath,str)):
+            tagpath = tagpath.encode('utf-8')
+        result = self.suffixes.get(tagpath)
+        if result is None:
+            result = [j for j, name in enumerate(self.names) if name.endswith(tagpath)]
+            self.suffixes[tagpath] = result
+        return result
+
+    # return name and value of the tag at line pos
+    def line(self, pos):
+        return self.names[pos], self.values[pos]
+
+    # find tag if within pos to end, returns its line number and value
+    # or -1 and None if there is no such tag
+    def find(self, tagpath, pos, end):
+        if (isinstance(tagpath,str)):
+            tagpath = tagpath.encode('utf-8')
+        if end == -1 :
+            end = self.size
+        else:
+            end = min(self.size, end)
+        if pos < 0:
+            # negative positions count back from the end of the document
+            for j in range(pos, min(end, 0)):
+                if self.names[j].endswith(tagpath):
+                    return j, self.values[j]
+            pos = 0
+        found = self.positions(tagpath)
+        i = bisect.bisect_left(found, pos)
+        if (i < len(found)) and (found[i] < end):
+            return found[i], self.values[found[i]]
+        return -1, None
+
+    # find the first tag whose path is exactly name
+    def findexact(self, name):
+        if self.firstnames is None:
+            self.firstnames = {}
+            for j in range(self.size - 1, -1, -1):
+                self.firstnames[self.names[j]] = j
+        j = self.firstnames.get(name, -1)
+        if j < 0:
+            return -1, None
+        return j, self.values[j]
+
+    # find the first tag ending with tagpath not already taken, and take it
+    def take(self, tagpath):
+        if self.taken is None:
+            self.taken = set()
+        for j in self.positions(tagpath):
+            if j not in self.taken:
+                self.taken.add(j)
+                return j, self.values[j]
+        return -1, None
@@ -11,15 +11,17 @@ import functools
 from struct import pack
 from struct import unpack
 
+from flatdoc import FlatDoc
+
 
 class DocParser(object):
-    def __init__(self, flatxml, classlst, fileid, bookDir, gdict, fixedimage):
+    def __init__(self, flatxml, classlst, fileid, store, gdict, fixedimage):
         self.id = os.path.basename(fileid).replace('.dat','')
         self.svgcount = 0
-        self.docList = flatxml.split(b'\n')
-        self.docSize = len(self.docList)
+        self.flatdoc = FlatDoc(flatxml)
+        self.docSize = self.flatdoc.size
         self.classList = {}
-        self.bookDir = bookDir
+        self.store = store
         self.gdict = gdict
         tmpList = classlst.split('\n')
         for pclass in tmpList:
@@ -40,22 +42,11 @@ class DocParser(object):
 
 
     def getGlyph(self, gid):
-        result = ''
-        id='id="gl%d"' % gid
-        return self.gdict.lookup(id)
+        return self.gdict.lookup(gid)
 
     def glyphs_to_image(self, glyphList):
 
-        def extract(path, key):
-            b = path.find(key) + len(key)
-            e = path.find(' ',b)
-            return int(path[b:e])
-
-        svgDir = os.path.join(self.bookDir,'svg')
-
-        imgDir = os.path.join(self.bookDir,'img')
         imgname = self.id + '_%04d.svg' % self.svgcount
-        imgfile = os.path.join(imgDir,imgname)
 
         # get glyph information
         gxList = self.getData(b'info.glyph.x',0,-1)
@@ -85,11 +76,11 @@ class DocParser(object):
             if miny == -1: miny = gyList[j]
             else : miny = min(miny, gyList[j])
 
-            path = self.getGlyph(gid)
-            gdefs.append(path)
+            gdefs.append(self.getGlyph(gid))
 
-            maxws.append(extract(path,'width='))
-            maxhs.append(extract(path,'height='))
+            (maxw, maxh) = self.gdict.getDim(gid)
+            maxws.append(maxw)
+            maxhs.append(maxh)
 
 
         # change the origin to minx, miny and calc max height and width
@@ -101,19 +92,19 @@ class DocParser(object):
             maxw = max( maxw, (maxws[j] + xs[j]) )
             maxh = max( maxh, (maxhs[j] + ys[j]) )
 
-        # open the image file for output
-        ifile = open(imgfile,'w')
-        ifile.write('<?xml version="1.0" standalone="no"?>\n')
-        ifile.write('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
-        ifile.write('<svg width="%dpx" height="%dpx" viewBox="0 0 %d %d" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1">\n' % (math.floor(maxw/10), math.floor(maxh/10), maxw, maxh))
-        ifile.write('<defs>\n')
+        # build the image and add it to the book's img directory
+        ilst = []
+        ilst.append('<?xml version="1.0" standalone="no"?>\n')
+        ilst.append('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
+        ilst.append('<svg width="%dpx" height="%dpx" viewBox="0 0 %d %d" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1">\n' % (math.floor(maxw/10), math.floor(maxh/10), maxw, maxh))
+        ilst.append('<defs>\n')
         for j in range(0,len(gdefs)):
-            ifile.write(gdefs[j])
-        ifile.write('</defs>\n')
+            ilst.append(gdefs[j])
+        ilst.append('</defs>\n')
         for j in range(0,len(gids)):
-            ifile.write('<use xlink:href="#gl%d" x="%d" y="%d" />\n' % (gids[j], xs[j], ys[j]))
-        ifile.write('</svg>')
-        ifile.close()
+            ilst.append('<use xlink:href="#gl%d" x="%d" y="%d" />\n' % (gids[j], xs[j], ys[j]))
+        ilst.append('</svg>')
+        self.store.write('img/' + imgname, "".join(ilst))
 
         return 0
 
@@ -122,50 +113,18 @@ class DocParser(object):
     # return tag at line pos in document
     def lineinDoc(self, pos) :
         if (pos >= 0) and (pos < self.docSize) :
-            item = self.docList[pos]
-            if item.find(b'=') >= 0:
-                (name, argres) = item.split(b'=',1)
-            else :
-                name = item
-                argres = b''
+            (name, argres) = self.flatdoc.line(pos)
         return name, argres
 
 
     # find tag in doc if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        if end == -1 :
-            end = self.docSize
-        else:
-            end = min(self.docSize, end)
-        foundat = -1
-        for j in range(pos, end):
-            item = self.docList[j]
-            if item.find(b'=') >= 0:
-                (name, argres) = item.split(b'=',1)
-            else :
-                name = item
-                argres = ''
-            if (isinstance(tagpath,str)):
-                tagpath = tagpath.encode('utf-8')
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.flatdoc.find(tagpath, pos, end)
 
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = ""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return list(self.flatdoc.positions(tagpath))
 
 
     # returns a vector of integers for the tagpath
@@ -802,8 +761,8 @@ class DocParser(object):
         return htmlpage, tocinfo
 
 
-def convert2HTML(flatxml, classlst, fileid, bookDir, gdict, fixedimage):
+def convert2HTML(flatxml, classlst, fileid, store, gdict, fixedimage):
     # create a document parser
-    dp = DocParser(flatxml, classlst, fileid, bookDir, gdict, fixedimage)
+    dp = DocParser(flatxml, classlst, fileid, store, gdict, fixedimage)
     htmlpage, tocinfo = dp.process()
     return htmlpage, tocinfo
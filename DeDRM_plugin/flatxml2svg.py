@@ -8,13 +8,14 @@ import getopt
 from struct import pack
 from struct import unpack
 
+from flatdoc import FlatDoc
+
 
 class PParser(object):
     def __init__(self, gd, flatxml, meta_array):
         self.gd = gd
-        self.flatdoc = flatxml.split(b'\n')
-        self.docSize = len(self.flatdoc)
-        self.temp = []
+        self.flatdoc = FlatDoc(flatxml)
+        self.docSize = self.flatdoc.size
 
         self.ph = -1
         self.pw = -1
@@ -57,111 +58,47 @@ class PParser(object):
     # return tag at line pos in document
     def lineinDoc(self, pos) :
         if (pos >= 0) and (pos < self.docSize) :
-            item = self.flatdoc[pos]
-            if item.find(b'=') >= 0:
-                (name, argres) = item.split(b'=',1)
-            else :
-                name = item
-                argres = b''
+            (name, argres) = self.flatdoc.line(pos)
         return name, argres
 
     # find tag in doc if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        if end == -1 :
-            end = self.docSize
-        else:
-            end = min(self.docSize, end)
-        foundat = -1
-        for j in range(pos, end):
-            item = self.flatdoc[j]
-            if item.find(b'=') >= 0:
-                (name, argres) = item.split(b'=',1)
-            else :
-                name = item
-                argres = b''
-            if (isinstance(tagpath,str)):
-                tagpath = tagpath.encode('utf-8')
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.flatdoc.find(tagpath, pos, end)
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = ""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return list(self.flatdoc.positions(tagpath))
+
+    # split a value into a vector of integers
+    def intList(self, argt):
+        if len(argt) == 0:
+            return []
+        return [int(strval) for strval in argt.split(b'|')]
 
     def getData(self, path):
-        result = None
-        cnt = len(self.flatdoc)
-        for j in range(cnt):
-            item = self.flatdoc[j]
-            if item.find(b'=') >= 0:
-                (name, argt) = item.split(b'=')
-                argres = argt.split(b'|')
-            else:
-                name = item
-                argres = []
-            if (name.endswith(path)):
-                result = argres
-                break
-        if (len(argres) > 0) :
-            for j in range(0,len(argres)):
-                argres[j] = int(argres[j])
-        return result
+        (foundat, argt) = self.flatdoc.find(path, 0, -1)
+        if argt is None:
+            return None
+        return self.intList(argt)
 
     def getDataatPos(self, path, pos):
-        result = None
-        item = self.flatdoc[pos]
-        if item.find(b'=') >= 0:
-            (name, argt) = item.split(b'=')
-            argres = argt.split(b'|')
-        else:
-            name = item
-            argres = []
-        if (len(argres) > 0) :
-            for j in range(0,len(argres)):
-                argres[j] = int(argres[j])
+        (name, argt) = self.flatdoc.line(pos)
         if (isinstance(path,str)):
             path = path.encode('utf-8')
         if (name.endswith(path)):
-            result = argres
-        return result
+            return self.intList(argt)
+        return None
 
+    # get the data of the first tag ending with path that has not been
+    # returned by an earlier call
     def getDataTemp(self, path):
-        result = None
-        cnt = len(self.temp)
-        for j in range(cnt):
-            item = self.temp[j]
-            if item.find(b'=') >= 0:
-                (name, argt) = item.split(b'=')
-                argres = argt.split(b'|')
-            else:
-                name = item
-                argres = []
-            if (isinstance(path,str)):
-                path = path.encode('utf-8')
-            if (name.endswith(path)):
-                result = argres
-                self.temp.pop(j)
-                break
-        if (len(argres) > 0) :
-            for j in range(0,len(argres)):
-                argres[j] = int(argres[j])
-        return result
+        (foundat, argt) = self.flatdoc.take(path)
+        if argt is None:
+            return None
+        return self.intList(argt)
 
     def getImages(self):
         result = []
-        self.temp = self.flatdoc
         while (self.getDataTemp('img') != None):
             h = self.getDataTemp('img.h')[0]
             w = self.getDataTemp('img.w')[0]
@@ -179,10 +116,9 @@ class PParser(object):
                 glyphs.append(j)
             glyphs.sort()
             for gid in glyphs:
-                id='id="gl%d"' % gid
-                path = self.gd.lookup(id)
+                path = self.gd.lookup(gid)
                 if path:
-                    result.append(id + ' ' + path)
+                    result.append('id="gl%d" ' % gid + path)
         return result
 
 
@@ -6,12 +6,17 @@ from __future__ import print_function
 
 #@@CALIBRE_COMPAT_CODE@@
 
-from .utilities import SafeUnbuffered
+try:
+    from .utilities import SafeUnbuffered
+except ImportError:
+    from utilities import SafeUnbuffered
 
 import sys
 import csv
 import os
+import io
 import getopt
+import zipfile
 from struct import pack
 from struct import unpack
 
@@ -26,6 +31,7 @@ import convert2xml
 import flatxml2html
 import flatxml2svg
 import stylexml2css
+from flatdoc import FlatDoc
 
 # global switch
 buildXML = False
@@ -69,10 +75,13 @@ def readString(file):
         return ""
     return unpack(str(stringLength)+"s",sv)[0]
 
-def getMetaArray(metaFile):
+def getMetaArray(metaFile, data=None):
     # parse the meta file
     result = {}
-    fo = open(metaFile,'rb')
+    if data is None:
+        fo = open(metaFile,'rb')
+    else:
+        fo = io.BytesIO(data)
     size = readEncodedNumber(fo)
     for i in range(size):
         tag = readString(fo)
@@ -83,62 +92,12 @@ def getMetaArray(metaFile):
     return result
 
 
-# dictionary of all text strings by index value
-class Dictionary(object):
-    def __init__(self, dictFile):
-        self.filename = dictFile
-        self.size = 0
-        self.fo = open(dictFile,'rb')
-        self.stable = []
-        self.size = readEncodedNumber(self.fo)
-        for i in range(self.size):
-            self.stable.append(self.escapestr(readString(self.fo)))
-        self.pos = 0
-    def escapestr(self, str):
-        str = str.replace(b'&',b'&amp;')
-        str = str.replace(b'<',b'&lt;')
-        str = str.replace(b'>',b'&gt;')
-        str = str.replace(b'=',b'&#61;')
-        return str
-    def lookup(self,val):
-        if ((val >= 0) and (val < self.size)) :
-            self.pos = val
-            return self.stable[self.pos]
-        else:
-            print("Error: %d outside of string table limits" % val)
-            raise TpzDRMError('outside or string table limits')
-            # sys.exit(-1)
-    def getSize(self):
-        return self.size
-    def getPos(self):
-        return self.pos
-
-
 class PageDimParser(object):
     def __init__(self, flatxml):
-        self.flatdoc = flatxml.split(b'\n')
+        self.flatdoc = FlatDoc(flatxml)
     # find tag if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        docList = self.flatdoc
-        cnt = len(docList)
-        if end == -1 :
-            end = cnt
-        else:
-            end = min(cnt,end)
-        foundat = -1
-        for j in range(pos, end):
-            item = docList[j]
-            if item.find(b'=') >= 0:
-                (name, argres) = item.split(b'=')
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.flatdoc.find(tagpath, pos, end)
     def process(self):
         (pos, sph) = self.findinDoc(b'page.h',0,-1)
         (pos, spw) = self.findinDoc(b'page.w',0,-1)
@@ -154,7 +113,7 @@ def getPageDim(flatxml):
 
 class GParser(object):
     def __init__(self, flatxml):
-        self.flatdoc = flatxml.split(b'\n')
+        self.flatdoc = FlatDoc(flatxml)
         self.dpi = 1440
         self.gh = self.getData(b'info.glyph.h')
         self.gw = self.getData(b'info.glyph.w')
@@ -178,23 +137,12 @@ class GParser(object):
         elif self.gvtx :
             self.gvtx.append(0)
     def getData(self, path):
-        result = None
-        cnt = len(self.flatdoc)
-        for j in range(cnt):
-            item = self.flatdoc[j]
-            if item.find(b'=') >= 0:
-                (name, argt) = item.split(b'=')
-                argres = argt.split(b'|')
-            else:
-                name = item
-                argres = []
-            if (name == path):
-                result = argres
-                break
-        if (len(argres) > 0) :
-            for j in range(0,len(argres)):
-                argres[j] = int(argres[j])
-        return result
+        (foundat, argt) = self.flatdoc.findexact(path)
+        if argt is None:
+            return None
+        if len(argt) == 0:
+            return []
+        return [int(strval) for strval in argt.split(b'|')]
     def getGlyphDim(self, gly):
         if self.gdpi[gly] == 0:
             return 0, 0
@@ -239,93 +187,236 @@ class GParser(object):
 
 
 
-# dictionary of all text strings by index value
+# table of all glyphs by glyph id, the path data, width and height of each
+# are kept separately and the svg path element is only built when written
 class GlyphDict(object):
     def __init__(self):
-        self.gdict = {}
-    def lookup(self, id):
-        # id='id="gl%d"' % val
-        if id in self.gdict:
-            return self.gdict[id]
+        self.paths = []
+        self.widths = []
+        self.heights = []
+    def addGlyph(self, val, path, width, height):
+        if val >= len(self.paths):
+            grow = val + 1 - len(self.paths)
+            self.paths.extend([None] * grow)
+            self.widths.extend([0] * grow)
+            self.heights.extend([0] * grow)
+        self.paths[val] = path
+        self.widths[val] = int(width)
+        self.heights[val] = int(height)
+    def hasGlyph(self, val):
+        return (val >= 0) and (val < len(self.paths)) and (self.paths[val] is not None)
+    def getDim(self, val):
+        return self.widths[val], self.heights[val]
+    def lookup(self, val):
+        if not self.hasGlyph(val):
+            return None
+        return '<path id="gl%d" d="%s" fill="black" /><!-- width=%d height=%d -->\n' % (val, self.paths[val], self.widths[val], self.heights[val])
+
+
+# the records of an unencrypted Topaz book, keyed by record name and index,
+# together with every file generated from them.  Records are fetched through
+# loader(name, index) on first use, so the book never has to be extracted to
+# and re-read from a directory tree.
+class BookStore(object):
+    def __init__(self, counts, loader):
+        # counts maps record name (b'page', b'glyphs', ...) to number of records
+        self.counts = counts
+        self.loader = loader
+        self.records = {}
+        self.files = {}
+        # what generateSVG needs, kept by generateBook until the svg is asked for
+        self.svgstate = None
+
+    def record(self, name, index):
+        key = (name, index)
+        if key not in self.records:
+            data = None
+            if index < self.counts.get(name, 0):
+                data = self.loader(name, index)
+            self.records[key] = data or b''
+        return self.records[key]
+
+    def indices(self, name):
+        # indices of the records of this name that hold any data
+        return [i for i in range(self.counts.get(name, 0)) if len(self.record(name, i)) > 0]
+
+    def image(self, index):
+        # a colour image replaces the greyscale image with the same index
+        data = self.record(b'color', index)
+        if len(data) == 0:
+            data = self.record(b'img', index)
+        return data
+
+    def write(self, path, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.files[path] = data
+
+    def read(self, path):
+        if path in self.files:
+            return self.files[path]
+        dirname, filename = path.rpartition('/')[::2]
+        if dirname == 'img' and filename.startswith('img') and filename.endswith('.jpg'):
+            data = self.image(int(filename[3:-4]))
+            if len(data) > 0:
+                return data
         return None
-    def addGlyph(self, val, path):
-        id='id="gl%d"' % val
-        self.gdict[id] = path
 
+    def exists(self, path):
+        return self.read(path) is not None
+
+    def listdir(self, dirname):
+        names = set()
+        if dirname == 'img':
+            for index in range(max(self.counts.get(b'img', 0), self.counts.get(b'color', 0))):
+                if len(self.image(index)) > 0:
+                    names.add('img%04d.jpg' % index)
+        prefix = dirname + '/'
+        for path in self.files:
+            if path.startswith(prefix) and '/' not in path[len(prefix):]:
+                names.add(path[len(prefix):])
+        return sorted(names)
+
+    def paths(self):
+        # every file of the generated book
+        paths = list(self.files.keys())
+        paths.extend('img/' + filename for filename in self.listdir('img') if ('img/' + filename) not in self.files)
+        return paths
+
+    def saveToDirectory(self, outdir, paths=None):
+        if paths is None:
+            paths = self.paths()
+        for path in paths:
+            data = self.read(path)
+            if data is None:
+                continue
+            fname = os.path.join(outdir, *path.split('/'))
+            if not os.path.exists(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            open(fname, 'wb').write(data)
+
+    def saveToZip(self, myzip, paths=None):
+        # jpegs are already compressed so they are stored as they are
+        if paths is None:
+            paths = self.paths()
+        for path in paths:
+            data = self.read(path)
+            if data is None:
+                continue
+            if path.endswith('.jpg'):
+                myzip.writestr(path, data, zipfile.ZIP_STORED)
+            else:
+                myzip.writestr(path, data)
+
+
+# where topazextract used to write each record when extracting a book
+def recordPath(bookDir, name, index):
+    name = name.decode('utf-8')
+    if name == 'img':
+        return os.path.join(bookDir, 'img', 'img%04d.jpg' % index)
+    if name == 'color':
+        return os.path.join(bookDir, 'color_img', 'color%04d.jpg' % index)
+    if name in ('page', 'glyphs'):
+        return os.path.join(bookDir, name, '%s%04d.dat' % (name, index))
+    return os.path.join(bookDir, '%s%04d.dat' % (name, index))
+
+# wrap a directory of previously extracted Topaz records in a BookStore
+def storeFromDirectory(bookDir):
+    counts = {}
+    for name, subdir, ext in ((b'img', 'img', '.jpg'), (b'color', 'color_img', '.jpg'),
+                              (b'page', 'page', '.dat'), (b'glyphs', 'glyphs', '.dat')):
+        dirpath = os.path.join(bookDir, subdir)
+        if os.path.isdir(dirpath):
+            prefix = name.decode('utf-8')
+            for filename in os.listdir(dirpath):
+                if filename.startswith(prefix) and filename.endswith(ext):
+                    try:
+                        index = int(filename[len(prefix):-len(ext)])
+                    except ValueError:
+                        continue
+                    counts[name] = max(counts.get(name, 0), index + 1)
+    for name in (b'dict', b'metadata', b'other'):
+        if os.path.isfile(recordPath(bookDir, name, 0)):
+            counts[name] = 1
+
+    def loader(name, index):
+        fname = recordPath(bookDir, name, index)
+        if not os.path.isfile(fname):
+            return None
+        return open(fname, 'rb').read()
+
+    return BookStore(counts, loader)
 
-def generateBook(bookDir, raw, fixedimage):
-    # sanity check Topaz file extraction
-    if not os.path.exists(bookDir) :
-        print("Can not find directory with unencrypted book")
-        return 1
 
-    dictFile = os.path.join(bookDir,'dict0000.dat')
-    if not os.path.exists(dictFile) :
-        print("Can not find dict0000.dat file")
-        return 1
+# convert one page record to flat xml and html.  Any svg images made from
+# fixed regions are collected in a store of their own and returned with it
+def convertPage(dict, classlst, gd, fixedimage, fname, data):
+    pagestore = BookStore({}, None)
+    flat_xml = convert2xml.fromData(dict, fname, data)
+    pagehtml, tocinfo = flatxml2html.convert2HTML(flat_xml, classlst, fname, pagestore, gd, fixedimage)
+    return flat_xml, pagehtml, tocinfo, pagestore.files
 
-    pageDir = os.path.join(bookDir,'page')
-    if not os.path.exists(pageDir) :
-        print("Can not find page directory in unencrypted book")
-        return 1
+# convert the flat xml of the pages with one svg page id to a single svg page
+def convertSVGPage(gd, raw, meta_array, scaledpi, flst, pageid, previd, nextid):
+    flat_svg = b"".join(flst)
+    return flatxml2svg.convert2SVG(gd, flat_svg, pageid, previd, nextid, 'svg', raw, meta_array, scaledpi)
 
-    imgDir = os.path.join(bookDir,'img')
-    if not os.path.exists(imgDir) :
-        print("Can not find image directory in unencrypted book")
-        return 1
+# read-only state of a page conversion worker process, set up once per worker
+workerState = None
+
+def initPageWorker(convert, state):
+    global workerState
+    workerState = (convert, state)
 
-    glyphsDir = os.path.join(bookDir,'glyphs')
-    if not os.path.exists(glyphsDir) :
-        print("Can not find glyphs directory in unencrypted book")
+def convertPageInWorker(args):
+    convert, state = workerState
+    return convert(*(state + args))
+
+# call convert(*(state + args)) for the args of every page on a pool of worker
+# processes, the state is only sent once to each worker.  Results are in page
+# order.  Returns None if the pages could not be converted in parallel.
+def convertPagesInPool(convert, state, pageargs, workers):
+    if workers <= 1 or len(pageargs) <= 1:
+        return None
+    from concurrent.futures import ProcessPoolExecutor
+    chunksize = max(1, len(pageargs) // (workers * 4))
+    try:
+        with ProcessPoolExecutor(workers, initializer=initPageWorker, initargs=(convert, state)) as pool:
+            return list(pool.map(convertPageInWorker, pageargs, chunksize=chunksize))
+    except Exception as e:
+        print("Could not convert pages in parallel ({0}), converting them one at a time".format(e))
+        return None
+
+
+# workers is the number of processes used to convert the pages, 0 or 1
+# converts them in this process
+def generateBook(store, raw, fixedimage, workers=0):
+    # sanity check Topaz file extraction
+    if store.counts.get(b'dict', 0) == 0 :
+        print("Can not find dict0000.dat file")
         return 1
 
-    metaFile = os.path.join(bookDir,'metadata0000.dat')
-    if not os.path.exists(metaFile) :
+    if store.counts.get(b'metadata', 0) == 0 :
         print("Can not find metadata0000.dat in unencrypted book")
         return 1
 
-    svgDir = os.path.join(bookDir,'svg')
-    if not os.path.exists(svgDir) :
-        os.makedirs(svgDir)
-
-    if buildXML:
-        xmlDir = os.path.join(bookDir,'xml')
-        if not os.path.exists(xmlDir) :
-            os.makedirs(xmlDir)
-
-    otherFile = os.path.join(bookDir,'other0000.dat')
-    if not os.path.exists(otherFile) :
+    if store.counts.get(b'other', 0) == 0 :
         print("Can not find other0000.dat in unencrypted book")
         return 1
 
-    print("Updating to color images if available")
-    spath = os.path.join(bookDir,'color_img')
-    dpath = os.path.join(bookDir,'img')
-    filenames = os.listdir(spath)
-    filenames = sorted(filenames)
-    for filename in filenames:
-        imgname = filename.replace('color','img')
-        sfile = os.path.join(spath,filename)
-        dfile = os.path.join(dpath,imgname)
-        imgdata = open(sfile,'rb').read()
-        open(dfile,'wb').write(imgdata)
-
     print("Creating cover.jpg")
     isCover = False
-    cpath = os.path.join(bookDir,'img')
-    cpath = os.path.join(cpath,'img0000.jpg')
-    if os.path.isfile(cpath):
-        cover = open(cpath, 'rb').read()
-        cpath = os.path.join(bookDir,'cover.jpg')
-        open(cpath, 'wb').write(cover)
+    cover = store.image(0)
+    if len(cover) > 0:
+        store.write('cover.jpg', cover)
         isCover = True
 
 
     print('Processing Dictionary')
-    dict = Dictionary(dictFile)
+    dict = convert2xml.Dictionary('dict0000.dat', store.record(b'dict', 0))
 
     print('Processing Meta Data and creating OPF')
-    meta_array = getMetaArray(metaFile)
+    meta_array = getMetaArray('metadata0000.dat', store.record(b'metadata', 0))
 
     # replace special chars in title and authors like & < >
     title = meta_array.get('Title','No Title Provided')
@@ -340,13 +431,12 @@ def generateBook(bookDir, raw, fixedimage):
     meta_array['Authors'] = authors
 
     if buildXML:
-        xname = os.path.join(xmlDir, 'metadata.xml')
         mlst = []
         for key in meta_array:
             mlst.append('<meta name="' + key + '" content="' + meta_array[key] + '" />\n')
         metastr = "".join(mlst)
         mlst = None
-        open(xname, 'wb').write(metastr)
+        store.write('xml/metadata.xml', metastr)
 
     print('Processing StyleSheet')
 
@@ -359,8 +449,8 @@ def generateBook(bookDir, raw, fixedimage):
 
     # also get the size of a normal text page
     # get the total number of pages unpacked as a safety check
-    filenames = os.listdir(pageDir)
-    numfiles = len(filenames)
+    pagenums = store.indices(b'page')
+    numfiles = len(pagenums)
 
     spage = '1'
     if 'firstTextPage' in meta_array:
@@ -374,8 +464,7 @@ def generateBook(bookDir, raw, fixedimage):
 
     # get page height and width from first text page for use in stylesheet scaling
     pname = 'page%04d.dat' % (pnum - 1)
-    fname = os.path.join(pageDir,pname)
-    flat_xml = convert2xml.fromData(dict, fname)
+    flat_xml = convert2xml.fromData(dict, pname, store.record(b'page', pnum - 1))
 
     (ph, pw) = getPageDim(flat_xml)
     if (ph == '-1') or (ph == '0') : ph = '11000'
@@ -388,15 +477,13 @@ def generateBook(bookDir, raw, fixedimage):
     # process other.dat for css info and for map of page files to svg images
     # this map is needed because some pages actually are made up of multiple
     # pageXXXX.xml files
-    xname = os.path.join(bookDir, 'style.css')
-    flat_xml = convert2xml.fromData(dict, otherFile)
+    otherdata = store.record(b'other', 0)
+    flat_xml = convert2xml.fromData(dict, 'other0000.dat', otherdata)
 
     # extract info.original.pid to get original page information
     pageIDMap = {}
     pageidnums = stylexml2css.getpageIDMap(flat_xml)
     if len(pageidnums) == 0:
-        filenames = os.listdir(pageDir)
-        numfiles = len(filenames)
         for k in range(numfiles):
             pageidnums.append(k)
     # create a map from page ids to list of page file nums to process for that page
@@ -409,44 +496,29 @@ def generateBook(bookDir, raw, fixedimage):
 
     # now get the css info
     cssstr , classlst = stylexml2css.convert2CSS(flat_xml, fontsize, ph, pw)
-    open(xname, 'w').write(cssstr)
+    store.write('style.css', cssstr)
     if buildXML:
-        xname = os.path.join(xmlDir, 'other0000.xml')
-        open(xname, 'wb').write(convert2xml.getXML(dict, otherFile))
+        store.write('xml/other0000.xml', convert2xml.getXML(dict, 'other0000.dat', otherdata))
 
     print('Processing Glyphs')
     gd = GlyphDict()
-    filenames = os.listdir(glyphsDir)
-    filenames = sorted(filenames)
-    glyfname = os.path.join(svgDir,'glyphs.svg')
-    glyfile = open(glyfname, 'w')
-    glyfile.write('<?xml version="1.0" standalone="no"?>\n')
-    glyfile.write('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
-    glyfile.write('<svg width="512" height="512" viewBox="0 0 511 511" xmlns="http://www.w3.org/2000/svg" version="1.1">\n')
-    glyfile.write('<title>Glyphs for %s</title>\n' % meta_array['Title'])
-    glyfile.write('<defs>\n')
     counter = 0
-    for filename in filenames:
+    for index in store.indices(b'glyphs'):
         # print '     ', filename
         print('.', end=' ')
-        fname = os.path.join(glyphsDir,filename)
-        flat_xml = convert2xml.fromData(dict, fname)
+        filename = 'glyphs%04d.dat' % index
+        data = store.record(b'glyphs', index)
+        flat_xml = convert2xml.fromData(dict, filename, data)
 
         if buildXML:
-            xname = os.path.join(xmlDir, filename.replace('.dat','.xml'))
-            open(xname, 'wb').write(convert2xml.getXML(dict, fname))
+            store.write('xml/' + filename.replace('.dat','.xml'), convert2xml.getXML(dict, filename, data))
 
         gp = GParser(flat_xml)
         for i in range(0, gp.count):
             path = gp.getPath(i)
             maxh, maxw = gp.getGlyphDim(i)
-            fullpath = '<path id="gl%d" d="%s" fill="black" /><!-- width=%d height=%d -->\n' % (counter * 256 + i, path, maxw, maxh)
-            glyfile.write(fullpath)
-            gd.addGlyph(counter * 256 + i, fullpath)
+            gd.addGlyph(counter * 256 + i, path, maxw, maxh)
         counter += 1
-    glyfile.write('</defs>\n')
-    glyfile.write('</svg>\n')
-    glyfile.close()
     print(" ")
 
 
@@ -470,32 +542,27 @@ def generateBook(bookDir, raw, fixedimage):
     hlst.append('</head>\n<body>\n')
 
     print('Processing Pages')
-    # Books are at 1440 DPI.  This is rendering at twice that size for
-    # readability when rendering to the screen.
-    scaledpi = 1440.0
-
-    filenames = os.listdir(pageDir)
-    filenames = sorted(filenames)
-    numfiles = len(filenames)
-
     xmllst = []
     elst = []
 
-    for filename in filenames:
+    pagefiles = [('page%04d.dat' % index, store.record(b'page', index)) for index in pagenums]
+    results = convertPagesInPool(convertPage, (dict, classlst, gd, fixedimage), pagefiles, workers)
+    if results is None:
+        results = (convertPage(dict, classlst, gd, fixedimage, fname, data) for fname, data in pagefiles)
+
+    for (fname, data), (flat_xml, pagehtml, tocinfo, imgfiles) in zip(pagefiles, results):
         # print '     ', filename
         print(".", end=' ')
-        fname = os.path.join(pageDir,filename)
-        flat_xml = convert2xml.fromData(dict, fname)
 
         # keep flat_xml for later svg processing
         xmllst.append(flat_xml)
 
         if buildXML:
-            xname = os.path.join(xmlDir, filename.replace('.dat','.xml'))
-            open(xname, 'wb').write(convert2xml.getXML(dict, fname))
+            store.write('xml/' + fname.replace('.dat','.xml'), convert2xml.getXML(dict, fname, data))
 
         # first get the html
-        pagehtml, tocinfo = flatxml2html.convert2HTML(flat_xml, classlst, fname, bookDir, gd, fixedimage)
+        for path in imgfiles:
+            store.write(path, imgfiles[path])
         elst.append(tocinfo)
         hlst.append(pagehtml)
 
@@ -503,9 +570,87 @@ def generateBook(bookDir, raw, fixedimage):
     hlst.append('</body>\n</html>\n')
     htmlstr = "".join(hlst)
     hlst = None
-    open(os.path.join(bookDir, htmlFileName), 'w').write(htmlstr)
+    store.write(htmlFileName, htmlstr)
 
     print(" ")
+
+    # the svg version of the book is only built if generateSVG is called
+    store.svgstate = (gd, meta_array, xmllst, pageIDMap, pageidnums, "".join(elst), raw, workers)
+    elst = None
+
+    # build the opf file
+    olst = []
+    olst.append('<?xml version="1.0" encoding="utf-8"?>\n')
+    olst.append('<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="guid_id">\n')
+    # adding metadata
+    olst.append('   <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n')
+    if b'GUID' in meta_array:
+        olst.append('      <dc:identifier opf:scheme="GUID" id="guid_id">' + meta_array[b'GUID'].decode('utf-8') + '</dc:identifier>\n')
+    if b'ASIN' in meta_array:
+        olst.append('      <dc:identifier opf:scheme="ASIN">' + meta_array[b'ASIN'].decode('utf-8') + '</dc:identifier>\n')
+    if b'oASIN' in meta_array:
+        olst.append('      <dc:identifier opf:scheme="oASIN">' + meta_array[b'oASIN'].decode('utf-8') + '</dc:identifier>\n')
+    olst.append('      <dc:title>' + meta_array[b'Title'].decode('utf-8') + '</dc:title>\n')
+    olst.append('      <dc:creator opf:role="aut">' + meta_array[b'Authors'].decode('utf-8') + '</dc:creator>\n')
+    olst.append('      <dc:language>en</dc:language>\n')
+    olst.append('      <dc:date>' + meta_array[b'UpdateTime'].decode('utf-8') + '</dc:date>\n')
+    if isCover:
+        olst.append('      <meta name="cover" content="bookcover"/>\n')
+    olst.append('   </metadata>\n')
+    olst.append('<manifest>\n')
+    olst.append('   <item id="book" href="book.html" media-type="application/xhtml+xml"/>\n')
+    olst.append('   <item id="stylesheet" href="style.css" media-type="text/css"/>\n')
+    # adding image files to manifest
+    for filename in store.listdir('img'):
+        imgname, imgext = os.path.splitext(filename)
+        if imgext == '.jpg':
+            imgext = 'jpeg'
+        if imgext == '.svg':
+            imgext = 'svg+xml'
+        olst.append('   <item id="' + imgname + '" href="img/' + filename + '" media-type="image/' + imgext + '"/>\n')
+    if isCover:
+        olst.append('   <item id="bookcover" href="cover.jpg" media-type="image/jpeg" />\n')
+    olst.append('</manifest>\n')
+    # adding spine
+    olst.append('<spine>\n   <itemref idref="book" />\n</spine>\n')
+    if isCover:
+        olst.append('   <guide>\n')
+        olst.append('      <reference href="cover.jpg" type="cover" title="Cover"/>\n')
+        olst.append('   </guide>\n')
+    olst.append('</package>\n')
+    opfstr = "".join(olst)
+    olst = None
+    store.write('book.opf', opfstr)
+
+    print('Processing Complete')
+
+    return 0
+
+# build the svg version of the book (svg/ pages, glyphs and toc, and
+# index_svg.xhtml) from what generateBook left in the store
+def generateSVG(store):
+    if store.svgstate is None:
+        return 0
+    (gd, meta_array, xmllst, pageIDMap, pageidnums, tocentries, raw, workers) = store.svgstate
+    # Books are at 1440 DPI.  This is rendering at twice that size for
+    # readability when rendering to the screen.
+    scaledpi = 1440.0
+
+    print('Building svg glyphs')
+    glst = []
+    glst.append('<?xml version="1.0" standalone="no"?>\n')
+    glst.append('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
+    glst.append('<svg width="512" height="512" viewBox="0 0 511 511" xmlns="http://www.w3.org/2000/svg" version="1.1">\n')
+    glst.append('<title>Glyphs for %s</title>\n' % meta_array['Title'])
+    glst.append('<defs>\n')
+    for gid in range(len(gd.paths)):
+        if gd.hasGlyph(gid):
+            glst.append(gd.lookup(gid))
+    glst.append('</defs>\n')
+    glst.append('</svg>\n')
+    store.write('svg/glyphs.svg', "".join(glst))
+    glst = None
+
     print('Extracting Table of Contents from Amazon OCR')
 
     # first create a table of contents file for the svg images
@@ -533,8 +678,6 @@ def generateBook(bookDir, raw, fixedimage):
 
     tlst.append('<h3><a href="' + startname + '">Start of Book</a></h3>\n')
     # build up a table of contents for the svg xhtml output
-    tocentries = "".join(elst)
-    elst = None
     toclst = tocentries.split('\n')
     toclst.pop()
     for entry in toclst:
@@ -549,7 +692,7 @@ def generateBook(bookDir, raw, fixedimage):
     tlst.append('</body>\n')
     tlst.append('</html>\n')
     tochtml = "".join(tlst)
-    open(os.path.join(svgDir, 'toc.xhtml'), 'w').write(tochtml)
+    store.write('svg/toc.xhtml', tochtml)
 
 
     # now create index_svg.xhtml that points to all required files
@@ -572,8 +715,8 @@ def generateBook(bookDir, raw, fixedimage):
     slst.append('<h2>List of Pages</h2>\n')
     slst.append('<div>\n')
     idlst = sorted(pageIDMap.keys())
-    numids = len(idlst)
     cnt = len(idlst)
+    pageargs = []
     previd = None
     for j in range(cnt):
         pageid = idlst[j]
@@ -581,93 +724,44 @@ def generateBook(bookDir, raw, fixedimage):
             nextid = idlst[j+1]
         else:
             nextid = None
+        flst = tuple(xmllst[page] for page in pageIDMap[pageid])
+        pageargs.append((flst, pageid, previd, nextid))
+        previd = pageid
+
+    state = (gd, raw, meta_array, scaledpi)
+    results = convertPagesInPool(convertSVGPage, state, pageargs, workers)
+    if results is None:
+        results = (convertSVGPage(*(state + args)) for args in pageargs)
+
+    for (flst, pageid, previd, nextid), svgxml in zip(pageargs, results):
         print('.', end=' ')
-        pagelst = pageIDMap[pageid]
-        flst = []
-        for page in pagelst:
-            flst.append(xmllst[page])
-        flat_svg = b"".join(flst)
-        flst=None
-        svgxml = flatxml2svg.convert2SVG(gd, flat_svg, pageid, previd, nextid, svgDir, raw, meta_array, scaledpi)
         if (raw) :
-            pfile = open(os.path.join(svgDir,'page%04d.svg' % pageid),'w')
+            store.write('svg/page%04d.svg' % pageid, svgxml)
             slst.append('<a href="svg/page%04d.svg">Page %d</a>\n' % (pageid, pageid))
         else :
-            pfile = open(os.path.join(svgDir,'page%04d.xhtml' % pageid), 'w')
+            store.write('svg/page%04d.xhtml' % pageid, svgxml)
             slst.append('<a href="svg/page%04d.xhtml">Page %d</a>\n' % (pageid, pageid))
-        previd = pageid
-        pfile.write(svgxml)
-        pfile.close()
-        counter += 1
     slst.append('</div>\n')
     slst.append('<h2><a href="svg/toc.xhtml">Table of Contents</a></h2>\n')
     slst.append('</body>\n</html>\n')
     svgindex = "".join(slst)
     slst = None
-    open(os.path.join(bookDir, 'index_svg.xhtml'), 'w').write(svgindex)
+    store.write('index_svg.xhtml', svgindex)
 
     print(" ")
-
-    # build the opf file
-    opfname = os.path.join(bookDir, 'book.opf')
-    olst = []
-    olst.append('<?xml version="1.0" encoding="utf-8"?>\n')
-    olst.append('<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="guid_id">\n')
-    # adding metadata
-    olst.append('   <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n')
-    if b'GUID' in meta_array:
-        olst.append('      <dc:identifier opf:scheme="GUID" id="guid_id">' + meta_array[b'GUID'].decode('utf-8') + '</dc:identifier>\n')
-    if b'ASIN' in meta_array:
-        olst.append('      <dc:identifier opf:scheme="ASIN">' + meta_array[b'ASIN'].decode('utf-8') + '</dc:identifier>\n')
-    if b'oASIN' in meta_array:
-        olst.append('      <dc:identifier opf:scheme="oASIN">' + meta_array[b'oASIN'].decode('utf-8') + '</dc:identifier>\n')
-    olst.append('      <dc:title>' + meta_array[b'Title'].decode('utf-8') + '</dc:title>\n')
-    olst.append('      <dc:creator opf:role="aut">' + meta_array[b'Authors'].decode('utf-8') + '</dc:creator>\n')
-    olst.append('      <dc:language>en</dc:language>\n')
-    olst.append('      <dc:date>' + meta_array[b'UpdateTime'].decode('utf-8') + '</dc:date>\n')
-    if isCover:
-        olst.append('      <meta name="cover" content="bookcover"/>\n')
-    olst.append('   </metadata>\n')
-    olst.append('<manifest>\n')
-    olst.append('   <item id="book" href="book.html" media-type="application/xhtml+xml"/>\n')
-    olst.append('   <item id="stylesheet" href="style.css" media-type="text/css"/>\n')
-    # adding image files to manifest
-    filenames = os.listdir(imgDir)
-    filenames = sorted(filenames)
-    for filename in filenames:
-        imgname, imgext = os.path.splitext(filename)
-        if imgext == '.jpg':
-            imgext = 'jpeg'
-        if imgext == '.svg':
-            imgext = 'svg+xml'
-        olst.append('   <item id="' + imgname + '" href="img/' + filename + '" media-type="image/' + imgext + '"/>\n')
-    if isCover:
-        olst.append('   <item id="bookcover" href="cover.jpg" media-type="image/jpeg" />\n')
-    olst.append('</manifest>\n')
-    # adding spine
-    olst.append('<spine>\n   <itemref idref="book" />\n</spine>\n')
-    if isCover:
-        olst.append('   <guide>\n')
-        olst.append('      <reference href="cover.jpg" type="cover" title="Cover"/>\n')
-        olst.append('   </guide>\n')
-    olst.append('</package>\n')
-    opfstr = "".join(olst)
-    olst = None
-    open(opfname, 'w').write(opfstr)
-
-    print('Processing Complete')
-
+    store.svgstate = None
     return 0
 
 def usage():
     print("genbook.py generates a book from the extract Topaz Files")
     print("Usage:")
-    print("    genbook.py [-r] [-h [--fixed-image] <bookDir>  ")
+    print("    genbook.py [-r] [-h [--fixed-image] [-j <workers>] <bookDir>  ")
     print("  ")
     print("Options:")
     print("  -h            :  help - print this usage message")
     print("  -r            :  generate raw svg files (not wrapped in xhtml)")
     print("  --fixed-image :  genearate any Fixed Area as an svg image in the html")
+    print("  -j <workers>  :  convert pages on this many worker processes")
     print("  ")
 
 
@@ -679,7 +773,7 @@ def main(argv):
         argv = sys.argv
 
     try:
-        opts, args = getopt.getopt(argv[1:], "rh:",["fixed-image"])
+        opts, args = getopt.getopt(argv[1:], "rh:j:",["fixed-image"])
 
     except getopt.GetoptError as err:
         print(str(err))
@@ -692,6 +786,7 @@ def main(argv):
 
     raw = 0
     fixedimage = True
+    workers = 0
     for o, a in opts:
         if o =="-h":
             usage()
@@ -700,10 +795,17 @@ def main(argv):
             raw = 1
         if o =="--fixed-image":
             fixedimage = True
+        if o =="-j":
+            workers = int(a)
 
     bookDir = args[0]
 
-    rv = generateBook(bookDir, raw, fixedimage)
+    store = storeFromDirectory(bookDir)
+    rv = generateBook(store, raw, fixedimage, workers)
+    if rv == 0:
+        rv = generateSVG(store)
+    if rv == 0:
+        store.saveToDirectory(bookDir)
     return rv
 
 
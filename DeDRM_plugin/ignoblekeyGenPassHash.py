@@ -52,9 +52,15 @@ try:
 except ImportError:
     from Crypto.Cipher import AES
 
-from .utilities import SafeUnbuffered
+try:
+    from .utilities import SafeUnbuffered
+except ImportError:
+    from utilities import SafeUnbuffered
 
-from .argv_utils import unicode_argv
+try:
+    from .argv_utils import unicode_argv
+except ImportError:
+    from argv_utils import unicode_argv
 
 class IGNOBLEError(Exception):
     pass
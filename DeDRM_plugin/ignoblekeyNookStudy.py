@@ -29,14 +29,20 @@ import re
 
 #@@CALIBRE_COMPAT_CODE@@
 
-from .utilities import SafeUnbuffered
+try:
+    from .utilities import SafeUnbuffered
+except ImportError:
+    from utilities import SafeUnbuffered
 
 try:
     from calibre.constants import iswindows
 except:
     iswindows = sys.platform.startswith('win')
 
-from .argv_utils import unicode_argv
+try:
+    from .argv_utils import unicode_argv
+except ImportError:
+    from argv_utils import unicode_argv
 
 class DrmException(Exception):
     pass
@@ -47,7 +47,10 @@ import traceback
 import base64
 import zlib
 from zipfile import ZipInfo, ZipFile, ZIP_STORED, ZIP_DEFLATED
-from .zeroedzipinfo import ZeroedZipInfo
+try:
+    from .zeroedzipinfo import ZeroedZipInfo
+except ImportError:
+    from zeroedzipinfo import ZeroedZipInfo
 from contextlib import closing
 from lxml import etree
 from uuid import UUID
@@ -71,8 +74,12 @@ def unpad(data, padding=16):
 
 #@@CALIBRE_COMPAT_CODE@@
 
-from .utilities import SafeUnbuffered
-from .argv_utils import unicode_argv
+try:
+    from .utilities import SafeUnbuffered
+    from .argv_utils import unicode_argv
+except ImportError:
+    from utilities import SafeUnbuffered
+    from argv_utils import unicode_argv
 
 
 class ADEPTError(Exception):
@@ -205,6 +212,24 @@ def adeptGetUserUUID(inpath):
         except:
             return None
 
+# Returns the resource ID from the license file. Unlike the user UUID this is
+# also present in PassHash (B&N) books, so it can identify the book when
+# looking up which key opened it last time.
+def adeptGetResourceID(inpath):
+    with closing(ZipFile(open(inpath, 'rb'))) as inf:
+        try:
+            rights = etree.fromstring(inf.read('META-INF/rights.xml'))
+            adept = lambda tag: '{%s}%s' % (NSMAP['adept'], tag)
+            expr = './/%s' % (adept('resource'),)
+            resource = ''.join(rights.findtext(expr))
+            if resource[:9] == "urn:uuid:":
+                resource = resource[9:]
+            if resource == "":
+                return None
+            return resource
+        except:
+            return None
+
 def removeHardening(rights, keytype, keydata):
     adept = lambda tag: '{%s}%s' % (NSMAP['adept'], tag)
     textGetter = lambda name: ''.join(rights.findtext('.//%s' % (adept(name),)))
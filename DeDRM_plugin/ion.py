@@ -23,6 +23,7 @@ import os
 import os.path
 import struct
 
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 __license__ = 'GPL v3'
@@ -58,7 +59,19 @@ except ImportError:
                 # Windows-friendly choice: pylzma wheels
                 import pylzma as lzma
 
-from .kfxtables import *
+# kfxtables.py holds several thousand lines of lookup tables that are only
+# used by the voucher key obfuscation below. Importing it costs more than
+# the rest of the plugin, so the process_V* functions load it on first use.
+kfxtables = None
+
+def loadkfxtables():
+    global kfxtables
+    if kfxtables is not None:
+        return
+    try:
+        from . import kfxtables
+    except ImportError:
+        import kfxtables
 
 TID_NULL = 0
 TID_BOOLEAN = 1
@@ -198,7 +211,7 @@ class BinaryIonParser(object):
         self.catalog = []
 
         self.stream = stream
-        self.initpos = stream.tell()
+        self.initpos = self.tell()
         self.reset()
         self.symbols = SymbolTable()
 
@@ -209,7 +222,7 @@ class BinaryIonParser(object):
         self.eof = False
         self.isinstruct = False
         self.containerstack = []
-        self.stream.seek(self.initpos)
+        self.seek(self.initpos)
 
     def addtocatalog(self, name, version, symbols):
         self.catalog.append(IonCatalogItem(name, version, symbols))
@@ -290,7 +303,7 @@ class BinaryIonParser(object):
             nextrem -= self.valuelen
             if nextrem < 0:
                 nextrem = 0
-        self.push(self.parenttid, self.stream.tell() + self.valuelen, nextrem)
+        self.push(self.parenttid, self.tell() + self.valuelen, nextrem)
 
         self.isinstruct = (self.valuetid == TID_STRUCT)
         if self.isinstruct:
@@ -317,7 +330,7 @@ class BinaryIonParser(object):
         self.needhasnext = True
 
         self.clearvalue()
-        curpos = self.stream.tell()
+        curpos = self.tell()
         if rec.nextpos > curpos:
             self.skip(rec.nextpos - curpos)
         else:
@@ -325,6 +338,12 @@ class BinaryIonParser(object):
 
         self.localremaining = rec.remaining
 
+    def tell(self):
+        return self.stream.tell()
+
+    def seek(self, pos):
+        self.stream.seek(pos)
+
     def read(self, count=1):
         if self.localremaining != -1:
             self.localremaining -= count
@@ -353,7 +372,9 @@ class BinaryIonParser(object):
         b = self.stream.read(1)
         if len(b) < 1:
             return -1
-        b = ord(b)
+        return self.decodetypeid(ord(b))
+
+    def decodetypeid(self, b):
         result = b >> 4
         ln = b & 0xF
 
@@ -611,8 +632,8 @@ class BinaryIonParser(object):
 
     def loadannotations(self):
         ln = self.readvaruint()
-        maxpos = self.stream.tell() + ln
-        while self.stream.tell() < maxpos:
+        maxpos = self.tell() + ln
+        while self.tell() < maxpos:
             self.annotations.append(self.readvaruint())
         self.valuetid = self.readtypeid()
 
@@ -656,8 +677,8 @@ class BinaryIonParser(object):
             return "null"
 
         result = ""
-        for i in b:
-            result += ("%02x " % ord(i))
+        for i in bytearray(b):
+            result += ("%02x " % i)
 
         if len(result) > 0:
             result = result[:-1]
@@ -714,6 +735,120 @@ class BinaryIonParser(object):
         self.ionwalk(-1, "", lst)
 
 
+class BinaryIonBufferParser(BinaryIonParser):
+    """BinaryIonParser over an in-memory buffer.
+
+    Walks a memoryview with an integer cursor instead of calling read() on a
+    stream for every byte, and returns LOB values as zero-copy memoryview
+    slices of the buffer.
+    """
+
+    def __init__(self, buf):
+        self.buf = memoryview(buf).cast("B")
+        self.pos = 0
+        BinaryIonParser.__init__(self, None)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def read(self, count=1):
+        return bytes(self.readview(count))
+
+    def readview(self, count):
+        if self.localremaining != -1:
+            self.localremaining -= count
+            _assert(self.localremaining >= 0)
+
+        result = self.buf[self.pos:self.pos + count]
+        if len(result) == 0:
+            raise EOFError()
+        self.pos += len(result)
+        return result
+
+    def readtypeid(self):
+        if self.localremaining != -1:
+            if self.localremaining < 1:
+                return -1
+            self.localremaining -= 1
+
+        if self.pos >= len(self.buf):
+            return -1
+        b = self.buf[self.pos]
+        self.pos += 1
+        return self.decodetypeid(b)
+
+    def readvarint(self):
+        buf = self.buf
+        start = pos = self.pos
+        try:
+            b = buf[pos]
+            pos += 1
+            negative = ((b & 0x40) != 0)
+            result = (b & 0x3F)
+            while (b & 0x80) == 0 and pos - start < 5:
+                b = buf[pos]
+                pos += 1
+                result = (result << 7) | (b & 0x7F)
+        except IndexError:
+            raise EOFError()
+
+        if (b & 0x80) == 0:
+            _assert(False, "int overflow")
+        self.consumed(start, pos)
+
+        if negative:
+            return -result
+        return result
+
+    def readvaruint(self):
+        buf = self.buf
+        start = pos = self.pos
+        try:
+            b = buf[pos]
+            pos += 1
+            result = (b & 0x7F)
+            while (b & 0x80) == 0 and pos - start < 5:
+                b = buf[pos]
+                pos += 1
+                result = (result << 7) | (b & 0x7F)
+        except IndexError:
+            raise EOFError()
+
+        if (b & 0x80) == 0:
+            _assert(False, "int overflow")
+        self.consumed(start, pos)
+        return result
+
+    def consumed(self, start, pos):
+        # Moves the cursor past bytes that were decoded straight from the buffer
+        if self.localremaining != -1:
+            self.localremaining -= pos - start
+            if self.localremaining < 0:
+                _assert(False)
+        self.pos = pos
+
+    def skip(self, count):
+        if self.localremaining != -1:
+            self.localremaining -= count
+            if self.localremaining < 0:
+                raise EOFError()
+
+        self.pos += count
+
+    def lobvalue(self):
+        _assert(self.valuetid in [TID_CLOB, TID_BLOB], "Not a LOB type: %s" % self.getfieldname())
+
+        if self.valueisnull:
+            return None
+
+        result = self.readview(self.valuelen)
+        self.state = ParserState.AfterValue
+        return result
+
+
 SYM_NAMES = [ 'com.amazon.drm.Envelope@1.0',
               'com.amazon.drm.EnvelopeMetadata@1.0', 'size', 'page_size',
               'encryption_key', 'encryption_transformation',
@@ -921,6 +1056,7 @@ class workspace(object):
     return out
 
 def process_V9708(st):
+  loadkfxtables()
   #e9c457a7dae6aa24365e7ef219b934b17ed58ee7d5329343fc3aea7860ed51f9a73de14351c9
   ws=workspace([0x11]*16)
   repl=[0,5,10,15,4,9,14,3,8,13,2,7,12,1,6,11]
@@ -929,10 +1065,10 @@ def process_V9708(st):
   out=[]
   while(remln>0):
     ws.shuffle(repl)
-    ws.sbox(d0x6a06ea70,d0x6a0dab50)
-    ws.sbox(d0x6a073a70,d0x6a0dab50)
+    ws.sbox(kfxtables.d0x6a06ea70,kfxtables.d0x6a0dab50)
+    ws.sbox(kfxtables.d0x6a073a70,kfxtables.d0x6a0dab50)
     ws.shuffle(repl)
-    ws.exlookup(d0x6a072a70)
+    ws.exlookup(kfxtables.d0x6a072a70)
     dat=ws.mask(st[sto:sto+16])
     out+=dat
     sto+=16
@@ -940,6 +1076,7 @@ def process_V9708(st):
   return bytes(out)
 
 def process_V1031(st):
+  loadkfxtables()
   #d53efea7fdd0fda3e1e0ebbae87cad0e8f5ef413c471c3ae81f39222a9ec8b8ed582e045918c
   ws=workspace([0x06,0x18,0x60,0x68,0x3b,0x62,0x3e,0x3c,0x06,0x50,0x71,0x52,0x02,0x5a,0x63,0x03])
   repl=[0,5,10,15,4,9,14,3,8,13,2,7,12,1,6,11]
@@ -948,12 +1085,12 @@ def process_V1031(st):
   out=[]
   while(remln>0):
     ws.shuffle(repl)
-    ws.sbox(d0x6a0797c0,d0x6a0dab50,[3])
-    ws.sbox(d0x6a07e7c0,d0x6a0dab50,[3])
+    ws.sbox(kfxtables.d0x6a0797c0,kfxtables.d0x6a0dab50,[3])
+    ws.sbox(kfxtables.d0x6a07e7c0,kfxtables.d0x6a0dab50,[3])
     ws.shuffle(repl)
-    ws.sbox(d0x6a0797c0,d0x6a0dab50,[3])
-    ws.sbox(d0x6a07e7c0,d0x6a0dab50,[3])
-    ws.exlookup(d0x6a07d7c0)
+    ws.sbox(kfxtables.d0x6a0797c0,kfxtables.d0x6a0dab50,[3])
+    ws.sbox(kfxtables.d0x6a07e7c0,kfxtables.d0x6a0dab50,[3])
+    ws.exlookup(kfxtables.d0x6a07d7c0)
     dat=ws.mask(st[sto:sto+16])
     out+=dat
     sto+=16
@@ -962,6 +1099,7 @@ def process_V1031(st):
   return bytes(out)
 
 def process_V2069(st):
+  loadkfxtables()
   #8e6196d754a304c9354e91b5d79f07b048026d31c7373a8691e513f2c802c706742731caa858
   ws=workspace([0x79,0x0d,0x12,0x08,0x66,0x77,0x2e,0x5b,0x02,0x09,0x0a,0x13,0x11,0x0c,0x11,0x62])
   repl=[0,5,10,15,4,9,14,3,8,13,2,7,12,1,6,11]
@@ -969,13 +1107,13 @@ def process_V2069(st):
   sto=0
   out=[]
   while(remln>0):
-    ws.sbox(d0x6a084498,d0x6a0dab50,[2])
+    ws.sbox(kfxtables.d0x6a084498,kfxtables.d0x6a0dab50,[2])
     ws.shuffle(repl)
-    ws.sbox(d0x6a089498,d0x6a0dab50,[2])
-    ws.sbox(d0x6a089498,d0x6a0dab50,[2])
-    ws.sbox(d0x6a084498,d0x6a0dab50,[2])
+    ws.sbox(kfxtables.d0x6a089498,kfxtables.d0x6a0dab50,[2])
+    ws.sbox(kfxtables.d0x6a089498,kfxtables.d0x6a0dab50,[2])
+    ws.sbox(kfxtables.d0x6a084498,kfxtables.d0x6a0dab50,[2])
     ws.shuffle(repl)
-    ws.exlookup(d0x6a088498)
+    ws.exlookup(kfxtables.d0x6a088498)
     dat=ws.mask(st[sto:sto+16])
     out+=dat
     sto+=16
@@ -984,6 +1122,7 @@ def process_V2069(st):
 
 
 def process_V9041(st):
+  loadkfxtables()
   #11f7db074b24e560dfa6fae3252b383c3b936e51f6ded570dc936cb1da9f4fc4a97ec686e7d8
   ws=workspace([0x49,0x0b,0x0e,0x3b,0x19,0x1a,0x49,0x61,0x10,0x73,0x19,0x67,0x5c,0x1b,0x11,0x21])
   repl=[0,5,10,15,4,9,14,3,8,13,2,7,12,1,6,11]
@@ -991,14 +1130,14 @@ def process_V9041(st):
   sto=0
   out=[]
   while(remln>0):
-    ws.sbox(d0x6a094170,d0x6a0dab50,[1])
+    ws.sbox(kfxtables.d0x6a094170,kfxtables.d0x6a0dab50,[1])
     ws.shuffle(repl)
     ws.shuffle(repl)
-    ws.sbox(d0x6a08f170,d0x6a0dab50,[1])
-    ws.sbox(d0x6a08f170,d0x6a0dab50,[1])
-    ws.sbox(d0x6a094170,d0x6a0dab50,[1])
+    ws.sbox(kfxtables.d0x6a08f170,kfxtables.d0x6a0dab50,[1])
+    ws.sbox(kfxtables.d0x6a08f170,kfxtables.d0x6a0dab50,[1])
+    ws.sbox(kfxtables.d0x6a094170,kfxtables.d0x6a0dab50,[1])
 
-    ws.exlookup(d0x6a093170)
+    ws.exlookup(kfxtables.d0x6a093170)
     dat=ws.mask(st[sto:sto+16])
     out+=dat
     sto+=16
@@ -1007,6 +1146,7 @@ def process_V9041(st):
   return bytes(out)
 
 def process_V3646(st):
+  loadkfxtables()
   #d468aa362b44479282291983243b38197c4b4aa24c2c58e62c76ec4b81e08556ca0c54301664
   ws=workspace([0x0a,0x36,0x3e,0x29,0x4e,0x02,0x18,0x38,0x01,0x36,0x73,0x13,0x14,0x1b,0x16,0x6a])
   repl=[0,5,10,15,4,9,14,3,8,13,2,7,12,1,6,11]
@@ -1015,15 +1155,15 @@ def process_V3646(st):
   out=[]
   while(remln>0):
     ws.shuffle(repl)
-    ws.sbox(d0x6a099e48,d0x6a0dab50,[2,3])
-    ws.sbox(d0x6a09ee48,d0x6a0dab50,[2,3])
-    ws.sbox(d0x6a09ee48,d0x6a0dab50,[2,3])
+    ws.sbox(kfxtables.d0x6a099e48,kfxtables.d0x6a0dab50,[2,3])
+    ws.sbox(kfxtables.d0x6a09ee48,kfxtables.d0x6a0dab50,[2,3])
+    ws.sbox(kfxtables.d0x6a09ee48,kfxtables.d0x6a0dab50,[2,3])
     ws.shuffle(repl)
-    ws.sbox(d0x6a099e48,d0x6a0dab50,[2,3])
-    ws.sbox(d0x6a099e48,d0x6a0dab50,[2,3])
+    ws.sbox(kfxtables.d0x6a099e48,kfxtables.d0x6a0dab50,[2,3])
+    ws.sbox(kfxtables.d0x6a099e48,kfxtables.d0x6a0dab50,[2,3])
     ws.shuffle(repl)
-    ws.sbox(d0x6a09ee48,d0x6a0dab50,[2,3])
-    ws.exlookup(d0x6a09de48)
+    ws.sbox(kfxtables.d0x6a09ee48,kfxtables.d0x6a0dab50,[2,3])
+    ws.exlookup(kfxtables.d0x6a09de48)
     dat=ws.mask(st[sto:sto+16])
     out+=dat
     sto+=16
@@ -1032,6 +1172,7 @@ def process_V3646(st):
 
 
 def process_V6052(st):
+  loadkfxtables()
   #d683c8c4e4f46ae45812196f37e218eabce0fae08994f25fabb01d3e569b8bf3866b99d36f57
   ws=workspace([0x5f,0x0d,0x01,0x12,0x5d,0x5c,0x14,0x2a,0x17,0x69,0x14,0x0d,0x09,0x21,0x1e,0x3b])
   repl=[0,5,10,15,4,9,14,3,8,13,2,7,12,1,6,11]
@@ -1040,16 +1181,16 @@ def process_V6052(st):
   out=[]
   while(remln>0):
     ws.shuffle(repl)
-    ws.sbox(d0x6a0a4b20,d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0a4b20,kfxtables.d0x6a0dab50,[1,3])
     ws.shuffle(repl)
-    ws.sbox(d0x6a0a4b20,d0x6a0dab50,[1,3])
-    ws.sbox(d0x6a0a9b20,d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0a4b20,kfxtables.d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0a9b20,kfxtables.d0x6a0dab50,[1,3])
     ws.shuffle(repl)
-    ws.sbox(d0x6a0a9b20,d0x6a0dab50,[1,3])
-    ws.sbox(d0x6a0a9b20,d0x6a0dab50,[1,3])
-    ws.sbox(d0x6a0a4b20,d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0a9b20,kfxtables.d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0a9b20,kfxtables.d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0a4b20,kfxtables.d0x6a0dab50,[1,3])
 
-    ws.exlookup(d0x6a0a8b20)
+    ws.exlookup(kfxtables.d0x6a0a8b20)
     dat=ws.mask(st[sto:sto+16])
     out+=dat
     sto+=16
@@ -1057,6 +1198,7 @@ def process_V6052(st):
   return bytes(out)
 
 def process_V9479(st):
+  loadkfxtables()
   #925635db434bccd3f4791eb87b89d2dfc7c93be06e794744eb9de58e6d721e696980680ab551
   ws=workspace([0x65,0x1d,0x19,0x7c,0x09,0x79,0x1d,0x69,0x7c,0x4e,0x13,0x0e,0x04,0x1b,0x6a,0x3c ])
   repl=[0,5,10,15,4,9,14,3,8,13,2,7,12,1,6,11]
@@ -1064,16 +1206,16 @@ def process_V9479(st):
   sto=0
   out=[]
   while(remln>0):
-    ws.sbox(d0x6a0af7f8,d0x6a0dab50,[1,2,3])
-    ws.sbox(d0x6a0af7f8,d0x6a0dab50,[1,2,3])
-    ws.sbox(d0x6a0b47f8,d0x6a0dab50,[1,2,3])
-    ws.sbox(d0x6a0af7f8,d0x6a0dab50,[1,2,3])
+    ws.sbox(kfxtables.d0x6a0af7f8,kfxtables.d0x6a0dab50,[1,2,3])
+    ws.sbox(kfxtables.d0x6a0af7f8,kfxtables.d0x6a0dab50,[1,2,3])
+    ws.sbox(kfxtables.d0x6a0b47f8,kfxtables.d0x6a0dab50,[1,2,3])
+    ws.sbox(kfxtables.d0x6a0af7f8,kfxtables.d0x6a0dab50,[1,2,3])
     ws.shuffle(repl)
-    ws.sbox(d0x6a0b47f8,d0x6a0dab50,[1,2,3])
+    ws.sbox(kfxtables.d0x6a0b47f8,kfxtables.d0x6a0dab50,[1,2,3])
     ws.shuffle(repl)
     ws.shuffle(repl)
-    ws.sbox(d0x6a0b47f8,d0x6a0dab50,[1,2,3])
-    ws.exlookup(d0x6a0b37f8)
+    ws.sbox(kfxtables.d0x6a0b47f8,kfxtables.d0x6a0dab50,[1,2,3])
+    ws.exlookup(kfxtables.d0x6a0b37f8)
 
     dat=ws.mask(st[sto:sto+16])
     out+=dat
@@ -1082,6 +1224,7 @@ def process_V9479(st):
   return bytes(out)
 
 def process_V9888(st):
+  loadkfxtables()
   #54c470723f8c105ba0186b6319050869de673ce31a5ec15d4439921d4cd05c5e860cb2a41fea
   ws=workspace([0x3f,0x17,0x79,0x69,0x24,0x6b,0x37,0x50,0x63,0x09,0x45,0x6f,0x0c,0x07,0x07,0x09])
   repl=[0,5,10,15,4,9,14,3,8,13,2,7,12,1,6,11]
@@ -1089,16 +1232,16 @@ def process_V9888(st):
   sto=0
   out=[]
   while(remln>0):
-    ws.sbox(d0x6a0ba4d0,d0x6a0dab50,[1,2])
-    ws.sbox(d0x6a0bf4d0,d0x6a0dab50,[1,2])
-    ws.sbox(d0x6a0bf4d0,d0x6a0dab50,[1,2])
-    ws.sbox(d0x6a0ba4d0,d0x6a0dab50,[1,2])
+    ws.sbox(kfxtables.d0x6a0ba4d0,kfxtables.d0x6a0dab50,[1,2])
+    ws.sbox(kfxtables.d0x6a0bf4d0,kfxtables.d0x6a0dab50,[1,2])
+    ws.sbox(kfxtables.d0x6a0bf4d0,kfxtables.d0x6a0dab50,[1,2])
+    ws.sbox(kfxtables.d0x6a0ba4d0,kfxtables.d0x6a0dab50,[1,2])
     ws.shuffle(repl)
     ws.shuffle(repl)
     ws.shuffle(repl)
-    ws.sbox(d0x6a0bf4d0,d0x6a0dab50,[1,2])
-    ws.sbox(d0x6a0ba4d0,d0x6a0dab50,[1,2])
-    ws.exlookup(d0x6a0be4d0)
+    ws.sbox(kfxtables.d0x6a0bf4d0,kfxtables.d0x6a0dab50,[1,2])
+    ws.sbox(kfxtables.d0x6a0ba4d0,kfxtables.d0x6a0dab50,[1,2])
+    ws.exlookup(kfxtables.d0x6a0be4d0)
     dat=ws.mask(st[sto:sto+16])
     out+=dat
     sto+=16
@@ -1106,6 +1249,7 @@ def process_V9888(st):
   return bytes(out)
 
 def process_V4648(st):
+  loadkfxtables()
   #705bd4cd8b61d4596ef4ca40774d68e71f1f846c6e94bd23fd26e5c127e0beaa650a50171f1b
   ws=workspace([0x16,0x2b,0x64,0x62,0x13,0x04,0x18,0x0d,0x63,0x25,0x14,0x17,0x0f,0x13,0x46,0x0c])
   repl=[0,5,10,15,4,9,14,3,8,13,2,7,12,1,6,11]
@@ -1113,16 +1257,16 @@ def process_V4648(st):
   sto=0
   out=[]
   while(remln>0):
-    ws.sbox(d0x6a0ca1a8,d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0ca1a8,kfxtables.d0x6a0dab50,[1,3])
     ws.shuffle(repl)
-    ws.sbox(d0x6a0ca1a8,d0x6a0dab50,[1,3])
-    ws.sbox(d0x6a0c51a8,d0x6a0dab50,[1,3])
-    ws.sbox(d0x6a0ca1a8,d0x6a0dab50,[1,3])
-    ws.sbox(d0x6a0c51a8,d0x6a0dab50,[1,3])
-    ws.sbox(d0x6a0c51a8,d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0ca1a8,kfxtables.d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0c51a8,kfxtables.d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0ca1a8,kfxtables.d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0c51a8,kfxtables.d0x6a0dab50,[1,3])
+    ws.sbox(kfxtables.d0x6a0c51a8,kfxtables.d0x6a0dab50,[1,3])
     ws.shuffle(repl)
     ws.shuffle(repl)
-    ws.exlookup(d0x6a0c91a8)
+    ws.exlookup(kfxtables.d0x6a0c91a8)
     dat=ws.mask(st[sto:sto+16])
     out+=dat
     sto+=16
@@ -1130,6 +1274,7 @@ def process_V4648(st):
   return bytes(out)
 
 def process_V5683(st):
+  loadkfxtables()
   #1f5af733423e5104afb9d5594e682ecf839a776257f33747c9beee671c57ab3f84943f69d8fd
   ws=workspace([0x7c,0x36,0x5c,0x1a,0x0d,0x10,0x0a,0x50,0x07,0x0f,0x75,0x1f,0x09,0x3b,0x0d,0x72])
   repl=[0,5,10,15,4,9,14,3,8,13,2,7,12,1,6,11]
@@ -1137,16 +1282,16 @@ def process_V5683(st):
   sto=0
   out=[]
   while(remln>0):
-    ws.sbox(d0x6a0d4e80,d0x6a0dab50,[])
+    ws.sbox(kfxtables.d0x6a0d4e80,kfxtables.d0x6a0dab50,[])
     ws.shuffle(repl)
-    ws.sbox(d0x6a0cfe80,d0x6a0dab50,[])
-    ws.sbox(d0x6a0d4e80,d0x6a0dab50,[])
-    ws.sbox(d0x6a0cfe80,d0x6a0dab50,[])
-    ws.sbox(d0x6a0d4e80,d0x6a0dab50,[])
+    ws.sbox(kfxtables.d0x6a0cfe80,kfxtables.d0x6a0dab50,[])
+    ws.sbox(kfxtables.d0x6a0d4e80,kfxtables.d0x6a0dab50,[])
+    ws.sbox(kfxtables.d0x6a0cfe80,kfxtables.d0x6a0dab50,[])
+    ws.sbox(kfxtables.d0x6a0d4e80,kfxtables.d0x6a0dab50,[])
     ws.shuffle(repl)
-    ws.sbox(d0x6a0cfe80,d0x6a0dab50,[])
+    ws.sbox(kfxtables.d0x6a0cfe80,kfxtables.d0x6a0dab50,[])
     ws.shuffle(repl)
-    ws.exlookup(d0x6a0d3e80)
+    ws.exlookup(kfxtables.d0x6a0d3e80)
     dat=ws.mask(st[sto:sto+16])
     out+=dat
     sto+=16
@@ -1475,19 +1620,74 @@ class DrmIonVoucher(object):
         return self.license_type
 
 
+class _FirstPageDecoded(Exception):
+    pass
+
+
 class DrmIon(object):
     ion = None
     voucher = None
     vouchername = ""
     key = b""
     onvoucherrequired = None
-
-    def __init__(self, ionstream, onvoucherrequired):
-        self.ion = BinaryIonParser(ionstream)
+    workers = None
+
+    # Pages are decrypted and decompressed on a thread pool (AES and LZMA
+    # release the GIL), while the envelope walk stays on the calling thread.
+    # At most MAX_PENDING_PER_WORKER pages per worker are in flight, and
+    # results are written to outpages in envelope order.
+    MAX_PENDING_PER_WORKER = 4
+
+    # ionstream may be a stream or a bytes-like object holding the whole
+    # envelope. The latter is parsed in place with BinaryIonBufferParser.
+    def __init__(self, ionstream, onvoucherrequired, workers=None):
+        if isinstance(ionstream, (bytes, bytearray, memoryview)):
+            self.ion = BinaryIonBufferParser(ionstream)
+        else:
+            self.ion = BinaryIonParser(ionstream)
         addprottable(self.ion)
         self.onvoucherrequired = onvoucherrequired
+        if workers is None:
+            workers = min(os.cpu_count() or 1, 8)
+        self.workers = workers
 
     def parse(self, outpages):
+        if self.workers <= 1:
+            self.parsepages(lambda *page: outpages.write(self.decodepage(*page)))
+            return
+
+        pending = collections.deque()
+        maxpending = self.workers * self.MAX_PENDING_PER_WORKER
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            def submitpage(*page):
+                pending.append(executor.submit(self.decodepage, *page))
+                while len(pending) >= maxpending:
+                    outpages.write(pending.popleft().result())
+
+            try:
+                self.parsepages(submitpage)
+                while pending:
+                    outpages.write(pending.popleft().result())
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def checkfirstpage(self):
+        # Decodes only the first page, to find out early whether the voucher
+        # opens the envelope.
+        def onpage(*page):
+            self.decodepage(*page)
+            raise _FirstPageDecoded()
+
+        try:
+            self.parsepages(onpage)
+        except _FirstPageDecoded:
+            pass
+
+    def parsepages(self, onpage):
+        # Walks the envelope and calls onpage(data, iv, decompress, decrypt)
+        # for every page, in order.
         self.ion.reset()
 
         _assert(self.ion.hasnext(), "DRMION envelope is empty")
@@ -1537,7 +1737,7 @@ class DrmIon(object):
                             civ = self.ion.lobvalue()
 
                     if ct is not None and civ is not None:
-                        self.processpage(ct, civ, outpages, decompress, decrypt)
+                        onpage(ct, civ, decompress, decrypt)
                     self.ion.stepout()
 
                 elif self.ion.gettypename() in ["com.amazon.drm.PlainText@1.0", "com.amazon.drm.PlainText@2.0"]:
@@ -1553,7 +1753,7 @@ class DrmIon(object):
                             plaintext = self.ion.lobvalue()
 
                     if plaintext is not None:
-                        self.processpage(plaintext, None, outpages, decompress, decrypt)
+                        onpage(plaintext, None, decompress, decrypt)
                     self.ion.stepout()
 
             self.ion.stepout()
@@ -1565,26 +1765,29 @@ class DrmIon(object):
         self.ion.print_(lst)
 
     def processpage(self, ct, civ, outpages, decompress, decrypt):
+        outpages.write(self.decodepage(ct, civ, decompress, decrypt))
+
+    def decodepage(self, ct, civ, decompress, decrypt):
         if decrypt:
             aes = AES.new(self.key[:16], AES.MODE_CBC, civ[:16])
             msg = pkcs7unpad(aes.decrypt(ct), 16)
         else:
-            msg = ct
+            # plaintext pages may be a memoryview into the envelope
+            msg = bytes(ct)
 
         if not decompress:
-            outpages.write(msg)
-            return
+            return msg
 
         _assert(msg[0] == 0, "LZMA UseFilter not supported")
 
         if calibre_lzma is not None:
             with calibre_lzma.decompress(msg[1:], bufsize=0x1000000) as f:
                 f.seek(0)
-                outpages.write(f.read())
-            return
+                return f.read()
 
+        segments = []
         decomp = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
         while not decomp.eof:
-            segment = decomp.decompress(msg[1:])
+            segments.append(decomp.decompress(msg[1:]))
             msg = b"" # Contents were internally buffered after the first call
-            outpages.write(segment)
+        return b"".join(segments)
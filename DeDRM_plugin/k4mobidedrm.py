@@ -82,11 +82,22 @@ import json
 class DrmException(Exception):
     pass
 
-from . import mobidedrm, topazextract, kgenpids, androidkindlekey, kfxdedrm
+try:
+    from . import mobidedrm, kgenpids
+except ImportError:
+    import mobidedrm, kgenpids
+# topazextract, kfxdedrm (which pulls in ion and its large kfxtables) and
+# androidkindlekey are only imported when a book actually needs them.
 
-from .utilities import SafeUnbuffered
+try:
+    from .utilities import SafeUnbuffered
+except ImportError:
+    from utilities import SafeUnbuffered
 
-from .argv_utils import unicode_argv
+try:
+    from .argv_utils import unicode_argv
+except ImportError:
+    from argv_utils import unicode_argv
 
 
 # cleanup unicode filenames
@@ -136,7 +147,12 @@ def unescape(text):
         return text # leave as is
     return re.sub("&#?\\w+;", fixup, text)
 
-def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime = time.time()):
+# keyhints is an optional DeDRM_KeyHints object from the plugin's prefs. If given, the
+# Kindle database that last opened a book with the same licence is tried on its own
+# first, before all the keys together. A database is only remembered when it was the
+# only source of keys, as the combined try doesn't say which key worked.
+# topazworkers is the number of processes Topaz pages are converted on.
+def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime = time.time(), keyhints = None, topazworkers = 0):
     # handle the obvious cases at the beginning
     if not os.path.isfile(infile):
         raise DrmException("Input file does not exist.")
@@ -151,11 +167,19 @@ def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime
         mobi = False
 
     if magic8[:4] == b'PK\x03\x04':
+        try:
+            from . import kfxdedrm
+        except ImportError:
+            import kfxdedrm
         mb = kfxdedrm.KFXZipBook(infile)
     elif mobi:
         mb = mobidedrm.MobiBook(infile)
     else:
-        mb = topazextract.TopazBook(infile)
+        try:
+            from . import topazextract
+        except ImportError:
+            import topazextract
+        mb = topazextract.TopazBook(infile, topazworkers)
 
     try: 
         bookname = unescape(mb.getBookTitle())
@@ -166,10 +190,42 @@ def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime
     # copy list of pids
     totalpids = list(pids)
     # extend list of serials with serials from android databases
+    if len(androidFiles) > 0:
+        try:
+            from . import androidkindlekey
+        except ImportError:
+            import androidkindlekey
     for aFile in androidFiles:
         serials.extend(androidkindlekey.get_serials(aFile))
     # extend PID list with book-specific PIDs from seriala and kDatabases
     md1, md2 = mb.getPIDMetaInfo()
+
+    bookid = None
+    if keyhints is not None and len(kDatabases) > 0:
+        try:
+            bookid = mb.getBookIdentity()
+        except:
+            bookid = None
+
+    hinted = keyhints.lookup(bookid) if bookid is not None else None
+    for dbname, kDatabase in kDatabases:
+        if dbname != hinted:
+            continue
+        # try the database that opened this book last time on its own first
+        dbpids = list(set(kgenpids.getPidList(md1, md2, [], [[dbname, kDatabase]])))
+        if len(dbpids) == 0:
+            break
+        print("Trying {1:d} keys from {2} after {0:.1f} seconds".format(time.time()-starttime, len(dbpids), dbname))
+        try:
+            mb.processBook(dbpids)
+        except Exception as e:
+            print("Keys from {0} did not work: {1}".format(dbname, e.args[0] if len(e.args) > 0 else e))
+            # no need to try them again with everything else
+            kDatabases = [item for item in kDatabases if item[0] != dbname]
+            break
+        print("Decryption succeeded after {0:.1f} seconds".format(time.time()-starttime))
+        return mb
+
     totalpids.extend(kgenpids.getPidList(md1, md2, serials, kDatabases))
     # remove any duplicates
     totalpids = list(set(totalpids))
@@ -182,6 +238,9 @@ def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime
         mb.cleanup()
         raise
 
+    if bookid is not None and len(kDatabases) == 1 and len(pids) == 0 and len(serials) == 0:
+        # all the keys came from one database, so that's the one that opened the book
+        keyhints.remember(bookid, kDatabases[0][0])
     print("Decryption succeeded after {0:.1f} seconds".format(time.time()-starttime))
     return mb
 
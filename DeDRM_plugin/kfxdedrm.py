@@ -6,12 +6,21 @@
 #  2.0   - Python 3 for calibre 5.0
 #  2.1   - Some fixes for debugging
 #  2.1.1 - Whitespace!
+#  2.2   - Index the archive once, stream decrypted DRMION data into the output
+#          and copy other members without recompressing them
 
 
 import os, sys
+import copy
+import mmap
 import shutil
+import tempfile
 import traceback
 import zipfile
+import zlib
+import struct
+
+from struct import unpack
 
 from io import BytesIO
 
@@ -19,56 +28,297 @@ from io import BytesIO
 #@@CALIBRE_COMPAT_CODE@@
 
 
-from .ion import DrmIon, DrmIonVoucher
+try:
+    from .ion import DrmIon, DrmIonVoucher
+except ImportError:
+    from ion import DrmIon, DrmIonVoucher
 
 
 
 __license__ = 'GPL v3'
-__version__ = '2.0'
+__version__ = '2.2'
+
+
+_DRMION_MAGIC = b'\xeaDRMION\xee'
+_VOUCHER_MAGIC = b'\xe0\x01\x00\xea'
+
+_FILENAME_LEN_OFFSET = 26
+_EXTRA_LEN_OFFSET = 28
+_FILENAME_OFFSET = 30
+_ZIP64_EXTRA_TAG = 0x0001
+_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+_CENTRAL_HEADER = struct.Struct('<4sBBBBHHHHIIIHHHHHII')
+_CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+_END_RECORD = struct.Struct('<4sHHHHIIH')
+_END_RECORD_SIGNATURE = b'PK\x05\x06'
+_ZIP_LIMIT = 0xFFFFFFFF
+_DATA_DESCRIPTOR_FLAG = 0x08
+_UTF8_FLAG = 0x800
+_COPY_BUFSIZE = 1024 * 1024
+# compressed DRMION members larger than this are decompressed to a temporary
+# file and parsed from a memory map of it
+_SPOOL_SIZE = 16 * 1024 * 1024
+
+
+def dosDateTime(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+
+def encodeFilename(info):
+    if info.flag_bits & _UTF8_FLAG:
+        return info.orig_filename.encode('utf-8')
+    return info.orig_filename.encode('cp437')
+
+
+class ZipMemberWriter:
+    # File object for a member of a RawZipWriter archive. Compresses and
+    # writes the data as it comes, then fills in the local header.
+    def __init__(self, writer, info):
+        self.writer = writer
+        self.info = info
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        if info.compress_type == zipfile.ZIP_STORED:
+            self.compressor = None
+        else:
+            self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.file_size += len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.writer.fp.write(data)
+        self.compress_size += len(data)
+        return len(data)
+
+    def close(self):
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            self.writer.fp.write(data)
+            self.compress_size += len(data)
+            self.compressor = None
+        self.info.CRC = self.crc
+        self.info.file_size = self.file_size
+        self.info.compress_size = self.compress_size
+        self.writer.finishMember(self.info)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+
+
+class RawZipWriter:
+    # Writes a zip archive that reuses the members of another one. copyMember
+    # copies a member's local header and compressed data unchanged, openMember
+    # returns a file object that compresses what is written to it. Archives
+    # that would need Zip64 are not supported.
+    def __init__(self, fp):
+        self.fp = fp
+        self.members = []
+        self.header_offset = None
+
+    def copyMember(self, inf, info):
+        # the local header has the name and extra field as they were written,
+        # which may differ from the central directory copy
+        inf.seek(info.header_offset)
+        header = inf.read(_LOCAL_HEADER.size)
+        fields = list(_LOCAL_HEADER.unpack(header))
+        if fields[0] != _LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile("Bad local header for {0}".format(info.filename))
+        header += inf.read(fields[9] + fields[10])
+
+        self.checkOffset(info)
+        offset = self.fp.tell()
+        if fields[2] & _DATA_DESCRIPTOR_FLAG:
+            # put the sizes into the local header and drop the data descriptor
+            fields[2] &= ~_DATA_DESCRIPTOR_FLAG
+            fields[6:9] = [info.CRC, info.compress_size, info.file_size]
+            header = _LOCAL_HEADER.pack(*fields) + header[_LOCAL_HEADER.size:]
+        self.fp.write(header)
+
+        remaining = info.compress_size
+        while remaining > 0:
+            data = inf.read(min(remaining, _COPY_BUFSIZE))
+            if len(data) == 0:
+                raise EOFError("Unexpected end of archive in {0}".format(info.filename))
+            self.fp.write(data)
+            remaining -= len(data)
+
+        zinfo = copy.copy(info)
+        zinfo.flag_bits &= ~_DATA_DESCRIPTOR_FLAG
+        zinfo.header_offset = offset
+        self.members.append(zinfo)
+
+    def openMember(self, info):
+        # A new member with info's name, date and attributes
+        zinfo = copy.copy(info)
+        if zinfo.compress_type != zipfile.ZIP_STORED:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.flag_bits &= _UTF8_FLAG
+        zinfo.extract_version = 20
+        zinfo.extra = b''
+        self.checkOffset(zinfo)
+        zinfo.header_offset = self.fp.tell()
+        self.fp.write(self.localHeader(zinfo))
+        return ZipMemberWriter(self, zinfo)
+
+    def finishMember(self, zinfo):
+        if zinfo.compress_size > _ZIP_LIMIT or zinfo.file_size > _ZIP_LIMIT:
+            raise zipfile.LargeZipFile("{0} is too large".format(zinfo.filename))
+        end = self.fp.tell()
+        self.fp.seek(zinfo.header_offset)
+        self.fp.write(self.localHeader(zinfo))
+        self.fp.seek(end)
+        self.members.append(zinfo)
+
+    def localHeader(self, zinfo):
+        name = encodeFilename(zinfo)
+        dosdate, dostime = dosDateTime(zinfo.date_time)
+        return _LOCAL_HEADER.pack(_LOCAL_HEADER_SIGNATURE, zinfo.extract_version, zinfo.flag_bits,
+                zinfo.compress_type, dostime, dosdate, zinfo.CRC, zinfo.compress_size,
+                zinfo.file_size, len(name), 0) + name
+
+    def checkOffset(self, info):
+        if self.fp.tell() >= _ZIP_LIMIT or len(self.members) >= 0xFFFF:
+            raise zipfile.LargeZipFile("Archive is too large at {0}".format(info.filename))
+
+    def close(self, comment=b''):
+        start = self.fp.tell()
+        for zinfo in self.members:
+            name = encodeFilename(zinfo)
+            extra = stripZip64Extra(zinfo.extra)
+            dosdate, dostime = dosDateTime(zinfo.date_time)
+            self.fp.write(_CENTRAL_HEADER.pack(_CENTRAL_HEADER_SIGNATURE, zinfo.create_version,
+                    zinfo.create_system, zinfo.extract_version, zinfo.reserved, zinfo.flag_bits,
+                    zinfo.compress_type, dostime, dosdate, zinfo.CRC, zinfo.compress_size,
+                    zinfo.file_size, len(name), len(extra), len(zinfo.comment), 0,
+                    zinfo.internal_attr, zinfo.external_attr, zinfo.header_offset))
+            self.fp.write(name + extra + zinfo.comment)
+        size = self.fp.tell() - start
+        if start + size > _ZIP_LIMIT:
+            raise zipfile.LargeZipFile("Archive is too large")
+        self.fp.write(_END_RECORD.pack(_END_RECORD_SIGNATURE, 0, 0, len(self.members),
+                len(self.members), size, start, len(comment)) + comment)
+
+
+def memberDataOffset(inf, info):
+    # Offset of a member's (compressed) data in the archive file
+    inf.seek(info.header_offset + _FILENAME_LEN_OFFSET)
+    local_name_length, = unpack('<H', inf.read(2))
+    inf.seek(info.header_offset + _EXTRA_LEN_OFFSET)
+    extra_field_length, = unpack('<H', inf.read(2))
+    return info.header_offset + _FILENAME_OFFSET + local_name_length + extra_field_length
+
+
+def stripZip64Extra(extra):
+    # the copied sizes and offsets always fit, so Zip64 records aren't needed
+    fields = []
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = unpack('<HH', extra[pos:pos+4])
+        if tag != _ZIP64_EXTRA_TAG:
+            fields.append(extra[pos:pos+4+size])
+        pos += 4 + size
+    return b''.join(fields)
+
+
+def parseMapped(fileobj, start, length, voucher, outfile):
+    # Parses the DRMION envelope at start in fileobj in place from a memory
+    # map, without reading it into memory first.
+    mm = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        envelope = memoryview(mm)[start:start + length]
+        drmion = DrmIon(envelope, lambda name: voucher)
+        drmion.parse(outfile)
+        del drmion
+        envelope.release()
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            # a view is still alive somewhere, the mapping is freed with it
+            pass
 
 
 class KFXZipBook:
     def __init__(self, infile):
         self.infile = infile
         self.voucher = None
+        self.voucherfile = None
+        self.voucherdata = None
+        self.drmionfiles = None
         self.decrypted = {}
 
     def getPIDMetaInfo(self):
         return (None, None)
 
-    def processBook(self, totalpids):
+    def indexBook(self):
+        # Single pass over the archive: find the DRMION members and the
+        # DRM voucher by their magic bytes.
+        if self.drmionfiles is not None:
+            return
+
+        self.drmionfiles = set()
         with zipfile.ZipFile(self.infile, 'r') as zf:
-            for filename in zf.namelist():
-                with zf.open(filename) as fh:
+            for info in zf.infolist():
+                with zf.open(info) as fh:
                     data = fh.read(8)
-                    if data != b'\xeaDRMION\xee':
-                        continue
-                    data += fh.read()
-                    if self.voucher is None:
-                        self.decrypt_voucher(totalpids)
-                    print("Decrypting KFX DRMION: {0}".format(filename))
-                    outfile = BytesIO()
-                    DrmIon(BytesIO(data[8:-8]), lambda name: self.voucher).parse(outfile)
-                    self.decrypted[filename] = outfile.getvalue()
-
-        if not self.decrypted:
+                    if data == _DRMION_MAGIC:
+                        self.drmionfiles.add(info.filename)
+                    elif data[:4] == _VOUCHER_MAGIC and self.voucherfile is None:
+                        data += fh.read()
+                        if b'ProtectedData' in data:
+                            # found DRM voucher
+                            self.voucherfile = info.filename
+                            self.voucherdata = data
+
+    def processBook(self, totalpids):
+        self.indexBook()
+
+        if not self.drmionfiles:
             print("The .kfx-zip archive does not contain an encrypted DRMION file")
+            return
+
+        if self.voucher is None:
+            self.decrypt_voucher(totalpids)
+
+        # The pages are decrypted as getFile writes them out. Decode the first
+        # page of every DRMION member now, so a key that doesn't open them
+        # fails here and not when the output is written.
+        with zipfile.ZipFile(self.infile, 'r') as zif:
+            for info in zif.infolist():
+                if info.filename not in self.drmionfiles:
+                    continue
+                print("Checking KFX DRMION: {0}".format(info.filename))
+                with zif.open(info) as fh:
+                    fh.read(len(_DRMION_MAGIC))
+                    DrmIon(fh, lambda name: self.voucher).checkfirstpage()
+
+    def getBookIdentity(self):
+        # identity of the book's licence, used to remember which key opened it
+        try:
+            filename, data = self.find_voucher()
+        except:
+            return None
+        return "kfx:" + filename
+
+    def find_voucher(self):
+        self.indexBook()
+        if self.voucherfile is None:
+            raise Exception("The .kfx-zip archive contains an encrypted DRMION file without a DRM voucher")
+        return self.voucherfile, self.voucherdata
 
     def decrypt_voucher(self, totalpids):
-        with zipfile.ZipFile(self.infile, 'r') as zf:
-            for info in zf.infolist():
-                with zf.open(info.filename) as fh:
-                    data = fh.read(4)
-                    if data != b'\xe0\x01\x00\xea':
-                        continue
-
-                    data += fh.read()
-                    if b'ProtectedData' in data:
-                        break   # found DRM voucher
-            else:
-                raise Exception("The .kfx-zip archive contains an encrypted DRMION file without a DRM voucher")
+        filename, data = self.find_voucher()
 
-        print("Decrypting KFX DRM voucher: {0}".format(info.filename))
+        print("Decrypting KFX DRM voucher: {0}".format(filename))
 
         for pid in [''] + totalpids:
             # Belt and braces. PIDs should be unicode strings, but just in case...
@@ -115,10 +365,36 @@ class KFXZipBook:
         pass
 
     def getFile(self, outpath):
-        if not self.decrypted:
+        if not self.drmionfiles:
             shutil.copyfile(self.infile, outpath)
+            return
+
+        with zipfile.ZipFile(self.infile, 'r') as zif, open(self.infile, 'rb') as inf, open(outpath, 'wb') as outf:
+            zof = RawZipWriter(outf)
+            for info in zif.infolist():
+                if info.filename not in self.drmionfiles:
+                    zof.copyMember(inf, info)
+                    continue
+
+                print("Decrypting KFX DRMION: {0}".format(info.filename))
+                with zof.openMember(info) as outfile:
+                    self.decryptMember(zif, inf, info, outfile)
+            zof.close(zif.comment)
+
+    def decryptMember(self, zif, inf, info, outfile):
+        # Writes the decrypted pages of a DRMION member to outfile as they are
+        # decoded. Memory use is bounded by _SPOOL_SIZE, not the member size.
+        length = info.file_size - 2 * len(_DRMION_MAGIC)
+        if info.compress_type == zipfile.ZIP_STORED:
+            parseMapped(inf, memberDataOffset(inf, info) + len(_DRMION_MAGIC), length, self.voucher, outfile)
+        elif info.file_size <= _SPOOL_SIZE:
+            data = zif.read(info)
+            DrmIon(memoryview(data)[len(_DRMION_MAGIC):-len(_DRMION_MAGIC)], lambda name: self.voucher).parse(outfile)
         else:
-            with zipfile.ZipFile(self.infile, 'r') as zif:
-                with zipfile.ZipFile(outpath, 'w') as zof:
-                    for info in zif.infolist():
-                        zof.writestr(info, self.decrypted.get(info.filename, zif.read(info.filename)))
+            # decompress to a temporary file, so the parser can seek around
+            # in it without going through the decompressor again
+            with tempfile.TemporaryFile() as spool:
+                with zif.open(info) as fh:
+                    shutil.copyfileobj(fh, spool, _COPY_BUFSIZE)
+                spool.flush()
+                parseMapped(spool, len(_DRMION_MAGIC), length, self.voucher, outfile)
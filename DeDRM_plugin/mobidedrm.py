@@ -80,14 +80,20 @@ import sys
 import os
 import struct
 import binascii
+import hashlib
 
 
 #@@CALIBRE_COMPAT_CODE@@
 
 
-from .alfcrypto import Pukall_Cipher
-from .utilities import SafeUnbuffered
-from .argv_utils import unicode_argv
+try:
+    from .alfcrypto import Pukall_Cipher
+    from .utilities import SafeUnbuffered
+    from .argv_utils import unicode_argv
+except ImportError:
+    from alfcrypto import Pukall_Cipher
+    from utilities import SafeUnbuffered
+    from argv_utils import unicode_argv
 
 
 class DrmException(Exception):
@@ -295,6 +301,14 @@ class MobiBook:
                 token += sval
         return rec209, token
 
+    # identity of the book's licence, used to remember which key opened it
+    def getBookIdentity(self):
+        crypto_type, = struct.unpack('>H', self.sect[0xC:0xC+2])
+        if crypto_type != 2 or 209 not in self.meta_array:
+            return None
+        rec209, token = self.getPIDMetaInfo()
+        return "mobi:" + hashlib.sha1(rec209 + token).hexdigest()
+
     # new must be byte array
     def patch(self, off, new):
         self.data_file = self.data_file[:off] + new + self.data_file[off+len(new):]
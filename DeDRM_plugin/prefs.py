@@ -7,6 +7,13 @@ __license__ = 'GPL v3'
 # Standard Python modules.
 import os, sys
 import traceback
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where remove_drm doesn't run books in parallel processes
+    fcntl = None
 
 
 #@@CALIBRE_COMPAT_CODE@@
@@ -19,14 +26,78 @@ except:
 
 from __init__ import PLUGIN_NAME
 
+# Settings file used when none is given. The standalone tools set this to
+# their --config file; in calibre it stays None and calibre's is used.
+default_json_path = None
+
+# The settings files already loaded in this process, by path, with the
+# modification time they had when they were loaded or last written by us.
+# DeDRM_Prefs is created again by every handler for every book, so the file
+# is only read and parsed again when something else has changed it.
+_loaded_configs = {}
+
+def loadconfig(json_path):
+    loaded = _loaded_configs.get(json_path)
+    if loaded is not None and loaded[0].mtime() == loaded[1]:
+        return loaded[0], True
+    config = JSONConfig(json_path)
+    _loaded_configs[json_path] = (config, config.mtime())
+    return config, False
+
+def configwritten(json_path, config):
+    # we wrote the file ourselves, so what's in memory is still up to date
+    if _loaded_configs.get(json_path, (None,))[0] is config:
+        _loaded_configs[json_path] = (config, config.mtime())
+
+# The settings files this process has locked, by path, with how many
+# lockedconfig blocks deep it is.
+_locked_configs = {}
+
+@contextmanager
+def lockedconfig(json_path, config):
+    # A read-modify-write of a settings file. Other processes (remove_drm's
+    # workers) change the same files, so the file is locked and read again
+    # first, and written once at the end, so no one's changes are lost.
+    # Nested blocks for the same file just join the outer one.
+    if json_path in _locked_configs:
+        _locked_configs[json_path] += 1
+        try:
+            yield config
+        finally:
+            _locked_configs[json_path] -= 1
+        return
+
+    lockfile = None
+    if fcntl is not None:
+        dpath = os.path.dirname(config.file_path)
+        if not os.path.exists(dpath):
+            os.makedirs(dpath)
+        lockfile = open(config.file_path + '.lock', 'a')
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+    _locked_configs[json_path] = 1
+    try:
+        config.refresh()
+        with config:
+            yield config
+        configwritten(json_path, config)
+    finally:
+        del _locked_configs[json_path]
+        if lockfile is not None:
+            lockfile.close()
+
 class DeDRM_Prefs():
     def __init__(self, json_path=None):
-        if json_path is None:
+        if json_path is None and default_json_path is not None:
+            JSON_PATH = default_json_path
+        elif json_path is None:
             JSON_PATH = os.path.join("plugins", PLUGIN_NAME.strip().lower().replace(' ', '_') + '.json')
         else:
             JSON_PATH = json_path
 
-        self.dedrmprefs = JSONConfig(JSON_PATH)
+        self.json_path = JSON_PATH
+        self.dedrmprefs, cached = loadconfig(JSON_PATH)
+        if cached:
+            return
 
         self.dedrmprefs.defaults['configured'] = False
         self.dedrmprefs.defaults['deobfuscate_fonts'] = True
@@ -42,54 +113,59 @@ class DeDRM_Prefs():
         self.dedrmprefs.defaults['adobe_pdf_passphrases'] = []
         self.dedrmprefs.defaults['adobewineprefix'] = ""
         self.dedrmprefs.defaults['kindlewineprefix'] = ""
+        # processes Topaz pages are converted on, 0 or 1 converts them in calibre's process
+        self.dedrmprefs.defaults['topaz_page_workers'] = 0
 
         # initialise
         # we must actually set the prefs that are dictionaries and lists
         # to empty dictionaries and lists, otherwise we are unable to add to them
         # as then it just adds to the (memory only) dedrmprefs.defaults versions!
-        if self.dedrmprefs['bandnkeys'] == {}:
-            self.dedrmprefs['bandnkeys'] = {}
-        if self.dedrmprefs['adeptkeys'] == {}:
-            self.dedrmprefs['adeptkeys'] = {}
-        if self.dedrmprefs['ereaderkeys'] == {}:
-            self.dedrmprefs['ereaderkeys'] = {}
-        if self.dedrmprefs['kindlekeys'] == {}:
-            self.dedrmprefs['kindlekeys'] = {}
-        if self.dedrmprefs['androidkeys'] == {}:
-            self.dedrmprefs['androidkeys'] = {}
-        if self.dedrmprefs['pids'] == []:
-            self.dedrmprefs['pids'] = []
-        if self.dedrmprefs['serials'] == []:
-            self.dedrmprefs['serials'] = []
-        if self.dedrmprefs['lcp_passphrases'] == []:
-            self.dedrmprefs['lcp_passphrases'] = []
-        if self.dedrmprefs['adobe_pdf_passphrases'] == []:
-            self.dedrmprefs['adobe_pdf_passphrases'] = []
+        # Only the missing ones are set, and all of them in one write.
+        missing = [kind for kind in ['bandnkeys', 'adeptkeys', 'ereaderkeys', 'kindlekeys', 'androidkeys',
+                                     'pids', 'serials', 'lcp_passphrases', 'adobe_pdf_passphrases']
+                   if kind not in self.dedrmprefs]
+        if missing:
+            with self:
+                for kind in missing:
+                    self.dedrmprefs[kind] = type(self.dedrmprefs.defaults[kind])()
 
     def __getitem__(self,kind = None):
         if kind is not None:
             return self.dedrmprefs[kind]
         return self.dedrmprefs
 
+    # Changes made inside a "with prefs:" block are written to the file once, at the end.
+    def __enter__(self):
+        self._locked = lockedconfig(self.json_path, self.dedrmprefs)
+        self._locked.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        locked, self._locked = self._locked, None
+        return locked.__exit__(*args)
+
     def set(self, kind, value):
-        self.dedrmprefs[kind] = value
+        with lockedconfig(self.json_path, self.dedrmprefs):
+            self.dedrmprefs[kind] = value
 
     def writeprefs(self,value = True):
-        self.dedrmprefs['configured'] = value
+        with lockedconfig(self.json_path, self.dedrmprefs):
+            self.dedrmprefs['configured'] = value
 
     def addnamedvaluetoprefs(self, prefkind, keyname, keyvalue):
         try:
-            if keyvalue not in self.dedrmprefs[prefkind].values():
-                # ensure that the keyname is unique
-                # by adding a number (starting with 2) to the name if it is not
-                namecount = 1
-                newname = keyname
-                while newname in self.dedrmprefs[prefkind]:
-                    namecount += 1
-                    newname = "{0:s}_{1:d}".format(keyname,namecount)
-                # add to the preferences
-                self.dedrmprefs[prefkind][newname] = keyvalue
-                return (True, newname)
+            with lockedconfig(self.json_path, self.dedrmprefs):
+                if keyvalue not in self.dedrmprefs[prefkind].values():
+                    # ensure that the keyname is unique
+                    # by adding a number (starting with 2) to the name if it is not
+                    namecount = 1
+                    newname = keyname
+                    while newname in self.dedrmprefs[prefkind]:
+                        namecount += 1
+                        newname = "{0:s}_{1:d}".format(keyname,namecount)
+                    # add to the preferences
+                    self.dedrmprefs[prefkind][newname] = keyvalue
+                    return (True, newname)
         except:
             traceback.print_exc()
             pass
@@ -98,9 +174,60 @@ class DeDRM_Prefs():
     def addvaluetoprefs(self, prefkind, prefsvalue):
         # ensure the keyvalue isn't already in the preferences
         try:
-            if prefsvalue not in self.dedrmprefs[prefkind]:
-                self.dedrmprefs[prefkind].append(prefsvalue)
-                return True
+            with lockedconfig(self.json_path, self.dedrmprefs):
+                if prefsvalue not in self.dedrmprefs[prefkind]:
+                    self.dedrmprefs[prefkind].append(prefsvalue)
+                    return True
         except:
             traceback.print_exc()
         return False
+
+
+class DeDRM_KeyHints():
+    # Remembers which configured key last opened a book, keyed by an identity
+    # taken from the book's licence (Adobe user UUID or resource ID, Mobi rec209,
+    # Topaz keys record, KFX voucher name). Keys are then tried in hint order,
+    # so re-imports and other books from the same account usually succeed with
+    # the first key and never get to the expensive default key discovery.
+
+    MAX_HINTS = 1000
+
+    def __init__(self, json_path=None):
+        if json_path is None and default_json_path is not None:
+            JSON_PATH = os.path.splitext(default_json_path)[0] + '_keyhints.json'
+        elif json_path is None:
+            JSON_PATH = os.path.join("plugins", PLUGIN_NAME.strip().lower().replace(' ', '_') + '_keyhints.json')
+        else:
+            JSON_PATH = json_path
+
+        self.json_path = JSON_PATH
+        self.keyhints = loadconfig(JSON_PATH)[0]
+
+    def lookup(self, bookid):
+        if bookid is None:
+            return None
+        return self.keyhints.get(bookid, None)
+
+    def sortkeys(self, bookid, keys):
+        # keys is an iterable of (keyname, keyvalue) pairs. Returns a list
+        # with the hinted key (if any) moved to the front.
+        keys = list(keys)
+        keyname = self.lookup(bookid)
+        if keyname is None:
+            return keys
+        return sorted(keys, key=lambda item: item[0] != keyname)
+
+    def remember(self, bookid, keyname):
+        if bookid is None or keyname is None:
+            return
+        try:
+            if self.keyhints.get(bookid, None) == keyname:
+                return
+            with lockedconfig(self.json_path, self.keyhints):
+                # re-insert so the dict stays ordered oldest to newest
+                self.keyhints.pop(bookid, None)
+                self.keyhints[bookid] = keyname
+                while len(self.keyhints) > self.MAX_HINTS:
+                    self.keyhints.pop(next(iter(self.keyhints)))
+        except:
+            traceback.print_exc()
@@ -122,7 +122,7 @@ def handle_single_argument(arg, next):
     global _additional_params
     global config_file_path
     
-    if arg in ["--username", "--password", "--output", "--outputdir"]: 
+    if arg in ["--username", "--password", "--output", "--outputdir", "--workers"]: 
         used_up = 1
         _additional_params.append(arg)
         if next is None or len(next) == 0: 
@@ -141,7 +141,7 @@ def handle_single_argument(arg, next):
         config_file_path = next[0]
         used_up = 1
 
-    elif arg in ["--help", "--credits", "--verbose", "--quiet", "--extract", "--import", "--overwrite", "--force"]:
+    elif arg in ["--help", "--credits", "--verbose", "--quiet", "--extract", "--import", "--overwrite", "--force", "--resume"]:
         _additional_params.append(arg)
 
         
@@ -181,7 +181,7 @@ def execute_action(action, filenames, params):
             print("Config file missing ...")
         
         from standalone.remove_drm import perform_action
-        perform_action(params, filenames)
+        sys.exit(perform_action(params, filenames, os.path.abspath(config_file_path)))
         
     elif action == "config":
         import prefs
@@ -115,11 +115,13 @@ class JSONConfig(dict):
             dpath = os.path.dirname(self.file_path)
             if not os.path.exists(dpath):
                 os.makedirs(dpath, mode=CONFIG_DIR_MODE)
-            with open(self.file_path, "w") as f:
+            # Write a new file and move it into place, so other processes
+            # (remove_drm workers) never read a half-written file.
+            tmp_path = "{0}.{1}.tmp".format(self.file_path, os.getpid())
+            with open(tmp_path, "w") as f:
                 raw = self.to_raw()
-                f.seek(0)
-                f.truncate()
                 f.write(raw)
+            os.replace(tmp_path, self.file_path)
 
     def __enter__(self):
         self.no_commit = True
@@ -10,34 +10,44 @@ from __future__ import absolute_import, print_function
 
 """
 
-NOTE: This code is not functional (yet). I started working on it a while ago
-to make a standalone version of the plugins that could work without Calibre, 
-too, but for now there's only a rough code structure and no working code yet.
+NOTE: This uses the DRM removal code of the calibre plugin. It can be run
+through Calibre, or with a standalone Python interpreter:
 
-Currently, to use these plugins, you will need to use Calibre. Hopwfully that'll
-change in the future. 
+  calibre-debug -r "DeDRM" -- remove_drm [ --workers <n> ] [ --resume ] <filename> ...
+  python3 DeDRM_plugin.zip remove_drm [ --workers <n> ] [ --resume ] <filename> ...
+
+The books are worked on in a pool of worker processes, and each finished book
+is recorded in a journal in the output folder so an interrupted run can be
+continued with --resume.
 
 """
 
 #@@CALIBRE_COMPAT_CODE@@
 
 import os, sys
+import io, json, shutil, tempfile, time, traceback
 
 from zipfile import ZipInfo, ZipFile, ZIP_STORED, ZIP_DEFLATED
-from contextlib import closing
+from contextlib import closing, redirect_stdout, redirect_stderr
 
 from standalone.__init__ import print_opt, print_std_usage
 
+# The plugin's modules import its __init__ (for PLUGIN_NAME and such), 
+# so the plugin folder has to come before this one on the path.
+plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if sys.path[0] != plugin_dir:
+    sys.path.insert(0, plugin_dir)
+
 iswindows = sys.platform.startswith('win')
 isosx = sys.platform.startswith('darwin')
 
 def print_removedrm_help():
-    from __init__ import PLUGIN_NAME, PLUGIN_VERSION
+    from __version import PLUGIN_NAME, PLUGIN_VERSION
     print(PLUGIN_NAME + " v" + PLUGIN_VERSION + " - Calibre DRM removal plugin by noDRM")
     print()
     print("remove_drm: Remove DRM from one or multiple files")
     print()
-    print_std_usage("remove_drm", "<filename> ... [ -o <filename> ] [ -f ]")
+    print_std_usage("remove_drm", "<filename> ... [ -o <filename> ] [ -f ] [ --workers <n> ] [ --resume ]")
     
     print()
     print("Options: ")
@@ -45,6 +55,9 @@ def print_removedrm_help():
     print_opt("o", "output", "File name to export the file to")
     print_opt("f", "force", "Overwrite output file if it already exists")
     print_opt(None, "overwrite", "Replace DRMed file with DRM-free file (implies --force)")
+    print_opt(None, "workers", "Number of books to work on at the same time (default: number of CPUs)")
+    print_opt(None, "resume", "Skip the books a previous, interrupted run already finished")
+    print_opt("v", "verbose", "Show the output of the DRM removal for every book, not just failed ones")
 
 
 def determine_file_type(file):
@@ -92,7 +105,7 @@ def determine_file_type(file):
                     data = subfile.read(8)
                     if data == b'\xeaDRMION\xee':
                         return "KFX-ZIP"
-    except:
+    except Exception:
         pass
 
     return "ZIP"
@@ -100,10 +113,65 @@ def determine_file_type(file):
      
 
 
-def dedrm_single_file(input_file, output_file):
+# Which method of the DeDRM plugin handles each file type from determine_file_type
+HANDLERS = {
+    "PDF": "PDFDecrypt",
+    "PDB": "eReaderDecrypt",
+    "MOBI": "KindleMobiDecrypt",
+    "TPZ": "KindleMobiDecrypt",
+    "KFX-ZIP": "KindleMobiDecrypt",
+    "LCP": "ePubDecrypt",
+    "ADEPT": "ePubDecrypt",
+    "ADEPT-PassHash": "ePubDecrypt",
+    "ZIP": "ePubDecrypt",
+}
+
+# Name of the file (in the output folder) that records finished books for --resume
+JOURNAL_NAME = "remove_drm_journal.txt"
+
+
+def get_dedrm_plugin(tempdir):
+    # The calibre plugin itself does the DRM removal. Outside of calibre's
+    # import process it just needs somewhere for its temporary files, 
+    # and the folder with the key retrieval scripts it runs in Wine.
+    from __init__ import DeDRM
+
+    class StandaloneDeDRM(DeDRM):
+        def __init__(self, tempdir):
+            self.tempdir = tempdir
+            self.alfdir = plugin_dir
+            self.starttime = time.time()
+
+        def temporary_file(self, suffix):
+            return tempfile.NamedTemporaryFile(suffix=suffix, dir=self.tempdir, delete=False)
+
+    return StandaloneDeDRM(tempdir)
+
+
+def still_encrypted(ftype, path):
+    # The handlers give back the input file when they can't do anything with it, 
+    # so check the result isn't still encrypted.
+    if path is None or not os.path.isfile(path):
+        return True
+    if ftype in ["ADEPT", "ADEPT-PassHash"]:
+        from ineptepub import adeptBook
+        return adeptBook(path)
+    if ftype == "PDF":
+        from ineptpdf import getPDFencryptionType
+        return getPDFencryptionType(path) is not None
+    if ftype == "LCP":
+        from lcpdedrm import isLCPbook
+        return isLCPbook(path)
+    return False
+
+
+def dedrm_single_file(input_file, output_file, keep_name=False):
     # When this runs, all the stupid file handling is done. 
     # Just take the file at the absolute path "input_file"
     # and export it, DRM-free, to "output_file". 
+    # Returns the status ("decrypted", "drm-free" or "failed")
+    # and the name of the output file, whose extension is changed
+    # to that of the decrypted book unless keep_name is set.
 
     # Use a temp file as input_file and output_file
     # might be identical.
@@ -115,22 +183,114 @@ def dedrm_single_file(input_file, output_file):
     # Okay, first check the file type and don't rely on the extension. 
     try: 
         ftype = determine_file_type(input_file)
-    except: 
+    except Exception: 
+        traceback.print_exc()
         print("Can't determine file type for this file.")
-        ftype = None
+        return "failed", output_file
     
     if ftype is None: 
-        return
-
-    
-    
-    
-
-def perform_action(params, files):
+        print("Unknown file type for this file.")
+        return "failed", output_file
+
+    tempdir = tempfile.mkdtemp(prefix="dedrm_")
+    try:
+        plugin = get_dedrm_plugin(tempdir)
+        try:
+            result = getattr(plugin, HANDLERS[ftype])(input_file)
+        except Exception:
+            traceback.print_exc()
+            return "failed", output_file
+
+        if still_encrypted(ftype, result):
+            print("Failed to remove the DRM from " + input_file)
+            return "failed", output_file
+
+        if ftype == "ZIP" or (ftype == "PDF" and result == input_file):
+            status = "drm-free"
+        else:
+            status = "decrypted"
+
+        if not keep_name:
+            ext = os.path.splitext(result)[1]
+            if ext and ext.lower() != os.path.splitext(output_file)[1].lower():
+                output_file = os.path.splitext(output_file)[0] + ext
+
+        # Write under a temporary name first, so an interrupted run
+        # never leaves a partial file that looks finished.
+        outdir = os.path.dirname(output_file)
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir, exist_ok=True)
+        shutil.copyfile(result, output_file + ".part")
+        os.replace(output_file + ".part", output_file)
+        return status, output_file
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def remove_drm_job(job):
+    # Runs in a worker process: remove the DRM from one book, 
+    # collecting what the handlers print instead of interleaving it.
+    input_file, output_file, keep_name = job
+    log = io.StringIO()
+    starttime = time.time()
+    with redirect_stdout(log), redirect_stderr(log):
+        try:
+            status, output_file = dedrm_single_file(input_file, output_file, keep_name)
+        except Exception:
+            traceback.print_exc()
+            status = "failed"
+    return {"input": input_file, "output": output_file, "status": status, 
+            "seconds": round(time.time() - starttime, 2), "log": log.getvalue()}
+
+
+def read_journal(journal_path):
+    # The journal has one JSON object per line for each book that was finished.
+    done = {}
+    try:
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line of an interrupted run
+                    continue
+                done[entry["input"]] = entry
+    except (IOError, OSError):
+        pass
+    return done
+
+
+def run_jobs(jobs, workers):
+    # Yields the result of each job as it finishes, using a pool of
+    # worker processes if there's more than one book and worker.
+    # Forked workers are used so they share the plugin and settings 
+    # that are already loaded (calibre's plugin loader isn't available 
+    # in new processes); without fork (Windows) the books are done 
+    # one after another. Workers that find a new key or key hint lock
+    # the settings file while they change it (prefs.lockedconfig).
+    import multiprocessing
+    if workers > 1 and len(jobs) > 1 and "fork" in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context("fork").Pool(min(workers, len(jobs)))
+        try:
+            for result in pool.imap_unordered(remove_drm_job, jobs):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for job in jobs:
+            yield remove_drm_job(job)
+
+
+def perform_action(params, files, config_path=None):
     output = None
     outputdir = None
     force = False
     overwrite_original = False
+    workers = os.cpu_count() or 1
+    resume = False
+    verbose = False
 
 
     if len(files) == 0:
@@ -148,6 +308,16 @@ def perform_action(params, files):
         elif p == "--overwrite":
             overwrite_original = True
             force = True
+        elif p == "--workers":
+            try:
+                workers = int(params.pop(0))
+            except ValueError:
+                print("--workers needs a number.", file=sys.stderr)
+                return 1
+        elif p == "--resume":
+            resume = True
+        elif p == "--verbose":
+            verbose = True
         elif p == "--help":
             print_removedrm_help()
             return 0
@@ -170,7 +340,25 @@ def perform_action(params, files):
         print("Remove --outputdir, or give a relative path to --output.", file=sys.stderr)
         return 1
 
+    if config_path is not None and os.path.isfile(config_path):
+        import prefs
+        prefs.default_json_path = config_path
+    # Otherwise the default settings file is used (calibre's, when run through calibre).
 
+    if outputdir is not None:
+        journal_path = os.path.join(os.path.abspath(outputdir), JOURNAL_NAME)
+    elif output is not None:
+        journal_path = os.path.join(os.path.dirname(os.path.abspath(output)), JOURNAL_NAME)
+    else:
+        journal_path = os.path.join(os.getcwd(), JOURNAL_NAME)
+
+    if resume:
+        done = read_journal(journal_path)
+    else:
+        done = {}
+
+    jobs = []
+    skipped = 0
 
     for file in files:
 
@@ -201,18 +389,43 @@ def perform_action(params, files):
                     output_filename = fn + "_nodrm" + f_ext
 
 
+        entry = done.get(file)
+        if entry is not None and entry["status"] != "failed" and os.path.isfile(entry["output"]):
+            print("Skipping file " + file + " - already done in a previous run.", file=sys.stderr)
+            skipped += 1
+            continue
         
         if os.path.isfile(output_filename) and not force:
             print("Skipping file " + file + " because output file already exists (use --force).", file=sys.stderr)
+            skipped += 1
             continue
 
-        
-
-        dedrm_single_file(file, output_filename)
-
-       
+        jobs.append((file, output_filename, output is not None))
 
+    if len(jobs) == 0:
+        return 0
 
+    # Books are recorded in the journal as they finish, so an 
+    # interrupted run can be picked up again with --resume.
+    counts = {"decrypted": 0, "drm-free": 0, "failed": 0}
+    starttime = time.time()
+    if not os.path.isdir(os.path.dirname(journal_path)):
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    with open(journal_path, "a" if resume else "w", encoding="utf-8") as journal:
+        for result in run_jobs(jobs, workers):
+            counts[result["status"]] += 1
+            if verbose or result["status"] == "failed":
+                print(result["log"], end="")
+            print("{0:>9} {1:7.1f}s  {2} -> {3}".format(result["status"], result["seconds"], result["input"], result["output"]))
+            del result["log"]
+            journal.write(json.dumps(result) + "\n")
+            journal.flush()
+
+    print("{0} decrypted, {1} DRM-free, {2} failed, {3} skipped in {4:.1f} seconds".format(
+            counts["decrypted"], counts["drm-free"], counts["failed"], skipped, time.time() - starttime))
+
+    if counts["failed"] > 0:
+        return 1
     return 0
     
 
@@ -10,8 +10,9 @@ from __future__ import print_function
 #  4.9  - moved unicode_argv call inside main for Windows DeDRM compatibility
 #  5.0  - Fixed potential unicode problem with command line interface
 #  6.0  - Added Python 3 compatibility for calibre 5.0
+#  6.1  - Keep decrypted records in memory instead of extracting them to a temporary directory
 
-__version__ = '6.0'
+__version__ = '6.1'
 
 import sys
 import os, csv, getopt
@@ -19,41 +20,44 @@ import os, csv, getopt
 #@@CALIBRE_COMPAT_CODE@@
 
 
-import zlib, zipfile, tempfile, shutil
+import zlib, zipfile, mmap
+import hashlib
 import traceback
 from struct import pack
 from struct import unpack
 
-from .alfcrypto import Topaz_Cipher
-from .utilities import SafeUnbuffered
+try:
+    from .alfcrypto import Topaz_Cipher
+    from .utilities import SafeUnbuffered
+except ImportError:
+    from alfcrypto import Topaz_Cipher
+    from utilities import SafeUnbuffered
 
-from .argv_utils import unicode_argv
+try:
+    from .argv_utils import unicode_argv
+except ImportError:
+    from argv_utils import unicode_argv
 
 
 #global switch
 debug = False
 
-from . import kgenpids
+try:
+    from . import kgenpids
+except ImportError:
+    import kgenpids
 
 
 class DrmException(Exception):
     pass
 
 
-# recursive zip creation support routine
-def zipUpDir(myzip, tdir, localname):
-    currentdir = tdir
-    if localname != "":
-        currentdir = os.path.join(currentdir,localname)
-    list = os.listdir(currentdir)
-    for file in list:
-        afilename = file
-        localfilePath = os.path.join(localname, afilename)
-        realfilePath = os.path.join(currentdir,file)
-        if os.path.isfile(realfilePath):
-            myzip.write(realfilePath, localfilePath)
-        elif os.path.isdir(realfilePath):
-            zipUpDir(myzip, tdir, localfilePath)
+# the paths of every file in some directories of the generated book
+def storePaths(store, localnames):
+    paths = []
+    for localname in localnames:
+        paths.extend(localname + "/" + filename for filename in store.listdir(localname))
+    return paths
 
 #
 # Utility routines
@@ -101,14 +105,13 @@ def topazCryptoDecrypt(data, ctx):
     return Topaz_Cipher().decrypt(data, ctx)
 #     ctx1 = ctx[0]
 #     ctx2 = ctx[1]
-#     plainText = ""
-#     for dataChar in data:
-#         dataByte = ord(dataChar)
+#     plainText = bytearray()
+#     for dataByte in data:
 #         m = (dataByte ^ ((ctx1 >> 3) &0xFF) ^ ((ctx2<<3) & 0xFF)) &0xFF
 #         ctx2 = ctx1
 #         ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) &0xFFFFFFFF) ^((m * m * 0x0F902007) &0xFFFFFFFF)
-#         plainText += chr(m)
-#     return plainText
+#         plainText.append(m)
+#     return bytes(plainText)
 
 # Decrypt data with the PID
 def decryptRecord(data,PID):
@@ -118,8 +121,6 @@ def decryptRecord(data,PID):
 # Try to decrypt a dkey record (contains the bookPID)
 def decryptDkeyRecord(data,PID):
     record = decryptRecord(data,PID)
-    if isinstance(record, str):
-       record = record.encode('latin-1')
     fields = unpack('3sB8sB8s3s',record)
     if fields[0] != b'PID' or fields[5] != b'pid' :
         raise DrmException("Didn't find PID magic numbers in record")
@@ -148,10 +149,17 @@ def decryptDkeyRecords(data,PID):
 
 
 class TopazBook:
-    def __init__(self, filename):
-        self.fo = open(filename, 'rb')
-        self.outdir = tempfile.mkdtemp()
-        # self.outdir = 'rawdat'
+    # workers is the number of processes genbook converts the pages on,
+    # 0 or 1 converts them in this process
+    def __init__(self, filename, workers=0):
+        self.workers = workers
+        self.infile = open(filename, 'rb')
+        try:
+            # records are read straight out of the mapped book
+            self.fo = mmap.mmap(self.infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self.fo = self.infile
+        self.store = None
         self.bookPayloadOffset = 0
         self.bookHeaderRecords = {}
         self.bookMetadata = {}
@@ -216,6 +224,15 @@ class TopazBook:
                 keysRecordRecord += self.bookMetadata.get(keyval,b'')
         return keysRecord, keysRecordRecord
 
+    # identity of the book's licence, used to remember which key opened it
+    def getBookIdentity(self):
+        if b'dkey' not in self.bookHeaderRecords:
+            return None
+        keysRecord, keysRecordRecord = self.getPIDMetaInfo()
+        if keysRecord == b'':
+            return None
+        return "topaz:" + hashlib.sha1(keysRecord + keysRecordRecord).hexdigest()
+
     def getBookTitle(self):
         title = b''
         if b'Title' in self.bookMetadata:
@@ -263,8 +280,6 @@ class TopazBook:
                 raise DrmException("Error: Attempt to decrypt without bookKey")
 
         if compressed:
-            if isinstance(record, str):
-                record = bytes(record, 'latin-1')
             record = zlib.decompress(record)
 
         return record
@@ -277,12 +292,7 @@ class TopazBook:
         except DrmException as e:
             print("no dkey record found, book may not be encrypted")
             print("attempting to extract files without a book key")
-            self.createBookDirectory()
-            self.extractFiles()
-            print("Successfully Extracted Topaz contents")
-            import genbook
-
-            rv = genbook.generateBook(self.outdir, raw, fixedimage)
+            rv = self.generateBook(raw, fixedimage)
             if rv == 0:
                 print("Book Successfully generated.")
             return rv
@@ -310,71 +320,26 @@ class TopazBook:
             raise DrmException("No key found in {0:d} keys tried. Read the FAQs at noDRM's repository: https://github.com/noDRM/DeDRM_tools/blob/master/FAQs.md".format(len(pidlst)))
 
         self.setBookKey(bookKey)
-        self.createBookDirectory()
-        self.extractFiles()
-        print("Successfully Extracted Topaz contents")
-        import genbook
-
-        rv = genbook.generateBook(self.outdir, raw, fixedimage)
+        rv = self.generateBook(raw, fixedimage)
         if rv == 0:
             print("Book Successfully generated")
         return rv
 
-    def createBookDirectory(self):
-        outdir = self.outdir
-        # create output directory structure
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
-        destdir =  os.path.join(outdir,"img")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,"color_img")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,"page")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,"glyphs")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-
-    def extractFiles(self):
-        outdir = self.outdir
-        for headerRecord in self.bookHeaderRecords:
-            name = headerRecord
+    def generateBook(self, raw, fixedimage):
+        import genbook
+
+        # records are decrypted as genbook asks for them
+        counts = {}
+        for name in self.bookHeaderRecords:
             if name != b'dkey':
-                ext = ".dat"
-                if name == b'img': ext = ".jpg"
-                if name == b'color' : ext = ".jpg"
-                print("Processing Section: {0}\n. . .".format(name.decode('utf-8')), end=' ')
-                for index in range (0,len(self.bookHeaderRecords[name])) :
-                    fname = "{0}{1:04d}{2}".format(name.decode('utf-8'),index,ext)
-                    destdir = outdir
-                    if name == b'img':
-                        destdir =  os.path.join(outdir,"img")
-                    if name == b'color':
-                        destdir =  os.path.join(outdir,"color_img")
-                    if name == b'page':
-                        destdir =  os.path.join(outdir,"page")
-                    if name == b'glyphs':
-                        destdir =  os.path.join(outdir,"glyphs")
-                    outputFile = os.path.join(destdir,fname)
-                    print(".", end=' ')
-                    record = self.getBookPayloadRecord(name,index)
-                    if isinstance(record, str):
-                        record=bytes(record, 'latin-1')
-                    if record != b'':
-                        open(outputFile, 'wb').write(record)
-                print(" ")
+                counts[name] = len(self.bookHeaderRecords[name])
+        self.store = genbook.BookStore(counts, self.getBookPayloadRecord)
+        return genbook.generateBook(self.store, raw, fixedimage, self.workers)
 
     def getFile(self, zipname):
         htmlzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
-        htmlzip.write(os.path.join(self.outdir,"book.html"),"book.html")
-        htmlzip.write(os.path.join(self.outdir,"book.opf"),"book.opf")
-        if os.path.isfile(os.path.join(self.outdir,"cover.jpg")):
-            htmlzip.write(os.path.join(self.outdir,"cover.jpg"),"cover.jpg")
-        htmlzip.write(os.path.join(self.outdir,"style.css"),"style.css")
-        zipUpDir(htmlzip, self.outdir, "img")
+        paths = ["book.html", "book.opf", "cover.jpg", "style.css"]
+        self.store.saveToZip(htmlzip, paths + storePaths(self.store, ["img"]))
         htmlzip.close()
 
     def getBookType(self):
@@ -384,20 +349,26 @@ class TopazBook:
         return ".htmlz"
 
     def getSVGZip(self, zipname):
+        import genbook
+
+        # the svg pages are only built when they are asked for
+        genbook.generateSVG(self.store)
         svgzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
-        svgzip.write(os.path.join(self.outdir,"index_svg.xhtml"),"index_svg.xhtml")
-        zipUpDir(svgzip, self.outdir, "svg")
-        zipUpDir(svgzip, self.outdir, "img")
+        paths = ["index_svg.xhtml"]
+        self.store.saveToZip(svgzip, paths + storePaths(self.store, ["svg", "img"]))
         svgzip.close()
 
     def cleanup(self):
-        if os.path.isdir(self.outdir):
-            shutil.rmtree(self.outdir, True)
+        self.store = None
+        if self.fo is not self.infile:
+            self.fo.close()
+        self.infile.close()
 
 def usage(progname):
     print("Removes DRM protection from Topaz ebooks and extracts the contents")
     print("Usage:")
-    print("    {0} [-k <kindle.k4i>] [-p <comma separated PIDs>] [-s <comma separated Kindle serial numbers>] <infile> <outdir>".format(progname))
+    print("    {0} [-k <kindle.k4i>] [-p <comma separated PIDs>] [-s <comma separated Kindle serial numbers>] [-j <workers>] <infile> <outdir>".format(progname))
+    print("  -j <workers> converts the pages on this many worker processes")
 
 # Main
 def cli_main():
@@ -406,7 +377,7 @@ def cli_main():
     print("TopazExtract v{0}.".format(__version__))
 
     try:
-        opts, args = getopt.getopt(argv[1:], "k:p:s:x")
+        opts, args = getopt.getopt(argv[1:], "k:p:s:xj:")
     except getopt.GetoptError as err:
         print("Error in options or arguments: {0}".format(err.args[0]))
         usage(progname)
@@ -428,6 +399,7 @@ def cli_main():
     kDatabaseFiles = []
     serials = []
     pids = []
+    workers = 0
 
     for o, a in opts:
         if o == '-k':
@@ -442,10 +414,12 @@ def cli_main():
             if a == None :
                 raise DrmException("Invalid parameter for -s")
             serials = [serial.replace(" ","") for serial in a.split(',')]
+        if o == '-j':
+            workers = int(a)
 
     bookname = os.path.splitext(os.path.basename(infile))[0]
 
-    tb = TopazBook(infile)
+    tb = TopazBook(infile, workers)
     title = tb.getBookTitle()
     print("Processing Book: {0}".format(title))
     md1, md2 = tb.getPIDMetaInfo()
@@ -463,7 +437,7 @@ def cli_main():
         zipname = os.path.join(outdir, bookname + "_SVG.zip")
         tb.getSVGZip(zipname)
 
-        # removing internal temporary directory of pieces
+        # release the book and its decrypted records
         tb.cleanup()
 
     except DrmException as e:
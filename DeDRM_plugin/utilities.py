@@ -4,6 +4,7 @@
 #@@CALIBRE_COMPAT_CODE@@
 
 import sys
+import traceback
 
 __license__ = 'GPL v3'
 
@@ -46,4 +47,41 @@ class SafeUnbuffered:
             raise
     def __getattr__(self, attr):
         return getattr(self.stream, attr)
-        
\ No newline at end of file
+
+
+# Lives here rather than in config.py so that the import path can use it
+# without loading the Qt configuration dialog.
+def checkForDeACSMkeys(): 
+        try: 
+            from calibre_plugins.deacsm.libadobeAccount import exportAccountEncryptionKeyDER, getAccountUUID
+        except: 
+            # Looks like DeACSM is not installed. 
+            return None, None
+
+        try:
+            from calibre.ptempfile import TemporaryFile
+       
+
+            acc_uuid = getAccountUUID()
+            if acc_uuid is None: 
+                return None, None
+
+            name = "DeACSM_uuid_" + getAccountUUID()
+
+            # Unfortunately, the DeACSM plugin only has code to export to a file, not to return raw key bytes.
+            # Make a temporary file, have the plugin write to that, then read (& delete) that file.
+
+            with TemporaryFile(suffix='.der') as tmp_key_file:
+                export_result = exportAccountEncryptionKeyDER(tmp_key_file)
+
+                if (export_result is False): 
+                    return None, None
+
+                # Read key file
+                with open(tmp_key_file,'rb') as keyfile:
+                    new_key_value = keyfile.read()
+
+            return new_key_value, name
+        except: 
+            traceback.print_exc()
+            return None, None
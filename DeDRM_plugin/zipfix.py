@@ -25,8 +25,12 @@ import sys, os
 #@@CALIBRE_COMPAT_CODE@@
 
 import zlib
-from . import zipfilerugged
-from .zipfilerugged import ZipInfo, ZeroedZipInfo
+try:
+    from . import zipfilerugged
+    from .zipfilerugged import ZipInfo, ZeroedZipInfo
+except ImportError:
+    import zipfilerugged
+    from zipfilerugged import ZipInfo, ZeroedZipInfo
 from struct import unpack
 
 
@@ -7,24 +7,27 @@ __docformat__ = 'restructuredtext en'
 
 
 import codecs
-import os, traceback, zipfile
+import io, os, traceback, zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from PyQt5.Qt import QToolButton, QUrl
 except ImportError:
     from PyQt4.Qt import QToolButton, QUrl
 
-from calibre.gui2 import open_url, question_dialog
+from calibre.gui2 import open_url, question_dialog, info_dialog
 from calibre.gui2.actions import InterfaceAction
 from calibre.utils.config import config_dir
 from calibre.ptempfile import (PersistentTemporaryDirectory,
                                PersistentTemporaryFile, remove_dir)
 
 from calibre.ebooks.metadata.meta import get_metadata
+from calibre.ebooks.metadata.book.base import Metadata
+from calibre.ebooks.metadata.opf2 import OPF
 
 from calibre_plugins.obok_dedrm.dialogs import (SelectionDialog, DecryptAddProgressDialog,
                                                 AddEpubFormatsProgressDialog, ResultsSummaryDialog)
-from calibre_plugins.obok_dedrm.config import plugin_prefs as cfg
+from calibre_plugins.obok_dedrm.config import plugin_prefs as cfg, imported_volumes
 from calibre_plugins.obok_dedrm.__init__ import (PLUGIN_NAME, PLUGIN_SAFE_NAME,
                                 PLUGIN_VERSION, PLUGIN_DESCRIPTION, HELPFILE_NAME)
 from calibre_plugins.obok_dedrm.utilities import (
@@ -37,6 +40,11 @@ from calibre_plugins.obok_dedrm.obok.legacy_obok import legacy_obok
 
 PLUGIN_ICONS = ['images/obok.png']
 
+# number of Kobo books decrypted at the same time
+DECRYPT_WORKERS = 4
+# number of decrypted books handed to calibre in one add_books call
+ADD_BATCH_SIZE = 50
+
 try:
     debug_print("obok::action_err.py - loading translations")
     load_translations()
@@ -76,6 +84,9 @@ class InterfacePluginAction(InterfaceAction):
         self.add_formats_cancelled = False
         self.tdir = PersistentTemporaryDirectory('_obok', prefix='')
         self.db = self.gui.current_db.new_api
+        self.imported = dict(imported_volumes.get(self.db.library_id, {}))
+        self.book_stamps = {}
+        self.sources = {}
         self.current_idx = self.gui.library_view.currentIndex()
 
         print ('Running {}'.format(PLUGIN_NAME + ' v' + PLUGIN_VERSION))
@@ -110,6 +121,16 @@ class InterfacePluginAction(InterfaceAction):
             msg = _('<p>No books found in Kobo Library\nAre you sure it\'s installed/configured/synchronized?')
             showErrorDlg(msg, None)
             return
+        # Only offer the books that are new or changed since they were imported.
+        count = len(books)
+        books = self.skip_imported_books(books)
+        if count > len(books):
+            print (_('{0} - Skipping {1} books already imported').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION, count - len(books)))
+        if len(books) < 1:
+            self.library.close()
+            msg = _('<p>All {0} books in the Kobo Library have already been imported, and haven\'t changed since.').format(count)
+            info_dialog(self.gui, PLUGIN_NAME + ' v' + PLUGIN_VERSION, msg, show=True)
+            return
 
         # Check to see if a key can be retrieved using the legacy obok method.
         legacy_key = legacy_obok().get_legacy_cookie_id
@@ -137,10 +158,16 @@ class InterfacePluginAction(InterfaceAction):
             books_to_import = dlg.getBooks()
             self.count = len(books_to_import)
             debug_print("InterfacePluginAction::launchObok - number of books to decrypt: %d" % self.count)
+            # Read the page keys and manifests of all the selected books up front.
+            self.library.preload_encryptedfiles(books_to_import)
+            # Start decrypting the books in the background; the progress dialog
+            # collects them in order as they finish.
+            self.start_decrypting(books_to_import)
             # Feed the titles, the callback function (self.get_decrypted_kobo_books)
             # and the Kobo library object to the ProgressDialog dispatcher.
             d = DecryptAddProgressDialog(self.gui, books_to_import, self.get_decrypted_kobo_books, self.library, 'kobo',
                                status_msg_type='Kobo books', action_type=('Decrypting', 'Decryption'))
+            self.stop_decrypting()
             # Canceled the decryption process; clean up and exit.
             if d.wasCanceled():
                 print (_('{} - Decryption canceled by user.').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION))
@@ -155,34 +182,36 @@ class InterfacePluginAction(InterfaceAction):
         # Close Kobo Library object
         self.library.close()
 
-        # If we have decrypted books to work with, feed the list of decrypted books details
-        # and the callback function (self.add_new_books) to the ProgressDialog dispatcher.
-        if len(self.books_to_add):
-            d = DecryptAddProgressDialog(self.gui, self.books_to_add, self.add_new_books, self.db, 'calibre',
-                               status_msg_type='new calibre books', action_type=('Adding','Addition'))
-            # Canceled the "add new books to calibre" process;
-            # show the results of what got added before cancellation.
-            if d.wasCanceled():
-                print (_('{} - "Add books" canceled by user.').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION))
-                self.add_books_cancelled = True
-                print (_('{} - wrapping up results.').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION))
-                self.wrap_up_results()
-                remove_dir(self.tdir)
-                return
-        # If books couldn't be added because of duplicate entries in calibre, ask
-        # if we should try to add the decrypted epubs to existing calibre library entries.
-        if len(self.duplicate_book_list):
-            if cfg['finding_homes_for_formats'] == 'Always':
-                self.process_epub_formats()
-            elif cfg['finding_homes_for_formats'] == 'Never':
-                self.no_home_for_book.extend([entry[0] for entry in self.duplicate_book_list])
-            else:
-                if self.ask_about_inserting_epubs():
-                    # Find homes for the epub decrypted formats in existing calibre library entries.
+        try:
+            # If we have decrypted books to work with, feed the list of decrypted books details
+            # and the callback function (self.add_new_books) to the ProgressDialog dispatcher.
+            if len(self.books_to_add):
+                d = DecryptAddProgressDialog(self.gui, self.books_to_add, self.add_new_books, self.db, 'calibre',
+                                   status_msg_type='new calibre books', action_type=('Adding','Addition'),
+                                   batch_size=ADD_BATCH_SIZE)
+                # Canceled the "add new books to calibre" process;
+                # show the results of what got added before cancellation.
+                if d.wasCanceled():
+                    print (_('{} - "Add books" canceled by user.').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION))
+                    self.add_books_cancelled = True
+            # If books couldn't be added because of duplicate entries in calibre, ask
+            # if we should try to add the decrypted epubs to existing calibre library entries.
+            if len(self.duplicate_book_list) and not self.add_books_cancelled:
+                if cfg['finding_homes_for_formats'] == 'Always':
                     self.process_epub_formats()
-                else:
-                    print (_('{} - User opted not to try to insert EPUB formats').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION))
+                elif cfg['finding_homes_for_formats'] == 'Never':
                     self.no_home_for_book.extend([entry[0] for entry in self.duplicate_book_list])
+                else:
+                    if self.ask_about_inserting_epubs():
+                        # Find homes for the epub decrypted formats in existing calibre library entries.
+                        self.process_epub_formats()
+                    else:
+                        print (_('{} - User opted not to try to insert EPUB formats').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION))
+                        self.no_home_for_book.extend([entry[0] for entry in self.duplicate_book_list])
+        finally:
+            # Save the books imported this time (also when adding was cancelled
+            # or went wrong part way), so they are skipped next time.
+            self.save_imported()
 
         print (_('{} - wrapping up results.').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION))
         self.wrap_up_results()
@@ -210,18 +239,120 @@ class InterfacePluginAction(InterfaceAction):
         '''
         return self.library.books
 
+    def skip_imported_books(self, books):
+        '''
+        Leave out the books that were imported before, if their file hasn't
+        changed since and the calibre book still has its EPUB
+
+        :param books: List of KoboBook objects.
+        '''
+        remaining = []
+        for book in books:
+            try:
+                st = os.stat(book.filename)
+            except OSError:
+                remaining.append(book)
+                continue
+            stamp = [st.st_mtime, st.st_size]
+            self.book_stamps[book.volumeid] = stamp
+            entry = self.imported.get(book.volumeid)
+            if entry is not None and entry[:2] == stamp and self.db.has_format(entry[2], 'EPUB'):
+                continue
+            remaining.append(book)
+        return remaining
+
+    def remember_import(self, path, book_id):
+        '''
+        Record the Kobo book a decrypted epub came from as imported into calibre
+
+        :param path: path to the decrypted epub (temp file)
+        :param book_id: calibre ID of the book the epub was added to.
+        '''
+        volumeid = self.sources.get(path)
+        if volumeid in self.book_stamps:
+            self.imported[volumeid] = self.book_stamps[volumeid] + [book_id]
+
+    def save_imported(self):
+        '''
+        Save the record of imported Kobo books for this calibre library
+        '''
+        imported_volumes[self.db.library_id] = self.imported
+
+    def start_decrypting(self, books):
+        '''
+        Decrypt the books on a pool of worker threads. Books whose keys couldn't be
+        preloaded still need the Kobo database, so they are left to be decrypted
+        on this thread by get_decrypted_kobo_books.
+
+        :param books: List of KoboBook objects to decrypt.
+        '''
+        self.decrypt_pool = ThreadPoolExecutor(max_workers=DECRYPT_WORKERS)
+        self.decrypt_futures = {}
+        for book in books:
+            if book.has_drm and not book.encryptedfiles_loaded:
+                continue
+            self.decrypt_futures[book.volumeid] = self.decrypt_pool.submit(self.decryptBook, book)
+
+    def stop_decrypting(self):
+        '''
+        Drop the books that haven't been started (if the user cancelled)
+        and wait for the ones being decrypted
+        '''
+        for future in self.decrypt_futures.values():
+            future.cancel()
+        self.decrypt_pool.shutdown(wait=True)
+
+    def get_kobo_metadata(self, book, decrypted):
+        '''
+        Build calibre metadata for a decrypted book from its OPF, kept by decryptBook,
+        and what the Kobo database already told us, rather than reading the new epub back in
+
+        :param book: A KoboBook object.
+        :param decrypted: The result of decryptBook for the book.
+        '''
+        if book.coverimage is None or decrypted['opf'] is None:
+            # the book's manifest wasn't read (DRM-free books), so fall back to the epub
+            return get_metadata(decrypted['fileobj'], 'epub')
+        try:
+            mi = OPF(io.BytesIO(decrypted['opf']), basedir=os.path.dirname(book.opffile),
+                     populate_spine=False, read_toc=False).to_book_metadata()
+        except Exception:
+            traceback.print_exc()
+            return get_metadata(decrypted['fileobj'], 'epub')
+        # the Kobo database fills in what the OPF leaves out
+        authors = [author.strip() for author in (book.author or '').split(',') if author.strip()]
+        if mi.is_null('title') and book.title:
+            mi.title = book.title
+        if mi.is_null('authors') and authors:
+            mi.authors = authors
+        if mi.is_null('series') and book.series:
+            mi.series = book.series
+            mi.series_index = book.series_index if book.series_index is not None else 1.0
+        if decrypted['cover'] is not None:
+            mi.cover_data = (os.path.splitext(book.coverimage)[1][1:].lower() or 'jpeg', decrypted['cover'])
+        return mi
+
     def get_decrypted_kobo_books(self, book):
         '''
-        This method is a call-back function used by DecryptAddProgressDialog in dialogs.py to decrypt Kobo books
+        This method is a call-back function used by DecryptAddProgressDialog in dialogs.py to collect
+        decrypted Kobo books from the pool started by start_decrypting
 
         :param book: A KoboBook object that is to be decrypted.
         '''
         print (_('{0} - Decrypting {1}').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION, book.title))
-        decrypted = self.decryptBook(book)
+        try:
+            if book.volumeid in self.decrypt_futures:
+                decrypted = self.decrypt_futures[book.volumeid].result()
+            else:
+                decrypted = self.decryptBook(book)
+        except Exception:
+            traceback.print_exc()
+            decrypted = {'success': False, 'fileobj': None, 'cover': None, 'opf': None}
         if decrypted['success']:
             # Build a list of calibre "book maps" for calibre's add_book function.
-            mi = get_metadata(decrypted['fileobj'], 'epub')
+            mi = self.get_kobo_metadata(book, decrypted)
             bookmap = {'EPUB':decrypted['fileobj'].name}
+            self.sources[bookmap['EPUB']] = book.volumeid
             self.books_to_add.append((mi, bookmap))
         else:
             # Book is probably still encrypted.
@@ -233,7 +364,8 @@ class InterfacePluginAction(InterfaceAction):
     def add_new_books(self, books_to_add):
         '''
         This method is a call-back function used by DecryptAddProgressDialog in dialogs.py to add books to calibre
-        (It's set up to handle multiple books, but will only be fed books one at a time by DecryptAddProgressDialog)
+        (DecryptAddProgressDialog feeds it batches of up to ADD_BATCH_SIZE books)
+        Returns the bookmaps that were added and the ones that weren't (duplicates)
 
         :param books_to_add: List of calibre bookmaps (created in get_decrypted_kobo_books)
         '''
@@ -241,18 +373,18 @@ class InterfacePluginAction(InterfaceAction):
         cfg_add_duplicates = (cfg['finding_homes_for_formats'] == 'Add new entry')
 
         added = self.db.add_books(books_to_add, add_duplicates=cfg_add_duplicates, run_hooks=False)
-        if len(added[0]):
-            # Record the id(s) that got added
-            for id in added[0]:
-                print (_('{0} - Added {1}').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION, books_to_add[0][0].title))
-                self.ids_of_new_books.append((id, books_to_add[0][0]))
-        if len(added[1]):
-            # Build a list of details about the books that didn't get added because duplicate were detected.
-            for mi, map in added[1]:
-                print (_('{0} - {1} already exists. Will try to add format later.').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION, mi.title))
-                self.duplicate_book_list.append((mi, map['EPUB'], _('duplicate detected')))
-            return False
-        return True
+        # The id(s) that got added are in the order of the books that weren't duplicates
+        duplicates = set(id(mi) for mi, map in added[1])
+        new_books = [(mi, map) for mi, map in books_to_add if id(mi) not in duplicates]
+        for book_id, (mi, map) in zip(added[0], new_books):
+            print (_('{0} - Added {1}').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION, mi.title))
+            self.ids_of_new_books.append((book_id, mi))
+            self.remember_import(map['EPUB'], book_id)
+        # Build a list of details about the books that didn't get added because duplicate were detected.
+        for mi, map in added[1]:
+            print (_('{0} - {1} already exists. Will try to add format later.').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION, mi.title))
+            self.duplicate_book_list.append((mi, map['EPUB'], _('duplicate detected')))
+        return new_books, list(added[1])
 
     def add_epub_format(self, book_id, mi, path):
         '''
@@ -264,6 +396,7 @@ class InterfacePluginAction(InterfaceAction):
         '''
         if self.db.add_format(book_id, 'EPUB', path, replace=False, run_hooks=False):
             self.successful_format_adds.append((book_id, mi))
+            self.remember_import(path, book_id)
             print (_('{0} - Successfully added EPUB format to existing {1}').format(PLUGIN_NAME + ' v' + PLUGIN_VERSION, mi.title))
             return True
         # we really shouldn't get here.
@@ -373,6 +506,8 @@ class InterfacePluginAction(InterfaceAction):
         result = {}
         result['success'] = False
         result['fileobj'] = None
+        result['cover'] = None
+        result['opf'] = None
 
         try:
             zin = zipfile.ZipFile(book.filename, 'r')
@@ -380,7 +515,9 @@ class InterfacePluginAction(InterfaceAction):
             print (_('{0} - File "{1}" not found. Make sure the eBook has been properly downloaded in the Kobo app.').format(PLUGIN_NAME, book.filename))
             return result
         #print ('Kobo library filename: {0}'.format(book.filename))
-        for userkey in self.userkeys:
+        # Only keys that decrypt a small sample of the book are tried on all of it,
+        # starting with the key that worked for the previous book.
+        for userkey in book.userkeys_to_try(zin, self.library.preferred_userkeys(self.userkeys)):
             print (_('Trying key: '), codecs.encode(userkey, 'hex'))
             try:
                 fileout = PersistentTemporaryFile('.epub', dir=self.tdir)
@@ -396,16 +533,16 @@ class InterfacePluginAction(InterfaceAction):
                     pass
                 zout.writestr('mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
                 # end of mimetype mod
-                for filename in members:
-                    contents = zin.read(filename)
-                    if filename in book.encryptedfiles:
-                        file = book.encryptedfiles[filename]
-                        contents = file.decrypt(userkey, contents)
-                        # Parse failures mean the key is probably wrong.
-                        file.check(contents)
+                # Parse failures mean the key is probably wrong.
+                for filename, contents in book.decrypt_many(userkey, zin, members):
+                    if filename == book.coverimage:
+                        result['cover'] = contents
+                    elif filename == book.opffile:
+                        result['opf'] = contents
                     zout.writestr(filename, contents)
                 zout.close()
                 zin.close()
+                self.library.lastuserkey = userkey
                 result['success'] = True
                 result['fileobj'] = fileout
                 print ('Success!')
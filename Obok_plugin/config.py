@@ -14,6 +14,10 @@ plugin_prefs.defaults['finding_homes_for_formats'] = 'Ask'
 plugin_prefs.defaults['kobo_serials'] = []
 plugin_prefs.defaults['kobo_directory'] = u''
 
+# For each calibre library (by library id), the Kobo books already imported:
+# volume ID -> [mtime, size, calibre book id] of the Kobo file when it was imported.
+imported_volumes = JSONConfig('plugins/obok_dedrm_imported')
+
 from calibre_plugins.obok_dedrm.__init__ import PLUGIN_NAME, PLUGIN_VERSION
 from calibre_plugins.obok_dedrm.utilities import (debug_print)
 try:
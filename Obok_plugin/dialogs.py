@@ -221,9 +221,9 @@ class BookListTableWidget(QTableWidget):
 class DecryptAddProgressDialog(QProgressDialog):
     '''
     Use the QTimer singleShot method to dole out books one at
-    a time to the indicated callback function from action.py
+    a time (or calibre books in batches) to the indicated callback function from action.py
     '''
-    def __init__(self, gui, indices, callback_fn, db, db_type='calibre', status_msg_type='books', action_type=('Decrypting','Decryption')):
+    def __init__(self, gui, indices, callback_fn, db, db_type='calibre', status_msg_type='books', action_type=('Decrypting','Decryption'), batch_size=1):
         '''
         :param gui: Parent gui
         :param indices: List of Kobo books or list calibre book maps (indicated by param db_type)
@@ -232,9 +232,12 @@ class DecryptAddProgressDialog(QProgressDialog):
         :param db_type: string indicating what kind of database param db is
         :param status_msg_type: string to indicate what the ProgressDialog is operating on (cosmetic only)
         :param action_type: 2-Tuple of strings indicating what the ProgressDialog is doing to param status_msg_type (cosmetic only)
+        :param batch_size: number of calibre book maps to give the callback function at a time
+                           (a batch is added in one go, so cancelling takes effect after the current batch)
         '''
 
         self.total_count = len(indices)
+        self.batch_size = batch_size
         QProgressDialog.__init__(self, '', 'Cancel', 0, self.total_count, gui)
         self.setMinimumWidth(500)
         self.indices, self.callback_fn, self.db, self.db_type = indices, callback_fn, db, db_type
@@ -250,23 +253,30 @@ class DecryptAddProgressDialog(QProgressDialog):
             return self.do_close()
         if self.i >= self.total_count:
             return self.do_close()
-        book = self.indices[self.i]
-        self.i += 1
+        if self.db_type == 'calibre':
+            books = self.indices[self.i:self.i + self.batch_size]
+            book = books[0]
+            self.i += len(books)
+        else:
+            book = self.indices[self.i]
+            self.i += 1
 
         # Get the title and build the caption and label text from the string parameters provided
         if self.db_type == 'calibre':
             dtitle = book[0].title
+            if len(books) > 1:
+                dtitle = '{0} (+{1})'.format(dtitle, len(books) - 1)
         elif self.db_type == 'kobo':
             dtitle = book.title
         self.setWindowTitle('{0} {1} {2}  ({3} {4} failures)...'.format(self.action_type[0], self.total_count,
                                                                 self.status_msg_type, len(self.failures), self.action_type[1]))
         self.setLabelText('{0}: {1}'.format(self.action_type[0], dtitle))
-        # If a calibre db, feed the calibre bookmap to action.py's add_new_books method
+        # If a calibre db, feed the calibre bookmaps to action.py's add_new_books method,
+        # which tells us which of them were added and which weren't
         if self.db_type == 'calibre':
-            if self.callback_fn([book]):
-                self.successes.append(book)
-            else:
-                self.failures.append(book)
+            added, not_added = self.callback_fn(books)
+            self.successes.extend(added)
+            self.failures.extend(not_added)
         # If a kobo db, feed the index to the kobo book to action.py's get_decrypted_kobo_books method
         elif self.db_type == 'kobo':
             if self.callback_fn(book):
@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+# Version 10.1.0 October 2026
+# Open the Kobo database read-only in place instead of copying it to a
+# temporary file every time; fall back to a copy cached on mtime and size.
+# On Linux, look for Kobo Desktop in the usual Wine/Proton prefixes before
+# a bounded search, and check the cached location is still good.
+#
 # Version 10.0.3 July 2022
 # Fix Calibre 6
 #
@@ -168,7 +174,7 @@
 """Manage all Kobo books, either encrypted or DRM-free."""
 from __future__ import print_function
 
-__version__ = '10.0.9'
+__version__ = '10.1.0'
 __about__ =  "Obok v{0}\nCopyright © 2012-2023 Physisticated et al.".format(__version__)
 
 import sys
@@ -185,6 +191,19 @@ import string
 import shutil
 import argparse
 import tempfile
+import atexit
+import glob
+import collections
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
 
 try:
     from Cryptodome.Cipher import AES
@@ -214,6 +233,86 @@ KOBO_HASH_KEYS = ['88b3a2e13', 'XzUhGYdFp', 'NoCanLook','QJhwzAtXL']
 class ENCRYPTIONError(Exception):
     pass
 
+# Copies of Kobo databases that could not be opened in place, keyed by
+# database path, with the (mtime, size) of the database and its journals
+# they were made from.
+_dbcopies = {}
+
+# The files SQLite keeps next to a database: a WAL (which the Kobo apps
+# use) or a rollback journal holds changes not yet in the database file.
+# The shared memory index of a WAL is rebuilt by SQLite, so isn't copied.
+_dbjournals = ('-wal', '-journal')
+
+def _removedbcopy(copyname):
+    for suffix in ('',) + _dbjournals + ('-shm',):
+        try:
+            os.remove(copyname + suffix)
+        except OSError:
+            pass
+
+def _removedbcopies():
+    for stamp, copyname in _dbcopies.values():
+        _removedbcopy(copyname)
+    _dbcopies.clear()
+
+atexit.register(_removedbcopies)
+
+def _dbstamp(kobodb):
+    """The (mtime, size) of a database and of each of its journals,
+    None for journals that don't exist or are empty."""
+    stamp = []
+    for suffix in ('',) + _dbjournals:
+        try:
+            st = os.stat(kobodb + suffix)
+        except OSError:
+            stamp.append(None)
+            continue
+        stamp.append((st.st_mtime, st.st_size) if st.st_size > 0 or suffix == '' else None)
+    return tuple(stamp)
+
+def opendb(kobodb):
+    """Open a Kobo database read-only.
+
+    When there is no WAL or rollback journal with changes in it, the
+    database is opened in place with immutable=1, which reads only the
+    main database file. Otherwise that would miss the latest changes
+    (or see half made ones), so the database is copied along with its
+    journal, which SQLite applies when it opens the copy. Without a WAL
+    the copy's header is set to the legacy journal mode. The copy is
+    reused for as long as the modification times and sizes of the
+    database and its journals don't change."""
+    stamp = _dbstamp(kobodb)
+    if stamp[1:] == (None,) * len(_dbjournals):
+        try:
+            uri = 'file:{0}?mode=ro&immutable=1'.format(pathname2url(os.path.abspath(kobodb)))
+            db = sqlite3.connect(uri, uri=True)
+            db.execute('SELECT count(*) FROM sqlite_master').fetchone()
+            return db
+        except (sqlite3.Error, TypeError):
+            pass
+
+    cached = _dbcopies.get(kobodb)
+    if cached is None or cached[0] != stamp or not os.path.isfile(cached[1]):
+        if cached is not None:
+            _removedbcopy(cached[1])
+        # make a copy of the database in a temporary file,
+        # with the journal that has the changes not yet in it.
+        newdb = tempfile.NamedTemporaryFile(mode='wb', delete=False)
+        print(newdb.name)
+        with open(kobodb, 'rb') as olddb:
+            if stamp[1] is None:
+                # no WAL, so make sure the copy isn't using WAL logging
+                newdb.write(olddb.read(18))
+                newdb.write(b'\x01\x01')
+                olddb.read(2)
+            shutil.copyfileobj(olddb, newdb)
+        newdb.close()
+        for suffix, journalstamp in zip(_dbjournals, stamp[1:]):
+            if journalstamp is not None:
+                shutil.copyfile(kobodb + suffix, newdb.name + suffix)
+        cached = _dbcopies[kobodb] = (stamp, newdb.name)
+    return sqlite3.connect(cached[1])
+
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
 # encoded using "replace" before writing them.
@@ -239,6 +338,132 @@ class SafeUnbuffered:
         return getattr(self.stream, attr)
 
 
+# Where Kobo Desktop keeps its data inside a Wine prefix, for each Windows user
+KOBO_WINE_DIRS = [
+    os.path.join("drive_c", "users", "*", "AppData", "Local", "Kobo", "Kobo Desktop Edition"),
+    os.path.join("drive_c", "users", "*", "Local Settings", "Application Data", "Kobo", "Kobo Desktop Edition"),
+]
+
+# Limits on the search for Kobo.sqlite when it isn't in any of the usual places
+KOBO_SEARCH_DEPTH = 8
+KOBO_SEARCH_DIRS = 20000
+
+def linuxwineprefixes():
+    """The Wine prefixes Kobo Desktop is likely to be installed in:
+    WINEPREFIX, the default prefix, and the prefixes made by Proton
+    (Steam), Lutris, Bottles and PlayOnLinux."""
+    home = os.path.expanduser("~")
+    datahome = os.environ.get("XDG_DATA_HOME") or os.path.join(home, ".local", "share")
+    prefixes = []
+    if os.environ.get("WINEPREFIX"):
+        prefixes.append(os.environ["WINEPREFIX"])
+    prefixes.append(os.path.join(home, ".wine"))
+    for pattern in [os.path.join(datahome, "wineprefixes", "*"),
+                    os.path.join(home, ".steam", "steam", "steamapps", "compatdata", "*", "pfx"),
+                    os.path.join(datahome, "Steam", "steamapps", "compatdata", "*", "pfx"),
+                    os.path.join(home, "Games", "*"),
+                    os.path.join(datahome, "bottles", "bottles", "*"),
+                    os.path.join(home, ".PlayOnLinux", "wineprefix", "*")]:
+        prefixes.extend(sorted(glob.glob(pattern)))
+    return prefixes
+
+def linuxkobodirs():
+    """The directories with a Kobo.sqlite in the usual places Kobo
+    Desktop is found on Linux: the Wine prefixes, then the XDG data
+    and config directories."""
+    home = os.path.expanduser("~")
+    candidates = []
+    for prefix in linuxwineprefixes():
+        for subdir in KOBO_WINE_DIRS:
+            candidates.extend(sorted(glob.glob(os.path.join(prefix, subdir))))
+    for base in [os.environ.get("XDG_DATA_HOME") or os.path.join(home, ".local", "share"),
+                 os.environ.get("XDG_CONFIG_HOME") or os.path.join(home, ".config")]:
+        candidates.append(os.path.join(base, "Kobo", "Kobo Desktop Edition"))
+    return [kobodir for kobodir in candidates if os.path.isfile(os.path.join(kobodir, "Kobo.sqlite"))]
+
+def searchkobodir(top, maxdepth = KOBO_SEARCH_DEPTH, maxdirs = KOBO_SEARCH_DIRS):
+    """Search the directory tree under top, breadth first, for the first
+    directory with a Kobo.sqlite in it. The search stays on the filesystem
+    top is on (so it doesn't wander into network mounts), doesn't follow
+    symbolic links, and gives up after maxdirs directories or maxdepth
+    levels. Returns the directory, or None."""
+    try:
+        device = os.stat(top).st_dev
+    except OSError:
+        return None
+    queue = collections.deque([(top, 0)])
+    visited = 0
+    while queue and visited < maxdirs:
+        dirname, depth = queue.popleft()
+        visited += 1
+        subdirs = []
+        try:
+            for entry in os.scandir(dirname):
+                if entry.name == "Kobo.sqlite" and entry.is_file():
+                    return dirname
+                if depth < maxdepth and entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+        except OSError:
+            continue
+        for subdir in subdirs:
+            try:
+                if os.lstat(subdir).st_dev != device:
+                    continue
+            except OSError:
+                continue
+            queue.append((subdir, depth + 1))
+    return None
+
+def linuxkobodir():
+    """Find the Kobo Desktop directory on Linux.
+
+    The location found is cached in ~/.config/calibre/kobo location,
+    with the modification time of its Kobo.sqlite. The cached location is
+    used as it is while its database is unchanged; otherwise the most
+    recently modified database of it and the usual places is used, and
+    only if there is none is the home directory, then the root
+    filesystem, searched. Returns u"" if nothing is found."""
+    cachedir = os.path.join(os.path.expanduser("~"), ".config", "calibre")
+    cachefile = os.path.join(cachedir, "kobo location")
+    cached = None
+    cachedmtime = None
+    try:
+        with open(cachefile, 'r') as f:
+            lines = f.read().splitlines()
+        cached = lines[0]
+        cachedmtime = float(lines[1])
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+
+    def dbmtime(kobodir):
+        try:
+            return os.path.getmtime(os.path.join(kobodir, "Kobo.sqlite"))
+        except OSError:
+            return None
+
+    if cached and cachedmtime is not None and dbmtime(cached) == cachedmtime:
+        return cached
+
+    candidates = linuxkobodirs()
+    if cached and dbmtime(cached) is not None:
+        candidates.append(cached)
+    if candidates:
+        kobodir = max(candidates, key=dbmtime)
+    else:
+        kobodir = searchkobodir(os.path.expanduser("~")) or searchkobodir("/")
+    if kobodir is None:
+        return u""
+
+    try:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        with open(cachefile, 'w') as f:
+            f.write("{0}\n{1!r}\n".format(kobodir, dbmtime(kobodir)))
+    except (IOError, OSError):
+        pass
+    return kobodir
+
+
 class KoboLibrary(object):
     """The Kobo library.
 
@@ -327,31 +552,7 @@ class KoboLibrary(object):
                 elif sys.platform.startswith('darwin'):
                     self.kobodir = os.path.join(os.environ['HOME'], "Library", "Application Support", "Kobo", "Kobo Desktop Edition")
                 elif sys.platform.startswith('linux'):
-
-                    #sets ~/.config/calibre as the location to store the kobodir location info file and creates this directory if necessary
-                    kobodir_cache_dir = os.path.join(os.environ['HOME'], ".config", "calibre")
-                    if not os.path.isdir(kobodir_cache_dir):
-                        os.mkdir(kobodir_cache_dir)
-                    
-                    #appends the name of the file we're storing the kobodir location info to the above path
-                    kobodir_cache_file = str(kobodir_cache_dir) + "/" + "kobo location"
-                    
-                    """if the above file does not exist, recursively searches from the root
-                    of the filesystem until kobodir is found and stores the location of kobodir
-                    in that file so this loop can be skipped in the future"""
-                    original_stdout = sys.stdout
-                    if not os.path.isfile(kobodir_cache_file):
-                        for root, dirs, files in os.walk('/'):
-                            for file in files:
-                                if file == 'Kobo.sqlite':
-                                    kobo_linux_path = str(root)
-                                    with open(kobodir_cache_file, 'w') as f:
-                                        sys.stdout = f
-                                        print(kobo_linux_path, end='')
-                                        sys.stdout = original_stdout
-
-                    f = open(kobodir_cache_file, 'r' )
-                    self.kobodir = f.read()
+                    self.kobodir = linuxkobodir()
 
             # desktop versions use Kobo.sqlite
             kobodb = os.path.join(self.kobodir, "Kobo.sqlite")
@@ -363,31 +564,19 @@ class KoboLibrary(object):
 
         if (self.kobodir != u""):
             self.bookdir = os.path.join(self.kobodir, "kepub")
-            # make a copy of the database in a temporary file
-            # so we can ensure it's not using WAL logging which sqlite3 can't do.
-            self.newdb = tempfile.NamedTemporaryFile(mode='wb', delete=False)
-            print(self.newdb.name)
-            olddb = open(kobodb, 'rb')
-            self.newdb.write(olddb.read(18))
-            self.newdb.write(b'\x01\x01')
-            olddb.read(2)
-            self.newdb.write(olddb.read())
-            olddb.close()
-            self.newdb.close()
-            self.__sqlite = sqlite3.connect(self.newdb.name)
+            self.__sqlite = opendb(kobodb)
             self.__sqlite.text_factory = lambda b: b.decode("utf-8", errors="ignore")
             self.__cursor = self.__sqlite.cursor()
             self._userkeys = []
+            self.lastuserkey = None
             self._books = []
-            self._volumeID = []
+            self._volumeID = set()
             self._serials = serials
 
     def close (self):
         """Closes the database used by the library."""
         self.__cursor.close()
         self.__sqlite.close()
-        # delete the temporary copy of the database
-        os.remove(self.newdb.name)
 
     @property
     def userkeys (self):
@@ -406,21 +595,82 @@ class KoboLibrary(object):
         if len(self._books) != 0:
             return self._books
         """Drm-ed kepub"""
-        for row in self.__cursor.execute('SELECT DISTINCT volumeid, Title, Attribution, Series FROM content_keys, content WHERE contentid = volumeid'):
-            self._books.append(KoboBook(row[0], row[1], self.__bookfile(row[0]), 'kepub', self.__cursor, author=row[2], series=row[3]))
-            self._volumeID.append(row[0])
+        for row in self.__cursor.execute('SELECT DISTINCT volumeid, Title, Attribution, Series, {0} FROM content_keys, content WHERE contentid = volumeid'.format(self.__seriesnumber())):
+            self._books.append(KoboBook(row[0], row[1], self.__bookfile(row[0]), 'kepub', self.__cursor, author=row[2], series=row[3], seriesnumber=row[4]))
+            self._volumeID.add(row[0])
         """Drm-free"""
-        for f in os.listdir(self.bookdir):
-            if(f not in self._volumeID):
-                row = self.__cursor.execute("SELECT Title, Attribution, Series FROM content WHERE ContentID = '" + f + "'").fetchone()
-                if row is not None:
-                    fTitle = row[0]
-                    self._books.append(KoboBook(f, fTitle, self.__bookfile(f), 'drm-free', self.__cursor, author=row[1], series=row[2]))
-                    self._volumeID.append(f)
+        files = [f for f in os.listdir(self.bookdir) if f not in self._volumeID]
+        for f, row in self.__getcontent(files):
+            self._books.append(KoboBook(f, row[0], self.__bookfile(f), 'drm-free', self.__cursor, author=row[1], series=row[2], seriesnumber=row[3]))
+            self._volumeID.add(f)
         """Sort"""
         self._books.sort(key=lambda x: x.title)
         return self._books
 
+    def preferred_userkeys (self, userkeys = None):
+        """The userkeys (by default this library's own) in the order they
+        should be tried, starting with the key that last decrypted a book."""
+        if userkeys is None:
+            userkeys = self.userkeys
+        if self.lastuserkey is None or self.lastuserkey not in userkeys:
+            return list(userkeys)
+        return [self.lastuserkey] + [userkey for userkey in userkeys if userkey != self.lastuserkey]
+
+    def preload_encryptedfiles (self, books = None, workers = 4):
+        """Load the encrypted file lists of many books at once.
+
+        The page keys of all the books are read with one query on
+        content_keys (batched like the book list), and the OPF manifests
+        that give the files' MIME types are parsed on a pool of worker
+        threads. A book that fails to load has its error printed and kept,
+        and raised again when its encryptedfiles are first used, so it is
+        reported as that book's failure."""
+        if books is None:
+            books = self.books
+        books = [book for book in books if book.has_drm and not book.encryptedfiles_loaded]
+        if len(books) == 0:
+            return
+        volumeids = [book.volumeid for book in books]
+        rows = dict((volumeid, []) for volumeid in volumeids)
+        for start in range(0, len(volumeids), 500):
+            chunk = volumeids[start:start + 500]
+            query = 'SELECT volumeid, elementid, elementkey FROM content_keys, content WHERE volumeid IN ({0}) AND volumeid = contentid'.format(','.join('?' * len(chunk)))
+            for row in self.__cursor.execute(query, chunk):
+                rows[row[0]].append(row[1:])
+
+        def load(book):
+            try:
+                book.set_encryptedfiles(rows[book.volumeid])
+            except Exception as e:
+                print("Could not read the file list of {0}: {1}".format(book.title, e))
+                book.encryptedfiles_error = e
+
+        if ThreadPoolExecutor is None or workers < 2 or len(books) < 2:
+            for book in books:
+                load(book)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(load, books))
+
+    def __seriesnumber (self):
+        """The column with the number of a book in its series, older
+        databases don't have one."""
+        columns = [row[1] for row in self.__cursor.execute('PRAGMA table_info(content)')]
+        return 'SeriesNumber' if 'SeriesNumber' in columns else 'NULL'
+
+    def __getcontent (self, contentids):
+        """The (ContentID, (Title, Attribution, Series, SeriesNumber)) of every
+        given content id that is in the database, in the order given."""
+        rows = {}
+        seriesnumber = self.__seriesnumber()
+        # stay below the smallest sqlite limit on query parameters
+        for start in range(0, len(contentids), 500):
+            chunk = contentids[start:start + 500]
+            query = 'SELECT ContentID, Title, Attribution, Series, {0} FROM content WHERE ContentID IN ({1})'.format(seriesnumber, ','.join('?' * len(chunk)))
+            for row in self.__cursor.execute(query, chunk):
+                rows.setdefault(row[0], row[1:])
+        return [(f, rows[f]) for f in contentids if f in rows]
+
     def __bookfile (self, volumeid):
         """The filename needed to open a given book."""
         return os.path.join(self.kobodir, "kepub", volumeid)
@@ -512,16 +762,27 @@ class KoboBook(object):
     title - the human-readable book title.
     filename - the complete path and filename of the book.
     type - either kepub or drm-free"""
-    def __init__ (self, volumeid, title, filename, type, cursor, author=None, series=None):
+    def __init__ (self, volumeid, title, filename, type, cursor, author=None, series=None, seriesnumber=None):
         self.volumeid = volumeid
         self.title = title
         self.author = author
         self.series = series
         self.series_index = None
+        if series and seriesnumber:
+            try:
+                self.series_index = float(seriesnumber)
+            except ValueError:
+                pass
         self.filename = filename
         self.type = type
         self.__cursor = cursor
         self._encryptedfiles = {}
+        self.encryptedfiles_loaded = False
+        # the error that stopped preload_encryptedfiles loading them
+        self.encryptedfiles_error = None
+        # paths of the OPF and the cover image in the book zip, once the OPF has been read
+        self.opffile = None
+        self.coverimage = None
 
     @property
     def encryptedfiles (self):
@@ -531,11 +792,21 @@ class KoboBook(object):
         the same as the pathnames inside the book 'zip' file."""
         if (self.type == 'drm-free'):
             return self._encryptedfiles
-        if len(self._encryptedfiles) != 0:
+        if self.encryptedfiles_loaded:
             return self._encryptedfiles
+        if self.encryptedfiles_error is not None:
+            raise self.encryptedfiles_error
         # Read the list of encrypted files from the DB
-        for row in self.__cursor.execute('SELECT elementid,elementkey FROM content_keys,content WHERE volumeid = ? AND volumeid = contentid',(self.volumeid,)):
-            self._encryptedfiles[row[0]] = KoboFile(row[0], None, base64.b64decode(row[1]))
+        rows = self.__cursor.execute('SELECT elementid,elementkey FROM content_keys,content WHERE volumeid = ? AND volumeid = contentid',(self.volumeid,)).fetchall()
+        self.set_encryptedfiles(rows)
+        return self._encryptedfiles
+
+    def set_encryptedfiles (self, rows):
+        """Build the dictionary of KoboFiles from the (elementid, elementkey)
+        rows of content_keys for this book."""
+        encryptedfiles = {}
+        for row in rows:
+            encryptedfiles[row[0]] = KoboFile(row[0], None, base64.b64decode(row[1]))
 
         # Read the list of files from the kepub OPF manifest so that
         # we can get their proper MIME type.
@@ -550,6 +821,12 @@ class KoboBook(object):
         basedir = re.sub('[^/]+$', '', opffile)
         opf = ET.fromstring(zin.read(opffile))
         zin.close()
+        self.opffile = opffile
+
+        coverid = None
+        for meta in opf.findall('.//opf:meta', xmlns):
+            if meta.attrib.get('name') == 'cover':
+                coverid = meta.attrib.get('content')
 
         c = re.compile('/')
         for item in opf.findall('.//opf:item', xmlns):
@@ -560,15 +837,77 @@ class KoboBook(object):
             if not c.match(href):
                 href = ''.join((basedir, href))
 
+            if item.attrib.get('id') == coverid or 'cover-image' in item.attrib.get('properties', '').split():
+                self.coverimage = href
+
             # Update books we've found from the DB.
-            if href in self._encryptedfiles:
-                self._encryptedfiles[href].mimetype = mimetype
-        return self._encryptedfiles
+            if href in encryptedfiles:
+                encryptedfiles[href].mimetype = mimetype
+        self._encryptedfiles = encryptedfiles
+        self.encryptedfiles_loaded = True
 
     @property
     def has_drm (self):
         return not self.type == 'drm-free'
 
+    def decrypt_many (self, userkey, zin, filenames = None):
+        """Yield (filename, contents) for the members of the book zip zin
+        (all of them, or those in filenames), with the encrypted ones
+        decrypted with userkey and checked. A failed check raises
+        ValueError, which means the key is probably wrong."""
+        if filenames is None:
+            filenames = zin.namelist()
+        encryptedfiles = self.encryptedfiles
+        for filename in filenames:
+            contents = zin.read(filename)
+            file = encryptedfiles.get(filename)
+            if file is not None:
+                contents = file.decrypt(userkey, contents)
+                file.check(contents)
+            yield filename, contents
+
+    def userkeys_to_try (self, zin, userkeys):
+        """The keys from userkeys that decrypt this book correctly, as far as
+        can be told without decrypting all of it.
+
+        Each key is tried on just the smallest encrypted file whose content
+        can be checked (xhtml or jpeg), so a wrong key is rejected without
+        writing out the whole book. Keys are yielded as they pass; if the
+        book has no checkable file every key is yielded."""
+        probe = None
+        for filename, file in self.encryptedfiles.items():
+            if file.mimetype not in ('application/xhtml+xml', 'image/jpeg'):
+                continue
+            try:
+                size = zin.getinfo(filename).file_size
+            except KeyError:
+                continue
+            # too short a file can't be checked reliably
+            if size >= 64 and (probe is None or size < probe[0]):
+                probe = (size, filename, file)
+        if probe is None:
+            for userkey in userkeys:
+                yield userkey
+            return
+        size, filename, file = probe
+        contents = zin.read(filename)
+        for userkey in userkeys:
+            try:
+                file.check(file.decrypt(userkey, contents))
+            except (ValueError, IndexError):
+                print("Key {0} does not decrypt {1}".format(userkey.hex(), filename))
+                continue
+            yield userkey
+
+
+# AES ciphers for user keys, which are shared by every file of the library
+_userciphers = {}
+
+def usercipher(userkey):
+    cipher = _userciphers.get(userkey)
+    if cipher is None:
+        cipher = _userciphers[userkey] = AES.new(userkey, AES.MODE_ECB)
+    return cipher
 
 class KoboFile(object):
     """An encrypted file in a KoboBook.
@@ -582,15 +921,27 @@ class KoboFile(object):
         self.filename = filename
         self.mimetype = mimetype
         self.key = key
+        # page key ciphers, by the user key that unwrapped them
+        self._ciphers = {}
+
+    def pagecipher (self, userkey):
+        """The cipher for this file's content, using the page key
+        unwrapped with userkey. Unwrapped keys are kept for reuse."""
+        cipher = self._ciphers.get(userkey)
+        if cipher is None:
+            # The userkey decrypts the page key (self.key)
+            decryptedkey = usercipher(userkey).decrypt(self.key)
+            cipher = AES.new(decryptedkey, AES.MODE_ECB)
+            self._ciphers[userkey] = cipher
+        return cipher
+
     def decrypt (self, userkey, contents):
         """
         Decrypt the contents using the provided user key and the
         file page key. The caller must determine if the decrypted
         data is correct."""
-        # The userkey decrypts the page key (self.key)
-        decryptedkey = AES.new(userkey, AES.MODE_ECB).decrypt(self.key)
         # The decrypted page key decrypts the content. Padding is PKCS#7
-        return unpad(AES.new(decryptedkey, AES.MODE_ECB).decrypt(contents), 16)
+        return unpad(self.pagecipher(userkey).decrypt(contents), 16)
 
     def check (self, contents):
         """
@@ -672,24 +1023,20 @@ def decrypt_book(book, lib):
         print("Book saved as {0}".format(os.path.join(os.getcwd(), outname)))
         return 0
     result = 1
-    for userkey in lib.userkeys:
+    for userkey in book.userkeys_to_try(zin, lib.preferred_userkeys()):
         print("Trying key: {0}".format(userkey.hex()))
         try:
             zout = zipfile.ZipFile(outname, "w", zipfile.ZIP_DEFLATED)
-            for filename in zin.namelist():
-                contents = zin.read(filename)
-                if filename in book.encryptedfiles:
-                    file = book.encryptedfiles[filename]
-                    contents = file.decrypt(userkey, contents)
-                    # Parse failures mean the key is probably wrong.
-                    file.check(contents)
+            # Parse failures mean the key is probably wrong.
+            for filename, contents in book.decrypt_many(userkey, zin):
                 zout.writestr(filename, contents)
             zout.close()
             print("Decryption succeeded.")
             print("Book saved as {0}".format(os.path.join(os.getcwd(), outname)))
+            lib.lastuserkey = userkey
             result = 0
             break
-        except ValueError:
+        except (ValueError, IndexError):
             print("Decryption failed.")
             zout.close()
             os.remove(outname)
@@ -729,6 +1076,7 @@ def cli_main():
                 print("Invalid choice. Exiting...")
                 sys.exit()
 
+    lib.preload_encryptedfiles(books)
     results = [decrypt_book(book, lib) for book in books]
     lib.close()
     overall_result = all(result != 0 for result in results)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Shared fixtures for the DeDRM tests.
+#
+# The plugin only works once make_release.py has patched the calibre compat
+# code into it, so tests that run the plugin build a release-style
+# DeDRM_plugin.zip from the source tree first.
+
+import os, sys, shutil, subprocess, zipfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_DIR = os.path.join(REPO_DIR, "DeDRM_plugin")
+
+sys.path.insert(0, REPO_DIR)
+import make_release
+
+
+def build_plugin(dest_dir):
+    # Copy the plugin and patch it the same way make_release.py does,
+    # then zip it up like the released DeDRM_plugin.zip.
+    src_dir = os.path.join(dest_dir, "DeDRM_plugin")
+    shutil.copytree(PLUGIN_DIR, src_dir, ignore=shutil.ignore_patterns("__pycache__"))
+
+    cwd = os.getcwd()
+    os.chdir(REPO_DIR)
+    try:
+        for root, dirs, files in os.walk(src_dir):
+            for name in files:
+                if name.endswith(".py"):
+                    make_release.patch_file(os.path.join(root, name))
+    finally:
+        os.chdir(cwd)
+
+    zip_path = os.path.join(dest_dir, "DeDRM_plugin.zip")
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for root, dirs, files in os.walk(src_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                zf.write(path, os.path.relpath(path, src_dir))
+    return zip_path
+
+
+@pytest.fixture(scope="session")
+def plugin_zip(tmp_path_factory):
+    return build_plugin(str(tmp_path_factory.mktemp("release")))
+
+
+@pytest.fixture
+def run_plugin(plugin_zip, tmp_path):
+    # Runs "python3 DeDRM_plugin.zip <args>" in tmp_path, with an empty
+    # settings file so nothing outside tmp_path gets written.
+    config_path = tmp_path / "dedrm.json"
+    config_path.write_text("{}")
+
+    def run(*args):
+        return subprocess.run([sys.executable, plugin_zip, "--config", str(config_path)] + list(args),
+                              cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True, timeout=300)
+    return run
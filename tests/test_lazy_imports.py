@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Cold import checks for the DeDRM plugin: the format handlers and the big
+# kfxtables lookup tables must only be loaded when a book needs them.
+#
+# calibre loads the plugin from its zip file without cached bytecode, so the
+# modules are imported in a fresh interpreter with an empty bytecode cache,
+# which compiles every module from source like calibre does.
+#
+# Run this file directly to print the cold import time of the main modules.
+
+import os, sys, json, subprocess, tempfile
+
+import pytest
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "DeDRM_plugin")
+
+# modules that are only needed for some book formats
+HANDLER_MODULES = ["ineptepub", "ineptpdf", "lcpdedrm", "k4mobidedrm", "kfxdedrm", "ion", "kfxtables",
+                   "topazextract", "genbook", "androidkindlekey", "erdr2pml", "config"]
+
+
+def cold_import(statements, cache_dir):
+    # Runs the statements in a new interpreter and returns how long they took
+    # and the modules that were loaded afterwards.
+    code = "\n".join([
+        "import json, sys, time",
+        "sys.path.insert(0, {0!r})".format(PLUGIN_DIR),
+        "start = time.perf_counter()",
+        statements,
+        "seconds = time.perf_counter() - start",
+        "print(json.dumps({'seconds': seconds, 'modules': sorted(sys.modules)}))",
+    ])
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1", PYTHONPYCACHEPREFIX=str(cache_dir))
+    result = subprocess.run([sys.executable, "-c", code], env=env, cwd=str(cache_dir),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def have_pycryptodome():
+    for name in ["Cryptodome.Util.py3compat", "Crypto.Util.py3compat"]:
+        try:
+            __import__(name)
+            return True
+        except ImportError:
+            pass
+    return False
+
+
+def test_plugin_import_loads_no_handlers(tmp_path):
+    loaded = cold_import("import __init__", tmp_path)["modules"]
+    assert [name for name in HANDLER_MODULES if name in loaded] == []
+
+
+def test_k4mobidedrm_import_loads_no_kfx_or_topaz(tmp_path):
+    loaded = cold_import("import k4mobidedrm", tmp_path)["modules"]
+    for name in ["kfxdedrm", "ion", "kfxtables", "topazextract", "androidkindlekey"]:
+        assert name not in loaded
+
+
+@pytest.mark.skipif(not have_pycryptodome(), reason="ion needs pycryptodome")
+def test_kfxtables_loaded_on_first_use(tmp_path):
+    assert "kfxtables" not in cold_import("import ion", tmp_path)["modules"]
+    assert "kfxtables" in cold_import("import ion\nion.loadkfxtables()", tmp_path)["modules"]
+
+
+def test_k4mobidedrm_cold_import_time(tmp_path):
+    # Importing the Kindle handler used to compile kfxtables as well. Compare
+    # against compiling kfxtables on its own on the same machine, so the
+    # check doesn't depend on how fast the machine is.
+    k4mobi = min(cold_import("import k4mobidedrm", tmp_path)["seconds"] for i in range(3))
+    tables = min(cold_import("import kfxtables", tmp_path)["seconds"] for i in range(3))
+    print("k4mobidedrm {0:.3f}s, kfxtables {1:.3f}s".format(k4mobi, tables))
+    assert k4mobi < tables / 2
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for statements in ["import __init__", "import k4mobidedrm", "import ineptepub", "import ineptpdf",
+                           "import ion", "import ion\nion.loadkfxtables()", "import kfxtables"]:
+            try:
+                seconds = min(cold_import(statements, cache_dir)["seconds"] for i in range(3))
+            except AssertionError as e:
+                print("{0:<36} failed: {1}".format(statements.replace("\n", "; "), str(e).splitlines()[-1]))
+                continue
+            print("{0:<36} {1:7.3f}s".format(statements.replace("\n", "; "), seconds))
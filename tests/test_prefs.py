@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Checks that settings changes made at the same time by several processes,
+# like remove_drm's workers, all end up in the settings files.
+
+import os, sys, json, multiprocessing
+
+import pytest
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "DeDRM_plugin")
+sys.path.insert(0, PLUGIN_DIR)
+
+import prefs
+
+WORKERS = 4
+BOOKS = 25
+
+
+def add_keys(worker, json_path):
+    prefs.default_json_path = json_path
+    for i in range(BOOKS):
+        dedrmprefs = prefs.DeDRM_Prefs()
+        added, name = dedrmprefs.addnamedvaluetoprefs("adeptkeys", "key", "{0}-{1}".format(worker, i))
+        assert added
+        dedrmprefs.writeprefs()
+        prefs.DeDRM_KeyHints().remember("book-{0}-{1}".format(worker, i), name)
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_parallel_updates_are_kept(tmp_path):
+    json_path = str(tmp_path / "dedrm.json")
+    with open(json_path, "w") as f:
+        f.write("{}")
+
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=add_keys, args=(worker, json_path)) for worker in range(WORKERS)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert [proc.exitcode for proc in procs] == [0] * WORKERS
+
+    with open(json_path) as f:
+        keys = json.load(f)["adeptkeys"]
+    with open(str(tmp_path / "dedrm_keyhints.json")) as f:
+        hints = json.load(f)
+
+    values = set("{0}-{1}".format(worker, i) for worker in range(WORKERS) for i in range(BOOKS))
+    assert set(keys.values()) == values
+    assert len(keys) == len(values)
+    assert len(hints) == len(values)
+    assert set(hints.values()) == set(keys)
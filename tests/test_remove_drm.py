@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# End-to-end tests for the standalone "remove_drm" command, run against a
+# release-style DeDRM_plugin.zip outside of calibre.
+
+import json, zipfile
+from hashlib import md5
+
+
+# PDF standard security handler padding string
+PDF_PASSWORD_PAD = bytes.fromhex("28bf4e5e4e758a4164004e56fffa01082e2e00b6d0683e802f0ca9fe6453697a")
+
+PAGE_CONTENT = b"0 0 m 100 100 l S"
+
+
+def rc4(key, data):
+    s = list(range(256))
+    j = 0
+    for i in range(256):
+        j = (j + s[i] + key[i % len(key)]) & 0xff
+        s[i], s[j] = s[j], s[i]
+    out = bytearray()
+    i = j = 0
+    for c in data:
+        i = (i + 1) & 0xff
+        j = (j + s[i]) & 0xff
+        s[i], s[j] = s[j], s[i]
+        out.append(c ^ s[(s[i] + s[j]) & 0xff])
+    return bytes(out)
+
+
+def make_pdf(path, encrypt=False):
+    # A one page PDF. With encrypt, its content stream is encrypted with
+    # 40-bit RC4 (V=1, R=2) and empty user and owner passwords.
+    docid = b"0123456789abcdef"
+    content = PAGE_CONTENT
+    trailer = b""
+    objs = [b"<</Type/Catalog/Pages 2 0 R>>",
+            b"<</Type/Pages/Kids[3 0 R]/Count 1>>",
+            b"<</Type/Page/Parent 2 0 R/MediaBox[0 0 100 100]/Contents 4 0 R>>"]
+    if encrypt:
+        permissions = -4
+        owner = rc4(md5(PDF_PASSWORD_PAD).digest()[:5], PDF_PASSWORD_PAD)
+        filekey = md5(PDF_PASSWORD_PAD + owner + permissions.to_bytes(4, "little", signed=True) + docid).digest()[:5]
+        user = rc4(filekey, PDF_PASSWORD_PAD)
+        content = rc4(md5(filekey + (4).to_bytes(3, "little") + b"\0\0").digest()[:10], content)
+        trailer = b"/Encrypt 5 0 R"
+    objs.append(b"<</Length %d>>\nstream\n" % len(content) + content + b"\nendstream")
+    if encrypt:
+        objs.append(b"<</Filter/Standard/V 1/R 2/O<" + owner.hex().encode() + b">/U<" + user.hex().encode() +
+                    b">/P %d>>" % permissions)
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for num, obj in enumerate(objs):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % (num + 1) + obj + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<</Size %d/Root 1 0 R/ID[<%s><%s>]%s>>\nstartxref\n%d\n%%%%EOF\n" % (
+            len(objs) + 1, docid.hex().encode(), docid.hex().encode(), trailer, xref)
+    path.write_bytes(data)
+
+
+def make_epub(path):
+    with zipfile.ZipFile(str(path), "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr("META-INF/container.xml", '<?xml version="1.0"?><container version="1.0" '
+                    'xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+                    '<rootfile full-path="content.opf" media-type="application/oebps-package+xml"/>'
+                    '</rootfiles></container>')
+        zf.writestr("content.opf", '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf"/>')
+        zf.writestr("text.html", "<html><body><p>Hello</p></body></html>")
+
+
+def read_journal(path):
+    with open(str(path), "r", encoding="utf-8") as f:
+        return {entry["input"]: entry for entry in map(json.loads, f)}
+
+
+def test_drm_free_books(run_plugin, tmp_path):
+    make_epub(tmp_path / "free.epub")
+    make_pdf(tmp_path / "free.pdf")
+
+    result = run_plugin("remove_drm", "--outputdir", "out", "--workers", "2", "free.epub", "free.pdf")
+
+    assert result.returncode == 0, result.stdout
+    assert "0 decrypted, 2 DRM-free, 0 failed" in result.stdout
+    assert (tmp_path / "out" / "free.pdf").read_bytes() == (tmp_path / "free.pdf").read_bytes()
+    with zipfile.ZipFile(str(tmp_path / "out" / "free.epub")) as zf:
+        assert zf.read("text.html") == b"<html><body><p>Hello</p></body></html>"
+    journal = read_journal(tmp_path / "out" / "remove_drm_journal.txt")
+    assert sorted(entry["status"] for entry in journal.values()) == ["drm-free", "drm-free"]
+
+
+def test_decrypt_pdf(run_plugin, tmp_path):
+    make_pdf(tmp_path / "locked.pdf", encrypt=True)
+    assert PAGE_CONTENT not in (tmp_path / "locked.pdf").read_bytes()
+
+    result = run_plugin("remove_drm", "--outputdir", "out", "locked.pdf")
+
+    assert result.returncode == 0, result.stdout
+    assert "1 decrypted, 0 DRM-free, 0 failed" in result.stdout
+    output = (tmp_path / "out" / "locked.pdf").read_bytes()
+    assert PAGE_CONTENT in output
+    assert b"/Encrypt" not in output
+
+
+def test_unknown_file_fails(run_plugin, tmp_path):
+    (tmp_path / "notabook.epub").write_bytes(b"nothing to see here" * 10)
+
+    result = run_plugin("remove_drm", "--outputdir", "out", "notabook.epub")
+
+    assert result.returncode == 1
+    assert "0 decrypted, 0 DRM-free, 1 failed" in result.stdout
+    assert not (tmp_path / "out" / "notabook.epub").exists()
+
+
+def test_resume(run_plugin, tmp_path):
+    make_epub(tmp_path / "a.epub")
+    make_epub(tmp_path / "b.epub")
+    assert run_plugin("remove_drm", "--outputdir", "out", "a.epub").returncode == 0
+
+    result = run_plugin("remove_drm", "--outputdir", "out", "--resume", "a.epub", "b.epub")
+
+    assert result.returncode == 0, result.stdout
+    assert "0 decrypted, 1 DRM-free, 0 failed, 1 skipped" in result.stdout
+    assert set(read_journal(tmp_path / "out" / "remove_drm_journal.txt")) == \
+        set([str(tmp_path / "a.epub"), str(tmp_path / "b.epub")])
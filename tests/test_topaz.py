@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Checks the Topaz conversion against the output of the code before the
+# record store, buffer based PageParser, FlatDoc, glyph table and style sheet
+# rewrites, using the synthetic book from topazbook.py.
+#
+# data/topaz_baseline.json has the SHA-256 of every file in the htmlz and SVG
+# zip, and of the flat xml and xml of some records, as made by that code.
+
+import os, sys, json, hashlib, zipfile, contextlib, io
+
+import pytest
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "DeDRM_plugin")
+sys.path.insert(0, PLUGIN_DIR)
+
+import convert2xml
+import topazextract
+from flatdoc import FlatDoc
+
+import topazbook
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "topaz_baseline.json")) as f:
+    BASELINE = json.load(f)
+
+RECORDS = [(b'page', 0), (b'page', 1), (b'glyphs', 0), (b'other', 0)]
+
+
+def digest(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def zipDigests(path):
+    with zipfile.ZipFile(path) as zf:
+        return dict((name, digest(zf.read(name))) for name in zf.namelist())
+
+
+def recordFile(name, index):
+    return '{0}{1:04d}.dat'.format(name.decode('ascii'), index)
+
+
+def reference_find(lines, tagpath, pos, end):
+    # DocParser.findinDoc as it was before FlatDoc
+    result = None
+    cnt = len(lines)
+    if end == -1 :
+        end = cnt
+    else:
+        end = min(cnt,end)
+    foundat = -1
+    for j in range(pos, end):
+        item = lines[j]
+        if item.find(b'=') >= 0:
+            (name, argres) = item.split(b'=',1)
+        else :
+            name = item
+            argres = b''
+        if name.endswith(tagpath) :
+            result = argres
+            foundat = j
+            break
+    return foundat, result
+
+
+def reference_findexact(lines, path):
+    # the exact name lookup GParser.getData did before FlatDoc
+    for j, item in enumerate(lines):
+        name, sep, value = item.partition(b'=')
+        if name == path:
+            return j, value
+    return -1, None
+
+
+@pytest.fixture(scope="module")
+def records():
+    return topazbook.bookRecords()
+
+
+@pytest.fixture(scope="module")
+def dictionary(records):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return convert2xml.Dictionary('dict0000.dat', records[b'dict'][0])
+
+
+def flatxml(dictionary, records, name, index):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return convert2xml.fromData(dictionary, recordFile(name, index), records[name][index])
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_book_matches_baseline(tmp_path, workers):
+    book = str(tmp_path / "book.tpz")
+    topazbook.build(book)
+    with contextlib.redirect_stdout(io.StringIO()):
+        tb = topazextract.TopazBook(book, workers)
+        try:
+            assert tb.processBook([topazbook.PID.decode('ascii')]) == 0
+            tb.getFile(str(tmp_path / "book.htmlz"))
+            tb.getSVGZip(str(tmp_path / "book_svg.zip"))
+        finally:
+            tb.cleanup()
+
+    assert zipDigests(str(tmp_path / "book.htmlz")) == BASELINE["htmlz"]
+    assert zipDigests(str(tmp_path / "book_svg.zip")) == BASELINE["svgzip"]
+
+
+@pytest.mark.parametrize("name,index", RECORDS)
+def test_page_parser_matches_baseline(tmp_path, dictionary, records, name, index):
+    fname = recordFile(name, index)
+    expected = BASELINE["pages"][fname]
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert digest(convert2xml.fromData(dictionary, fname, records[name][index])) == expected["flat"]
+        assert digest(convert2xml.getXML(dictionary, fname, records[name][index])) == expected["xml"]
+
+        # and read from a file, like the command line does
+        path = tmp_path / fname
+        path.write_bytes(records[name][index])
+        assert digest(convert2xml.fromData(dictionary, str(path))) == expected["flat"]
+
+
+@pytest.mark.parametrize("name,index", RECORDS)
+def test_flatdoc_find(dictionary, records, name, index):
+    flat = flatxml(dictionary, records, name, index)
+    lines = flat.split(b'\n')
+    doc = FlatDoc(flat)
+    size = len(lines)
+
+    tagpaths = set()
+    for line in lines:
+        parts = line.partition(b'=')[0].split(b'.')
+        for i in range(len(parts)):
+            tagpaths.add(b'.'.join(parts[i:]))
+    tagpaths.add(b'no.such.tag')
+
+    # negative positions count back from the end, like a list index
+    positions = [-size, -size // 2, -3, -1, 0, 1, size // 3, size // 2, size - 1, size]
+    ends = [-1, 0, 2, size // 2, size, size + 5]
+    for tagpath in sorted(tagpaths):
+        for pos in positions:
+            for end in ends:
+                assert doc.find(tagpath, pos, end) == reference_find(lines, tagpath, pos, end), (tagpath, pos, end)
+        assert doc.find(tagpath.decode('ascii'), 0, -1) == reference_find(lines, tagpath, 0, -1)
+        assert doc.findexact(tagpath) == reference_findexact(lines, tagpath)
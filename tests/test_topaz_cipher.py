@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Checks alfcrypto.Topaz_Cipher against the old str based implementation.
+#
+# Run this file directly for a micro-benchmark of both on a page sized
+# record, including the bytes(record, 'latin-1') the callers needed with
+# the old str result.
+
+import os, sys, zlib, timeit, random
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "DeDRM_plugin")
+sys.path.insert(0, PLUGIN_DIR)
+
+from alfcrypto import Topaz_Cipher
+
+
+def reference_decrypt(data, ctx):
+    # Topaz_Cipher.decrypt as it was before it returned bytes
+    ctx1 = ctx[0]
+    ctx2 = ctx[1]
+    plainText = ""
+    for dataByte in data:
+        m = (dataByte ^ ((ctx1 >> 3) &0xFF) ^ ((ctx2<<3) & 0xFF)) &0xFF
+        ctx2 = ctx1
+        ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) &0xFFFFFFFF) ^((m * m * 0x0F902007) &0xFFFFFFFF)
+        plainText += chr(m)
+    return plainText
+
+
+def page_record(size=48 * 1024):
+    # Topaz page records are zlib compressed text, so their bytes are close
+    # to random. Sized like a large page of a novel.
+    rnd = random.Random(1)
+    words = [bytes(rnd.choice(b"etaoinshrdlucmfwyp") for i in range(rnd.randint(2, 9))) for j in range(2000)]
+    text = b""
+    while len(zlib.compress(text)) < size:
+        text += b" ".join(rnd.choice(words) for i in range(1000))
+    return zlib.compress(text)[:size]
+
+
+KEY = b"\x9d\x8a\x02\x1f\x11\x08\xa7\xc3"
+
+
+def test_matches_reference():
+    record = page_record(8 * 1024)
+    cipher = Topaz_Cipher()
+    plain = cipher.decrypt(record, cipher.ctx_init(KEY))
+    assert isinstance(plain, bytes)
+    assert plain == bytes(reference_decrypt(record, Topaz_Cipher().ctx_init(KEY)), "latin-1")
+
+
+def test_decrypt_in_pieces():
+    record = page_record(8 * 1024)
+    cipher = Topaz_Cipher()
+    whole = cipher.decrypt(record, cipher.ctx_init(KEY))
+    ctx = cipher.ctx_init(KEY)
+    pieces = [cipher.decrypt(record[pos:pos + 1000], ctx) for pos in range(0, len(record), 1000)]
+    assert b"".join(pieces) == whole
+
+
+if __name__ == "__main__":
+    record = page_record()
+    cipher = Topaz_Cipher()
+    number = 20
+    old = min(timeit.repeat(lambda: bytes(reference_decrypt(record, cipher.ctx_init(KEY)), "latin-1"),
+                            number=number, repeat=3)) / number
+    new = min(timeit.repeat(lambda: cipher.decrypt(record, cipher.ctx_init(KEY)),
+                            number=number, repeat=3)) / number
+    print("{0} byte record: str {1:.2f} ms, bytearray {2:.2f} ms, {3:.1f}x".format(
+            len(record), old * 1000, new * 1000, old / new))
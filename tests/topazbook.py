@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Builds small synthetic Topaz books for the Topaz tests.
+#
+# The books have text, fixed and graphic regions, glyphs, images, a style
+# sheet and an original page id map where two page files make up one page,
+# so the HTML, CSS and SVG conversions all have something to do. Records are
+# encrypted with a book key, which is itself encrypted with PID.
+#
+# Run this file directly to write a book: topazbook.py <book.tpz> [<pages>]
+
+import sys, zlib, random
+
+PID = b'ABCDEFGH'
+BOOK_KEY = b'BOOKKEY1'
+
+WORDS = [b'alpha', b'beta', b'gamma', b'delta', b'epsilon', b'zeta', b'eta', b'theta',
+         b'iota', b'kappa', b'lambda', b'mu', b'<nu>', b'xi&omicron']
+
+GLYPHS = 40
+
+
+def encodeNumber(n):
+    # Topaz 7 bit encoded number, negative numbers have a 0xff prefix
+    if n < 0:
+        return b'\xff' + encodeNumber(-n)
+    groups = []
+    while True:
+        groups.append(n & 0x7f)
+        n >>= 7
+        if n == 0:
+            break
+    groups.reverse()
+    out = bytes([g | 0x80 for g in groups[:-1]] + [groups[-1]])
+    if out[0] == 0xff:
+        out = b'\x80' + out
+    return out
+
+
+def lengthPrefixString(data):
+    return encodeNumber(len(data)) + data
+
+
+class Dictionary(object):
+    # the book's string dictionary, strings get an index on first use
+    def __init__(self):
+        self.strings = [b'']
+        self.index = {}
+
+    def __call__(self, string):
+        if string not in self.index:
+            self.index[string] = len(self.strings)
+            self.strings.append(string)
+        return self.index[string]
+
+    def data(self):
+        return encodeNumber(len(self.strings)) + b''.join(lengthPrefixString(s) for s in self.strings)
+
+
+def vector(d, values, text=False):
+    # 0x76 vector command: count, mode 0, then the values
+    out = encodeNumber(0x76) + encodeNumber(len(values)) + encodeNumber(0)
+    for value in values:
+        out += encodeNumber(d(value) if text else value)
+    return out
+
+
+def tag(d, name, subtags=None, args=b''):
+    out = encodeNumber(d(name))
+    if subtags is not None:
+        out += encodeNumber(len(subtags)) + b''.join(subtags)
+    return out + args
+
+
+def textArg(d, string):
+    return encodeNumber(d(string))
+
+
+def pageRecord(d, rnd, pno, nwords=60):
+    words = [rnd.choice(WORDS) for i in range(nwords)]
+    nglyphs = nwords * 4
+    half = nwords // 2
+    # the implicit info tag: its subtag count, then the subtags
+    body = encodeNumber(2)
+    body += tag(d, b'word', [tag(d, b'ocrText', None, vector(d, words, True)),
+                             tag(d, b'firstGlyph', None, vector(d, [i * 4 for i in range(nwords)]))])
+    body += tag(d, b'glyph', [tag(d, b'x', None, vector(d, [100 + 30 * i for i in range(nglyphs)])),
+                              tag(d, b'y', None, vector(d, [200 + (i % 7) for i in range(nglyphs)])),
+                              tag(d, b'glyphID', None, vector(d, [i % GLYPHS for i in range(nglyphs)]))])
+    regions = [
+        tag(d, b'region', [tag(d, b'type', None, textArg(d, b'text')),
+                           tag(d, b'paragraph', [tag(d, b'class', None, textArg(d, b'body')),
+                                                 tag(d, b'firstWord', None, encodeNumber(0)),
+                                                 tag(d, b'lastWord', None, encodeNumber(half))], encodeNumber(1))],
+            encodeNumber(2)),
+        tag(d, b'region', [tag(d, b'type', None, textArg(d, b'fixed')),
+                           tag(d, b'paragraph', [tag(d, b'firstWord', None, encodeNumber(half)),
+                                                 tag(d, b'lastWord', None, encodeNumber(nwords - 2))], encodeNumber(3))],
+            encodeNumber(4)),
+        tag(d, b'region', [tag(d, b'type', None, textArg(d, b'graphic')),
+                           tag(d, b'img', [tag(d, b'src', None, encodeNumber(pno % 3)),
+                                           tag(d, b'x', None, encodeNumber(500)),
+                                           tag(d, b'y', None, encodeNumber(600)),
+                                           tag(d, b'h', None, encodeNumber(2000)),
+                                           tag(d, b'w', None, encodeNumber(3000))], encodeNumber(5))],
+            encodeNumber(6)),
+    ]
+    body += tag(d, b'page', [tag(d, b'type', None, textArg(d, b'text')),
+                             tag(d, b'h', None, encodeNumber(11000)),
+                             tag(d, b'w', None, encodeNumber(8500))] + regions, encodeNumber(7))
+    return b'p\x00_PAGE_\x00' + body
+
+
+def glyphsRecord(d, rnd):
+    points = 4
+    body = encodeNumber(3)
+    body += tag(d, b'glyph', [tag(d, b'h', None, vector(d, [300 + i for i in range(GLYPHS)])),
+                              tag(d, b'w', None, vector(d, [200 + i for i in range(GLYPHS)])),
+                              tag(d, b'use', None, vector(d, [1] * GLYPHS)),
+                              tag(d, b'vtx', None, vector(d, [i * points for i in range(GLYPHS)])),
+                              tag(d, b'len', None, vector(d, list(range(GLYPHS)))),
+                              tag(d, b'dpi', None, vector(d, [1440] * GLYPHS))])
+    body += tag(d, b'vtx', [tag(d, b'x', None, vector(d, [rnd.randrange(300) for i in range(GLYPHS * points)])),
+                            tag(d, b'y', None, vector(d, [rnd.randrange(300) for i in range(GLYPHS * points)]))])
+    body += tag(d, b'len', [tag(d, b'n', None, vector(d, [points - 1] * GLYPHS))])
+    return b'g\x00__GLYPH\x00\x00\x00' + body
+
+
+def styleTag(d, tagname, sclass, rules):
+    subtags = [tag(d, b'_tag', None, textArg(d, tagname)), tag(d, b'class', None, textArg(d, sclass))]
+    for attr, value in rules:
+        subtags.append(tag(d, b'rule', [tag(d, b'attr', None, textArg(d, attr)),
+                                        tag(d, b'value', None, textArg(d, value))], encodeNumber(0)))
+    return tag(d, b'style', subtags, encodeNumber(0))
+
+
+def otherRecord(d, pageids):
+    info = tag(d, b'info', [tag(d, b'original', [tag(d, b'pid', None, vector(d, pageids, True))])])
+    styles = [
+        styleTag(d, b'paragraph', b'body', [(b'margin-top', b'100'), (b'indent', b'400'), (b'line-space', b'150'),
+                                            (b'align', b'justify')]),
+        styleTag(d, b'paragraph', b'ch1 title', [(b'hang', b'200'), (b'margin-left', b'300'),
+                                                 (b'align', b'center')]),
+        styleTag(d, b'graphic', b'picture', [(b'display', b'inline'), (b'margin-bottom', b'50')]),
+    ]
+    book = tag(d, b'book', [tag(d, b'version', [tag(d, b'Topaz_version', None, textArg(d, b'2.6 synthetic')),
+                                                tag(d, b'creation_date', None, textArg(d, b'2020-01-01'))],
+                                encodeNumber(0)),
+                            tag(d, b'stylesheet', styles, encodeNumber(0))], encodeNumber(0))
+    return info + book
+
+
+def jpeg(n):
+    return b'\xff\xd8\xff\xe0' + bytes([n]) * 5000 + b'\xff\xd9'
+
+
+def encrypt(data, key):
+    # Topaz_Cipher run the other way round
+    ctx1 = 0x0CAFFE19E
+    for k in key:
+        ctx2 = ctx1
+        ctx1 = ((((ctx1 >> 2) * (ctx1 >> 7)) & 0xFFFFFFFF) ^ (k * k * 0x0F902007) & 0xFFFFFFFF)
+    out = bytearray()
+    for m in data:
+        out.append((m ^ ((ctx1 >> 3) & 0xFF) ^ ((ctx2 << 3) & 0xFF)) & 0xFF)
+        ctx2 = ctx1
+        ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) & 0xFFFFFFFF) ^ ((m * m * 0x0F902007) & 0xFFFFFFFF)
+    return bytes(out)
+
+
+def bookRecords(npages=6, seed=5):
+    # The records of a book by name, and the dictionary record data
+    rnd = random.Random(seed)
+    d = Dictionary()
+    records = {}
+    records[b'page'] = [pageRecord(d, rnd, i) for i in range(npages)]
+    records[b'glyphs'] = [glyphsRecord(d, rnd)]
+    # page files 1 and 2 are both parts of page 1
+    records[b'other'] = [otherRecord(d, [str(pageid).encode() for pageid in [0] + [max(1, i - 1) for i in range(1, npages)]])]
+    records[b'img'] = [jpeg(i) for i in range(3)]
+    records[b'color'] = [b'', jpeg(200)]
+    records[b'dict'] = [d.data()]
+    return records
+
+
+def build(path, npages=6, seed=5):
+    records = bookRecords(npages, seed)
+    metadata = [(b'Title', b'Synthetic & <Book>'), (b'Authors', b'A. N. Other'), (b'UpdateTime', b'2020-01-01'),
+                (b'ASIN', b'B000TEST'), (b'GUID', b'guid-1234'), (b'keys', b'k1'), (b'k1', b'val1')]
+    metadata = bytes([0, len(metadata)]) + b''.join(lengthPrefixString(k) + lengthPrefixString(v) for k, v in metadata)
+    dkey = b'PID' + bytes([8]) + PID + bytes([8]) + BOOK_KEY + b'pid'
+    dkey = encrypt(dkey, PID)
+    dkey = bytes([1, len(dkey)]) + dkey
+
+    payload = bytearray()
+    headers = {}
+
+    def add(name, index, data, encrypted=False, compress=False):
+        offset = len(payload)
+        size = len(data)
+        compressed = 0
+        if compress:
+            data = zlib.compress(data)
+            compressed = len(data)
+        if encrypted:
+            data = encrypt(data, BOOK_KEY)
+        payload.extend(lengthPrefixString(name) + encodeNumber(-(index + 1) if encrypted else index) + data)
+        headers.setdefault(name, []).append((offset, size, compressed))
+
+    headers[b'metadata'] = [(0, len(metadata) - 1, 0)]
+    payload.extend(lengthPrefixString(b'metadata') + metadata)
+    add(b'dkey', 0, dkey)
+    for name in (b'dict', b'other', b'page', b'glyphs', b'img', b'color'):
+        for index, data in enumerate(records[name]):
+            add(name, index, data, name in (b'page', b'dict', b'glyphs', b'other'), name in (b'page', b'glyphs'))
+
+    out = b'TPZ0' + encodeNumber(len(headers))
+    for name, values in headers.items():
+        out += b'\x63' + lengthPrefixString(name) + encodeNumber(len(values))
+        for value in values:
+            out += b''.join(encodeNumber(v) for v in value)
+    out += b'\x64' + bytes(payload)
+    with open(path, 'wb') as f:
+        f.write(out)
+
+
+if __name__ == '__main__':
+    build(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 6)